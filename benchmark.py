@@ -0,0 +1,316 @@
+#!/usr/bin/python
+
+"""
+Benchmark the guardfraction scripts against synthetic consensuses and
+databases of realistic size, and report the results as JSON so that
+they can be compared across commits.
+"""
+
+import logging
+import argparse
+import sys
+import os
+import datetime
+import base64
+import json
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+import guardiness.consensus as consensus
+import guardiness.sqlite_db as sqlite_db
+import databaser
+import guardfraction
+
+SQLITE_DB_SCHEMA = "./db_schema.sql"
+
+CONSENSUS_HEADER = """@type network-status-microdesc-consensus-3 1.0
+network-status-version 3 microdesc
+vote-status consensus
+consensus-method 17
+valid-after %(valid_after)s
+fresh-until %(fresh_until)s
+valid-until %(valid_until)s
+voting-delay 300 300
+known-flags Authority BadExit Exit Fast Guard HSDir Named Running Stable Unnamed V2Dir Valid
+dir-source synthetic 0000000000000000000000000000000000000000 127.0.0.1 127.0.0.1 80 443
+contact nobody
+vote-digest 0000000000000000000000000000000000000000
+"""
+
+CONSENSUS_FOOTER = """directory-footer
+bandwidth-weights Wbd=0 Wbe=0 Wbg=4143 Wbm=10000 Wdb=10000 Web=10000 Wed=10000 Wee=10000 Weg=10000 Wem=10000 Wgb=10000 Wgd=0 Wgg=5857 Wgm=5857 Wmb=10000 Wmd=0 Wme=0 Wmg=4143 Wmm=10000
+"""
+
+class SyntheticNetwork(object):
+    """
+    A made up Tor network whose relays come and go, and whose guards
+    gain and lose the Guard flag, as the hours pass.
+    """
+
+    def __init__(self, relays_n, guards_n, churn, seed):
+        """
+        Make a network of 'relays_n' relays out of which 'guards_n' are
+        guards. Every hour, a 'churn' fraction of the relays leaves the
+        network and is replaced by new relays, and a 'churn' fraction of
+        the guards loses its flag to another relay.
+        """
+        self.random = random.Random(seed)
+        self.churn = churn
+
+        self.relays = [self._new_fingerprint() for _ in xrange(relays_n)]
+        self.guards_n = guards_n
+        self.guards = set(self.random.sample(self.relays, guards_n))
+
+    def _new_fingerprint(self):
+        return "%040X" % self.random.getrandbits(160)
+
+    def step(self):
+        """Move the network one hour forward."""
+
+        for _ in xrange(int(len(self.relays) * self.churn)):
+            i = self.random.randrange(len(self.relays))
+            self.guards.discard(self.relays[i])
+            self.relays[i] = self._new_fingerprint()
+
+        # Guards that left the network are replaced too, or the
+        # network would run out of guards over long histories.
+        for _ in xrange(int(self.guards_n * self.churn)):
+            self.guards.discard(self.random.choice(tuple(self.guards)))
+        while len(self.guards) < self.guards_n:
+            self.guards.add(self.random.choice(self.relays))
+
+    def consensus_str(self, valid_after):
+        """Return the network as a microdesc consensus from 'valid_after'."""
+
+        lines = [CONSENSUS_HEADER % {
+            "valid_after" : valid_after,
+            "fresh_until" : valid_after + datetime.timedelta(hours=1),
+            "valid_until" : valid_after + datetime.timedelta(hours=3)}]
+
+        for i, fingerprint in enumerate(self.relays):
+            identity = base64.b64encode(fingerprint.decode("hex")).rstrip("=")
+            flags = "Fast Guard Running Stable Valid" if fingerprint in self.guards else "Fast Running Valid"
+            lines.append("r relay%d %s %s 10.%d.%d.%d 9001 0\n" % (
+                i, identity, valid_after, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff))
+            lines.append("m %s\n" % base64.b64encode(fingerprint.decode("hex") * 2)[:43])
+            lines.append("s %s\n" % flags)
+            lines.append("v Tor 0.2.4.22\n")
+            lines.append("w Bandwidth=%d\n" % (i % 10000))
+
+        lines.append(CONSENSUS_FOOTER)
+        return "".join(lines)
+
+def hours_until_now(hours_n):
+    """Return the last 'hours_n' full hours, oldest first."""
+    now = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    return [now - datetime.timedelta(hours=hours_n - i) for i in xrange(hours_n)]
+
+def write_consensus_dir(network, consensus_dir, hours_n):
+    """Write 'hours_n' consensuses of 'network' to 'consensus_dir'."""
+    for valid_after in hours_until_now(hours_n):
+        network.step()
+        filename = valid_after.strftime("%Y-%m-%d-%H-%M-%S-consensus-microdesc")
+        with open(os.path.join(consensus_dir, filename), "w") as consensus_fd:
+            consensus_fd.write(network.consensus_str(valid_after))
+
+def populate_db(network, db_cursor, hours_n, missing_ratio):
+    """
+    Import 'hours_n' consensuses of 'network' straight to the database
+    at 'db_cursor', skipping a 'missing_ratio' of them.
+    """
+    consensus_parser = consensus.ConsensusParser()
+    for valid_after in hours_until_now(hours_n):
+        network.step()
+        if network.random.random() < missing_ratio:
+            continue
+        consensus_parser.import_guards(valid_after, list(network.guards), db_cursor)
+
+def read_all_guards(read_func, *args):
+    """
+    Call 'read_func', one of the read_db_file*() functions of
+    guardfraction.py, and read all the guards it returns. They are
+    streamed out of the database lazily, so this is when the work gets
+    done. Return whatever 'read_func' returned.
+    """
+    ret = read_func(*args)
+    for guards, _ in (ret.values() if isinstance(ret, dict) else [ret]):
+        for _ in guards:
+            pass
+    return ret
+
+def peak_rss_kb():
+    """Return the peak resident set size of this process so far, in KB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def git_revision():
+    """Return the git commit we are benchmarking, if we can tell."""
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Stopwatch(object):
+    """Times the stages of the benchmark and records their results."""
+
+    def __init__(self):
+        # Maps a <stage name> to a <dict of results>.
+        self.results = {}
+
+    def run(self, stage, items_n, func, *args, **kwargs):
+        """Call 'func' and record how long it took to handle 'items_n' items."""
+        start = time.time()
+        ret = func(*args, **kwargs)
+        seconds = time.time() - start
+
+        self.results[stage] = {
+            "seconds" : round(seconds, 4),
+            "items" : items_n,
+            "items_per_second" : round(items_n / seconds, 2) if seconds else None,
+        }
+        logging.info("%s: %.3fs", stage, seconds)
+
+        return ret
+
+def run_benchmark(args, work_dir):
+    """Run all the benchmark stages in 'work_dir' and return the report."""
+
+    stopwatch = Stopwatch()
+    report = {
+        "revision" : git_revision(),
+        "params" : vars(args),
+        "results" : stopwatch.results,
+    }
+
+    # Import benchmark: parse real consensus files into a fresh database.
+    consensus_dir = os.path.join(work_dir, "consensus_dir")
+    os.mkdir(consensus_dir)
+    network = SyntheticNetwork(args.relays, args.guards, args.churn, args.seed)
+    write_consensus_dir(network, consensus_dir, args.import_hours)
+
+    import_db_file = os.path.join(work_dir, "import.db")
+    db_conn, db_cursor = sqlite_db.init_db(import_db_file, SQLITE_DB_SCHEMA, "import")
+    stopwatch.run("import_consensus_dir_to_db", args.import_hours,
+                  databaser.import_consensus_dir_to_db, db_cursor, consensus_dir, False,
+                  jobs=args.jobs, fast=args.fast_parse)
+    db_conn.commit()
+    db_conn.close()
+
+    # Aggregation benchmarks: a database with a long history.
+    db_file = os.path.join(work_dir, "guardfraction.db")
+    db_conn, db_cursor = sqlite_db.init_db(db_file, SQLITE_DB_SCHEMA, "import")
+    hours_n = args.days * 24
+    stopwatch.run("populate_db", hours_n,
+                  populate_db, network, db_cursor, hours_n, args.missing)
+    db_conn.commit()
+    db_conn.close()
+    report["db_size_bytes"] = os.path.getsize(db_file)
+
+    # Without running counters guardfraction has to count everything.
+    db_conn, db_cursor = sqlite_db.init_db(db_file, profile="aggregate")
+    stopwatch.run("read_db_file_cold", hours_n,
+                  read_all_guards, guardfraction.read_db_file, db_conn, db_cursor, args.days)
+    db_conn.close()
+
+    # Then databaser builds the counters once, and keeps them moving.
+    db_conn, db_cursor = sqlite_db.init_db(db_file, profile="import")
+    window_start = sqlite_db.get_window_start(db_cursor, args.days)
+    stopwatch.run("update_guard_counts", hours_n,
+                  sqlite_db.update_guard_counts, db_conn, db_cursor, args.days, window_start)
+    db_conn.close()
+
+    db_conn, db_cursor = sqlite_db.init_db(db_file, profile="aggregate")
+    guards, consensuses_read_n = stopwatch.run("read_db_file_warm", hours_n,
+                                               read_all_guards, guardfraction.read_db_file,
+                                               db_conn, db_cursor, args.days)
+
+    # Writing the output file reads the guards out of the database
+    # again, as they get written.
+    output_file = os.path.join(work_dir, "guardfraction.output")
+    stopwatch.run("write_output_file", len(guards),
+                  guards.write_output_file, output_file, args.days, consensuses_read_n)
+    db_conn.close()
+
+    # A third, half and all of the history, in one pass.
+    db_conn, db_cursor = sqlite_db.init_db(db_file, profile="aggregate")
+    windows = sorted(set([max(args.days // 3, 1), max(args.days // 2, 1), args.days]))
+    stopwatch.run("read_db_file_windows", hours_n,
+                  read_all_guards, guardfraction.read_db_file_windows, db_conn, db_cursor, args.days, windows)
+    db_conn.close()
+
+    db_conn, db_cursor = sqlite_db.init_db(db_file, profile="aggregate")
+    stdout = sys.stdout
+    try:
+        with open(os.devnull, "w") as sys.stdout:
+            stopwatch.run("print_missing_consensuses", hours_n,
+                          guardfraction.print_missing_consensuses, db_conn, db_cursor, args.days)
+    finally:
+        sys.stdout = stdout
+    db_conn.close()
+
+    # ru_maxrss is a high-water mark for the whole process, so it can
+    # only be reported for the run as a whole, not per stage.
+    report["peak_rss_kb"] = peak_rss_kb()
+    return report
+
+def parse_cmd_args():
+    parser = argparse.ArgumentParser("benchmark.py",
+                                      formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--days", type=int, default=90,
+                        help="Days of history in the aggregation database.")
+    parser.add_argument("--import-hours", type=int, default=24,
+                        help="Number of consensus files to generate and import.")
+    parser.add_argument("--relays", type=int, default=6000,
+                        help="Number of relays in each consensus.")
+    parser.add_argument("--guards", type=int, default=2000,
+                        help="Number of guards in each consensus.")
+    parser.add_argument("--churn", type=float, default=0.005,
+                        help="Fraction of relays and guards replaced every hour.")
+    parser.add_argument("--missing", type=float, default=0.01,
+                        help="Fraction of consensuses missing from the aggregation database.")
+    parser.add_argument("--seed", type=int, default=236,
+                        help="Seed of the random generator.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes to parse consensuses with.")
+    parser.add_argument("--fast-parse", action="store_true", default=False,
+                        help="Import consensuses with the fast guard flag extractor.")
+    parser.add_argument("--work-dir", type=str, default=None,
+                        help="Where to put the generated files (default: a temporary directory).")
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="Write the JSON report here instead of stdout.")
+
+    return parser.parse_args()
+
+def main():
+    """Run the benchmark and print a JSON report."""
+
+    logging.getLogger("").setLevel(logging.INFO)
+
+    # Parse CLI
+    args = parse_cmd_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="guardfraction-bench-")
+    try:
+        report = run_benchmark(args, work_dir)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+    report_str = json.dumps(report, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output_fd:
+            output_fd.write(report_str + "\n")
+    else:
+        print report_str
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        logging.warning("Caught ^C. Closing.")
+        sys.exit(1)
@@ -9,53 +9,378 @@ import logging
 import argparse
 import sys
 import os
+import datetime
 import sqlite3
+import itertools
+import functools
+import operator
+import signal
+import subprocess
+import tarfile
+import multiprocessing
+import collections
 
 import guardiness.consensus as consensus
 import guardiness.sqlite_db as sqlite_db
+import guardiness.stats as stats
+import guardiness.snapshot as snapshot
+import guardiness.fetch as fetch
 
 SQLITE_DB_FILE = "./guardfraction.db"
 SQLITE_DB_SCHEMA = "./db_schema.sql"
+# Window that we keep the running guard counters for.
+DEFAULT_WINDOW_DAYS = 90
 
 # XXX Fix this! ERROR:root:There was an error initializing the database. Maybe
 # there is already a database in './guardiness.db'? The error message
 # is 'table relays already exists'. Exiting.
 
 
-def import_consensus_dir_to_db(db_cursor, consensus_dir, delete_imported):
+# How many of the consensuses given along with a snapshot to parse
+# and check against it.
+DEFAULT_SNAPSHOT_VERIFY_N = 3
+
+# How many consensuses to keep in flight per worker process when
+# parsing in parallel. Keeps the workers busy while the database
+# writer imports, without reading too far ahead of it.
+PARSE_BATCH_PER_JOB = 4
+
+# Consensuses in the CollecTor archives live in this directory, and
+# are named after it. The same archives also hold all the
+# microdescriptors, which we don't want.
+CONSENSUS_MEMBER_DIR = "consensus-microdesc"
+
+def parse_consensuses(parse_func, consensus_items, jobs):
     """
-    Read consensus files from 'consensus_dir' and write guard activity
-    to the db at 'db_cursor'.
+    Yield the result of 'parse_func' on each of 'consensus_items', in
+    order.
+
+    If 'jobs' is more than one, parse in that many worker processes.
+    Every result we yield makes room for the next item to be handed
+    out, so the workers keep parsing while the caller imports.
+    """
+
+    if jobs <= 1:
+        for item in consensus_items:
+            yield parse_func(item)
+        return
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # Results of the items handed out so far, oldest first.
+        pending = collections.deque()
+        for item in consensus_items:
+            pending.append(pool.apply_async(parse_func, (item,)))
+            if len(pending) >= jobs * PARSE_BATCH_PER_JOB:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        # All results have been consumed by now, unless we are bailing
+        # out because of an error; in both cases, stop the workers.
+        pool.terminate()
+        pool.join()
+
+def skip_imported(db_cursor, consensus_items, sniff_func, skipped=None):
+    """
+    Yield the 'consensus_items' whose consensus is not in the database
+    at 'db_cursor' yet.
+
+    'sniff_func' returns the valid-after date of an item by only
+    reading its header, so that we never fully parse a consensus we
+    already have. Items it can't date are kept, and left to the
+    parser to complain about. Skipped items are appended to 'skipped'
+    if it's a list.
+    """
+    with stats.timer("skip_imported"):
+        imported_hours = sqlite_db.get_consensus_hours(db_cursor)
+
+    for item in consensus_items:
+        with stats.timer("skip_imported"):
+            valid_after = sniff_func(item)
+            is_imported = valid_after is not None and sqlite_db.datetime_to_hour(valid_after) in imported_hours
+
+        if is_imported:
+            logging.debug("Skipping consensus %s. Already imported.", valid_after)
+            stats.count("consensuses_skipped")
+            if skipped is not None:
+                skipped.append(item)
+            continue
+
+        yield item
+
+def import_records_to_db(consensus_parser, db_cursor, consensus_names, records):
+    """
+    Import the parsed consensus 'records' to the db at 'db_cursor',
+    and yield the name of each consensus once we are done with it.
+
+    The time spent waiting for 'records' counts as parsing, so with
+    worker processes it's only the parsing that we couldn't overlap
+    with importing.
     """
 
     # Counter used to track progress.
     counter = 0
+    for consensus_name, record in stats.timed_iter("parse", itertools.izip(consensus_names, records)):
+        counter += 1
+        logging.debug("Importing consensus %s (%d)!", consensus_name, counter)
+
+        if record:
+            stats.count("consensuses_parsed")
+            valid_after, guard_fprs = record
+            consensus_parser.import_guards(valid_after, guard_fprs, db_cursor)
+        else:
+            stats.count("consensuses_unparseable")
+
+        yield consensus_name
+
+def import_consensus_dir_to_db(db_cursor, consensus_dir, delete_imported, commit_every=None, jobs=1,
+                               fast=False):
+    """
+    Read consensus files from 'consensus_dir' and write guard activity
+    to the db at 'db_cursor'.
+
+    If 'commit_every' is set, commit the database every 'commit_every'
+    imported consensuses instead of leaving it all to the caller.
+
+    If 'jobs' is more than one, parse the consensuses in that many
+    worker processes. This process remains the only database writer
+    and imports the parsed consensuses in directory order.
+
+    If 'fast' is set, use our own line-based parser instead of stem.
+
+    Consensuses that are already in the database are skipped without
+    being parsed (and still deleted if 'delete_imported' is set).
+    """
+
     # Initialize our singletons.
-    consensus_parser = consensus.ConsensusParser()
+    consensus_parser = consensus.ConsensusParser(commit_every, fast)
 
     # Walk all files in the directory and try to parse them as
     # consensuses to import them to our database.
-    dir_listing = os.listdir(consensus_dir)
-    for filename in dir_listing:
-        counter += 1
-        logging.debug("Parsing consensus %s (%d/%d)!",
-                      filename, counter, len(dir_listing))
+    consensus_files = [os.path.join(consensus_dir, filename)
+                       for filename in sorted(os.listdir(consensus_dir))]
+    consensus_files = [f for f in consensus_files if os.path.isfile(f)] # skip non-files
 
-        consensus_f = os.path.join(consensus_dir, filename)
-        if not os.path.isfile(consensus_f): # skip non-files
-            continue
+    skipped_files = []
+    consensus_files = list(skip_imported(db_cursor, consensus_files, consensus.sniff_consensus_file,
+                                         skipped_files))
+    if delete_imported:
+        for consensus_f in skipped_files:
+            os.remove(consensus_f)
 
-        consensus_parser.parse_and_import_consensus(consensus_f, db_cursor)
+    records = parse_consensuses(functools.partial(consensus.parse_consensus_file, fast=fast),
+                                consensus_files, jobs)
 
+    for consensus_f in import_records_to_db(consensus_parser, db_cursor, consensus_files, records):
         if delete_imported:
             os.remove(consensus_f)
 
+def is_tarball(path):
+    """Return True if 'path' looks like a (possibly compressed) tarball."""
+    if path.endswith(".tar.xz") or path.endswith(".txz"):
+        return True
+
+    return os.path.isfile(path) and tarfile.is_tarfile(path)
+
+def is_consensus_member(member_name):
+    """Return True if the tarball member 'member_name' looks like a consensus by its name."""
+    return (CONSENSUS_MEMBER_DIR in member_name.split("/")[:-1] or
+            member_name.endswith("-" + CONSENSUS_MEMBER_DIR))
+
+def iter_tarball_members(tarball_path):
+    """
+    Yield a (name, contents) tuple for every consensus in the tarball
+    at 'tarball_path', without extracting anything to disk. Members
+    that aren't consensuses by their name, like the microdescriptors
+    of the CollecTor archives, are skipped without being read.
+
+    Our tarfile module doesn't know about xz, so xz tarballs are
+    piped through the xz tool.
+    """
+
+    xz_proc = None
+    if tarball_path.endswith(".tar.xz") or tarball_path.endswith(".txz"):
+        xz_proc = subprocess.Popen(["xz", "--decompress", "--stdout", tarball_path],
+                                   stdout=subprocess.PIPE)
+        tarball = tarfile.open(fileobj=xz_proc.stdout, mode="r|")
+    else:
+        tarball = tarfile.open(tarball_path, mode="r|*")
+
+    try:
+        for member in tarball:
+            if not member.isfile():
+                continue
+            if not is_consensus_member(member.name):
+                stats.count("tarball_members_ignored")
+                continue
+
+            yield member.name, tarball.extractfile(member).read()
+    finally:
+        tarball.close()
+        if xz_proc:
+            xz_proc.stdout.close()
+            if xz_proc.wait() not in (0, -signal.SIGPIPE):
+                raise IOError("xz failed while decompressing %s" % tarball_path)
+
+def import_consensus_tarball_to_db(db_cursor, tarball_path, delete_imported, commit_every=None, jobs=1,
+                                   fast=False):
+    """
+    Read consensuses straight out of the tarball at 'tarball_path',
+    like the CollecTor consensus archives, and write guard activity
+    to the db at 'db_cursor'.
+
+    The rest of the arguments are like in import_consensus_dir_to_db(),
+    except that 'delete_imported' deletes the whole tarball after all
+    its consensuses have been imported.
+    """
+
+    # Initialize our singletons.
+    consensus_parser = consensus.ConsensusParser(commit_every, fast)
+
+    # Split the (name, contents) stream of the consensuses that we
+    # don't have yet into names for the writer and contents for the
+    # parsers.
+    new_members = skip_imported(db_cursor, iter_tarball_members(tarball_path), consensus.sniff_consensus_member)
+    names_stream, members_stream = itertools.tee(new_members)
+    consensus_names = itertools.imap(operator.itemgetter(0), names_stream)
+
+    records = parse_consensuses(functools.partial(consensus.parse_consensus_member, fast=fast),
+                                members_stream, jobs)
+
+    for _ in import_records_to_db(consensus_parser, db_cursor, consensus_names, records):
+        pass
+
+    # Don't throw away the whole tarball before its data hit the disk.
+    if delete_imported:
+        consensus_parser.commit(db_cursor)
+        os.remove(tarball_path)
+
+def import_fetched_consensus(db_cursor, urls, timeout=fetch.DEFAULT_TIMEOUT, retries=fetch.DEFAULT_RETRIES,
+                             fast=False):
+    """
+    Fetch the latest consensus from whichever of 'urls' has a fresh
+    one first (or the newest one, if none of them do), and import it
+    straight to the db at 'db_cursor'.
+
+    Sources are only asked for a consensus newer than the newest one
+    in the database, and consensuses that are too old to be valid
+    don't count. Each source gets 'timeout' seconds per attempt and
+    'retries' more attempts. Raise fetch.FetchError if no source has a
+    fresh one.
+
+    Return True if a new consensus was imported.
+    """
+    db_cursor.execute("SELECT max(consensus_hour) FROM consensus")
+    newest_hour = db_cursor.fetchone()[0]
+    if_modified_since = sqlite_db.hour_to_datetime(newest_hour) if newest_hour is not None else None
+
+    with stats.timer("fetch"):
+        fetched = fetch.fetch_consensus(urls, datetime.datetime.utcnow() - fetch.MAX_CONSENSUS_AGE,
+                                        if_modified_since, timeout, retries)
+    if not fetched:
+        return False
+
+    url, _, consensus_str = fetched
+    stats.count("consensus_bytes_fetched", len(consensus_str))
+
+    consensus_parser = consensus.ConsensusParser(fast=fast)
+    with stats.timer("parse"):
+        record = consensus_parser.parse_consensus_string(consensus_str, url)
+    if not record:
+        raise fetch.FetchError("Can't parse the consensus from %s" % url)
+
+    stats.count("consensuses_parsed")
+    valid_after, guard_fprs = record
+    return consensus_parser.import_guards(valid_after, guard_fprs, db_cursor)
+
+def verify_consensuses_in_db(db_cursor, consensus_path, verify_n, fast=False, consensus_hours=None):
+    """
+    Parse up to 'verify_n' of the consensuses at 'consensus_path' (a
+    directory or a tarball) that the database at 'db_cursor' already
+    has, and check that the database has the same guards for them.
+    If 'consensus_hours' is set, only check the consensuses of those
+    hours.
+
+    Return a (number of consensuses checked, list of the valid-after
+    dates of the ones that didn't match) tuple.
+    """
+    if os.path.isdir(consensus_path):
+        consensus_items = [os.path.join(consensus_path, filename)
+                           for filename in sorted(os.listdir(consensus_path))]
+        consensus_items = [f for f in consensus_items if os.path.isfile(f)]
+        sniff_func, parse_func = consensus.sniff_consensus_file, consensus.parse_consensus_file
+    else:
+        consensus_items = iter_tarball_members(consensus_path)
+        sniff_func, parse_func = consensus.sniff_consensus_member, consensus.parse_consensus_member
+
+    imported_hours = sqlite_db.get_consensus_hours(db_cursor)
+    if consensus_hours is not None:
+        imported_hours &= set(consensus_hours)
+    checked_n = 0
+    mismatched = []
+
+    for item in consensus_items:
+        if checked_n >= verify_n:
+            break
+
+        valid_after = sniff_func(item)
+        if valid_after is None or sqlite_db.datetime_to_hour(valid_after) not in imported_hours:
+            continue
+
+        record = parse_func(item, fast=fast)
+        if not record:
+            continue
+
+        valid_after, guard_fprs = record
+        checked_n += 1
+        if sqlite_db.get_consensus_guards(db_cursor, sqlite_db.datetime_to_hour(valid_after)) != set(guard_fprs):
+            mismatched.append(valid_after)
+
+    return checked_n, mismatched
+
+def import_verified_snapshot(db_conn, db_cursor, snapshot_fname, consensus_path, verify_n, fast=False):
+    """
+    Bulk load the snapshot at 'snapshot_fname' to the database at
+    'db_cursor', and check up to 'verify_n' of the consensuses that it
+    brought against the ones at 'consensus_path'. Commit the snapshot
+    only if they all match, and roll it back otherwise.
+
+    Return a (number of consensuses loaded, number of consensuses
+    checked, list of the valid-after dates of the ones that didn't
+    match) tuple. Nothing was loaded if that list is not empty.
+
+    Might raise snapshot.SnapshotError or IOError.
+    """
+    loaded_hours = snapshot.load_snapshot(db_conn, db_cursor, snapshot_fname)
+    if not loaded_hours:
+        return 0, 0, []
+
+    checked_n, mismatched = 0, []
+    try:
+        if consensus_path and verify_n > 0:
+            with stats.timer("snapshot_verify"):
+                checked_n, mismatched = verify_consensuses_in_db(db_cursor, consensus_path, verify_n, fast,
+                                                                 loaded_hours)
+    except Exception:
+        db_conn.rollback()
+        raise
+
+    if mismatched:
+        db_conn.rollback()
+        return 0, checked_n, mismatched
+
+    snapshot.commit_snapshot(db_conn, db_cursor)
+    return len(loaded_hours), checked_n, mismatched
+
 def parse_cmd_args():
     parser = argparse.ArgumentParser("databaser.py",
                                       formatter_class = argparse.ArgumentDefaultsHelpFormatter)
 
-    parser.add_argument("consensus_dir", type=str,
-                        help="Path to the consensus files directory.")
+    parser.add_argument("consensus_path", type=str, nargs="?", default=None,
+                        help="Path to the consensus files directory, or to a (compressed) tarball of consensuses. "
+                        "Can be left out when only exporting or importing a snapshot.")
     parser.add_argument("--db-file", type=str, default=SQLITE_DB_FILE,
                         help="Path to where the database file should be created .")
     parser.add_argument("--schema-file", type=str, default=SQLITE_DB_SCHEMA,
@@ -64,6 +389,39 @@ def parse_cmd_args():
                         help="Delete consensus files after importing them to the database.")
     parser.add_argument("--first-time", action="store_true", default=False,
                         help="First time running this script: initialize database, etc..")
+    parser.add_argument("--commit-every", type=int, default=None,
+                        help="Commit the database every N imported consensuses (default: once at the end).")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes to parse consensuses with.")
+    parser.add_argument("--fast-parse", action="store_true", default=False,
+                        help="Only extract guard flags from consensuses instead of fully parsing them with stem.")
+    parser.add_argument("--window-days", type=int, default=DEFAULT_WINDOW_DAYS,
+                        help="Keep running guard counters for the past N days, for guardfraction.py to read (0 to disable).")
+    parser.add_argument("--decay-half-life-days", type=int, default=0,
+                        help="Keep exponentially decayed guard scores with this half-life, "
+                        "for guardfraction.py --decayed to read (0 to leave them as they are).")
+    parser.add_argument("--db-profile", type=str, default="import",
+                        choices=sorted(sqlite_db.CONNECTION_PROFILES),
+                        help="Database connection profile.")
+    parser.add_argument("--fetch-from", type=str, action="append", default=[],
+                        help="Fetch the latest consensus from this URL and import it without touching the disk. "
+                        "Give it several times to race several sources.")
+    parser.add_argument("--fetch-timeout", type=float, default=fetch.DEFAULT_TIMEOUT,
+                        help="Seconds to wait for each attempt to fetch a consensus.")
+    parser.add_argument("--fetch-retries", type=int, default=fetch.DEFAULT_RETRIES,
+                        help="Number of times to retry each source that fails to give us a fresh consensus.")
+    parser.add_argument("--export-snapshot", type=str, default=None,
+                        help="After importing, write the guard history of the database to this snapshot file.")
+    parser.add_argument("--import-snapshot", type=str, default=None,
+                        help="Before importing, bulk load the guard history of this snapshot file. "
+                        "Some of the consensuses at consensus_path that are in the snapshot get parsed "
+                        "and checked against it.")
+    parser.add_argument("--snapshot-verify-n", type=int, default=DEFAULT_SNAPSHOT_VERIFY_N,
+                        help="Number of consensuses to check an imported snapshot against.")
+    parser.add_argument("--stats-file", type=str, default=None,
+                        help="Append a JSON line with the timers and counters of this run to this file.")
+    parser.add_argument("--profile", type=str, default=None,
+                        help="Run under cProfile and dump the profile to this file.")
 
     return parser.parse_args()
 
@@ -76,17 +434,39 @@ def main():
     # Parse CLI
     args = parse_cmd_args()
 
-    # Make sure a directory was provided.
-    if not os.path.isdir(args.consensus_dir):
-        logging.error("%s is not a directory!", args.consensus_dir)
+    stats.run_instrumented("databaser", run_databaser, args, args.stats_file, args.profile)
+
+def run_databaser(args):
+    """Import the consensuses of the parsed command line 'args'."""
+
+    # Make sure a directory or a tarball was provided, unless we are
+    # fetching consensuses or only moving snapshots around.
+    if args.consensus_path is None:
+        if not args.fetch_from and not args.export_snapshot and not args.import_snapshot:
+            logging.error("No consensus_path given!")
+            sys.exit(2)
+    elif not os.path.isdir(args.consensus_path) and not is_tarball(args.consensus_path):
+        logging.error("%s is neither a directory nor a tarball!", args.consensus_path)
         sys.exit(2)
 
     # Unwrap CLI arguments
     db_file = args.db_file
     schema_file = args.schema_file
-    consensus_dir = args.consensus_dir
+    consensus_path = args.consensus_path
     delete_imported = args.delete_imported
     first_time = args.first_time
+    commit_every = args.commit_every
+    jobs = args.jobs
+    fast_parse = args.fast_parse
+    window_days = args.window_days
+    decay_half_life_days = args.decay_half_life_days
+    db_profile = args.db_profile
+    export_snapshot = args.export_snapshot
+    import_snapshot = args.import_snapshot
+    snapshot_verify_n = args.snapshot_verify_n
+    fetch_from = args.fetch_from
+    fetch_timeout = args.fetch_timeout
+    fetch_retries = args.fetch_retries
 
     # If there is no database file, assume that this is our first time
     # getting run.
@@ -95,17 +475,75 @@ def main():
 
     # Initialize sqlite3 database.
     db_conn, db_cursor = sqlite_db.init_db(db_file,
-                                           schema_file if first_time else None)
+                                           schema_file if first_time else None,
+                                           db_profile)
+
+    # Bulk load the snapshot, and spot check it against the consensuses
+    # we were given before we import the rest of them.
+    if import_snapshot:
+        try:
+            loaded_n, checked_n, mismatched = import_verified_snapshot(db_conn, db_cursor, import_snapshot,
+                                                                       consensus_path, snapshot_verify_n,
+                                                                       fast_parse)
+        except (snapshot.SnapshotError, IOError), err:
+            logging.error("Could not import snapshot %s: %s", import_snapshot, err)
+            sys.exit(2)
+
+        if mismatched:
+            logging.error("Snapshot %s disagrees with the consensuses from %s! Not importing it.",
+                          import_snapshot, ", ".join(str(valid_after) for valid_after in mismatched))
+            sys.exit(1)
+        if loaded_n:
+            logging.info("Checked snapshot %s against %d consensuses.", import_snapshot, checked_n)
 
     # Parse all consensus files
-    import_consensus_dir_to_db(db_cursor, consensus_dir, delete_imported)
+    if consensus_path and os.path.isdir(consensus_path):
+        import_consensus_dir_to_db(db_cursor, consensus_path, delete_imported, commit_every, jobs,
+                                   fast_parse)
+    elif consensus_path:
+        import_consensus_tarball_to_db(db_cursor, consensus_path, delete_imported, commit_every, jobs,
+                                       fast_parse)
+
+    # Fetch the latest consensus and import it. If that fails, still
+    # keep everything else up to date before reporting it.
+    fetch_failed = False
+    if fetch_from:
+        try:
+            if not import_fetched_consensus(db_cursor, fetch_from, fetch_timeout, fetch_retries, fast_parse):
+                logging.info("No new consensus to fetch.")
+        except fetch.FetchError, err:
+            logging.error("%s", err)
+            fetch_failed = True
+
+    # Commit database changes.
+    with stats.timer("commit"):
+        db_conn.commit()
+
+    # Move the running guard counters to the current window, so that
+    # guardfraction.py only has to read them.
+    if window_days > 0:
+        with stats.timer("guard_counts_update"):
+            window_start = sqlite_db.get_window_start(db_cursor, window_days)
+            sqlite_db.update_guard_counts(db_conn, db_cursor, window_days, window_start)
+
+    # Start keeping decayed guard scores, or switch to a new half-life.
+    # From then on, the importer keeps them up to date.
+    if decay_half_life_days > 0:
+        with stats.timer("guard_decay_update"):
+            sqlite_db.update_guard_decay(db_conn, db_cursor, decay_half_life_days)
+
+    if export_snapshot:
+        with stats.timer("snapshot_export"):
+            snapshot.export_snapshot(db_conn, db_cursor, export_snapshot)
 
     logging.info("Done! Wrote database file at %s.", db_file)
 
-    # Commit database changes and close the file. We are done!
-    db_conn.commit()
+    # Close the file. We are done!
     db_conn.close()
 
+    if fetch_failed:
+        sys.exit(1)
+
 if __name__ == '__main__':
     try:
         main()
@@ -1,20 +1,88 @@
+-- Hand the pages of dropped guardset partitions back to the
+-- filesystem on 'PRAGMA incremental_vacuum'. Must come before any table.
+PRAGMA auto_vacuum = INCREMENTAL;
+
+
+-- identity is the 20 byte identity digest of the relay (see
+-- sqlite_db.pack_identity()).
 CREATE TABLE relay (
   relay_id INTEGER PRIMARY KEY AUTOINCREMENT,
   identity BLOB NOT NULL,
   UNIQUE(identity)
 );
 
+-- consensus_hour is the valid-after time of the consensus, in hours
+-- since the epoch (see sqlite_db.datetime_to_hour()). All the other
+-- hours of the database are counted the same way.
 CREATE TABLE consensus (
   consensus_id INTEGER PRIMARY KEY AUTOINCREMENT,
-  consensus_date DATETIME NOT NULL,
-   UNIQUE(consensus_date)
+  consensus_hour INTEGER NOT NULL,
+   UNIQUE(consensus_hour)
+);
+
+-- The guards of each consensus, as a packed list of their relay_ids
+-- (see sqlite_db.pack_relay_ids()), live in one guardset_YYYY_MM
+-- table per month of consensuses. This table lists them, along with
+-- the consensus hours they cover (start_hour <= hour < end_hour).
+-- Expired months get dropped as a whole (see
+-- sqlite_db.drop_expired_consensuses()).
+CREATE TABLE guardset_partition (
+  name TEXT PRIMARY KEY,
+  start_hour INTEGER NOT NULL,
+  end_hour INTEGER NOT NULL
+);
+
+-- How many times each relay has been a guard in the consensuses of
+-- the window described by guard_count_window. Kept up to date by the
+-- importer and by guardfraction.py when the window moves.
+CREATE TABLE guard_count (
+  relay_id INTEGER PRIMARY KEY REFERENCES relay(relay_id),
+  times_seen INTEGER NOT NULL
+);
+
+-- The window of consensuses counted in guard_count. At most one row.
+CREATE TABLE guard_count_window (
+  max_days INTEGER NOT NULL,
+  window_start INTEGER NOT NULL
+);
+
+-- Exponentially decayed number of consensuses that each relay has been
+-- a guard in, as of guard_decay_state.last_hour. Only kept if
+-- guard_decay_state has a row. Kept up to date by the importer.
+CREATE TABLE guard_decay (
+  relay_id INTEGER PRIMARY KEY REFERENCES relay(relay_id),
+  score REAL NOT NULL
 );
 
-CREATE TABLE guarddata (
-  relay_id INTEGER REFERENCES relay(relay_id) ON DELETE CASCADE NOT NULL,
-  consensus_id INTEGER REFERENCES consensus(consensus_id) ON DELETE CASCADE NOT NULL
+-- The half-life of the scores in guard_decay, the decayed number of
+-- consensuses and the hour of the newest one. At most one row.
+CREATE TABLE guard_decay_state (
+  half_life_days INTEGER NOT NULL,
+  total REAL NOT NULL,
+  last_hour INTEGER
 );
 
-CREATE INDEX consensus_consensus_date_idx ON consensus(consensus_date);
-CREATE INDEX guarddata_relay_id_idx ON guarddata(relay_id);
-CREATE INDEX guarddata_consensus_id_idx ON guarddata(consensus_id);
+-- The runs of consecutive consensuses that each relay was a guard in:
+-- relay_id was a guard in all the consensuses from start_hour up to
+-- (not including) end_hour, and in neither of the ones around them.
+-- Missing consensuses end a run. The runs that reach the newest
+-- consensus are left open, with an end_hour of 1 << 62, so that
+-- importing the next consensus only touches the guards that gained or
+-- lost the flag in between. Kept up to date by the importer (see
+-- sqlite_db.extend_guard_intervals()), so that the history of a guard
+-- is a lookup away (see guardiness/history.py).
+CREATE TABLE guard_interval (
+  relay_id INTEGER NOT NULL REFERENCES relay(relay_id),
+  start_hour INTEGER NOT NULL,
+  end_hour INTEGER NOT NULL,
+  PRIMARY KEY (relay_id, start_hour)
+);
+
+CREATE INDEX guard_interval_end_hour_idx ON guard_interval(end_hour);
+CREATE INDEX guard_interval_start_hour_idx ON guard_interval(start_hour);
+
+-- No separate index on consensus(consensus_hour): the index behind
+-- UNIQUE(consensus_hour) already maps hours to consensus_ids and serves
+-- the window queries of guardfraction.py.
+
+PRAGMA user_version = 9;
@@ -11,39 +11,65 @@ import argparse
 import sys
 import os
 import datetime
+import json
 
 import guardiness.sqlite_db as sqlite_db
 import guardiness.guard_ds as guard_ds
+import guardiness.collector as collector
+import guardiness.history as history
+import guardiness.replay as replay
+import guardiness.stats as stats
 
 # XXX put it in const file
 SQLITE_DB_FILE = "./guardfraction.db"
 DEFAULT_OUTPUT_FNAME = "./guardfraction.output"
+DEFAULT_REPLAY_FNAME = "./guardfraction.replay"
+# Where a single --as-of goes, so that a look into the past never
+# replaces the output file that tor reads.
+DEFAULT_AS_OF_FNAME = "./guardfraction.as-of"
+# Where the output file of each extra window goes, given the main
+# output file and the number of days of the window.
+WINDOW_OUTPUT_FORMAT = "%s.%ddays"
 
 class DesynchronizedClock(Exception): pass
 
-def read_db_file(db_conn, db_cursor, max_days, delete_expired=False):
+def read_db_file(db_conn, db_cursor, max_days, delete_expired=False, as_of=None):
     """
     Read database file with 'db_cursor' and register all guards active
     in the past 'max_days'.
 
-    Return the Guards object that kept track of the guards, and the
-    number of consensuses parsed.
+    If 'as_of' is set, register the guards that were active in the
+    'max_days' before that UTC datetime instead, like guardfraction
+    would have if it had been run back then. The running guard
+    counters only count the present, so the window gets counted from
+    the guard intervals.
+
+    Return the guards, and the number of consensuses parsed. The
+    guards are streamed out of the database as they are read, so
+    'db_conn' has to stay open until the caller is done with them.
     """
     # Keeps track of the guards we've seen.
     guards = guard_ds.Guards()
 
-    # The months argument to datetime() so that we filter old consensuses.
-    date_sql_parameter = "-%s days" % max_days
+    # The start of our window, so that we filter old consensuses.
+    window_start = sqlite_db.get_window_start(db_cursor, max_days, as_of)
 
     # If the user wants, remove old consensus measurements from the database.
     if delete_expired:
-        db_cursor.execute("DELETE FROM consensus WHERE consensus_date < (datetime('now', ?))", (date_sql_parameter,))
-        db_conn.commit()
+        # Catch the running guard counters up with our window first,
+        # or they would never forget about the deleted consensuses.
+        with stats.timer("expire"):
+            sqlite_db.update_guard_counts(db_conn, db_cursor, max_days, window_start)
+            sqlite_db.drop_expired_consensuses(db_conn, window_start)
 
     # Now we are ready to scrap the database!
     # First, get number of consensus documents read:
-    db_cursor.execute("SELECT count(*) FROM consensus WHERE consensus.consensus_date >= (datetime('now', ?))", (date_sql_parameter,))
-    consensuses_read_n = int(db_cursor.fetchone()[0])
+    if as_of:
+        _, window_end = replay.get_window_bounds(db_cursor, max_days, as_of)
+        consensuses_read_n = sqlite_db.count_range_consensuses(db_cursor, window_start, window_end)
+    else:
+        db_cursor.execute(sqlite_db.WINDOW_CONSENSUS_COUNT_SQL, (window_start,))
+        consensuses_read_n = int(db_cursor.fetchone()[0])
 
     logging.info("Read db file with %d consensuses info", consensuses_read_n)
     # Check that there is at least a single consensus.  Not having any
@@ -54,53 +80,239 @@ def read_db_file(db_conn, db_cursor, max_days, delete_expired=False):
         return guards, 0
 
     # Get list of guards and their guardfraction
-    db_cursor.execute("SELECT (SELECT identity FROM relay WHERE relay_id=guarddata.relay_id), count(*) FROM guarddata,consensus "
-                      "WHERE consensus.consensus_date >= datetime('now', ?) AND consensus.consensus_id = guarddata.consensus_id GROUP BY relay_id;",
-                      (date_sql_parameter,))
-    guardfraction_list = db_cursor.fetchall()
+    if as_of:
+        guards = guard_ds.StreamedGuards(lambda: stats.timed_iter(
+            "aggregate", sqlite_db.iter_interval_guards(db_conn, db_cursor, window_start, window_end)))
+    else:
+        guards = guard_ds.StreamedGuards(lambda: stats.timed_iter(
+            "aggregate", sqlite_db.iter_guard_counts(db_conn, db_cursor, max_days, window_start)))
 
-    for guard_fpr, times_seen in guardfraction_list:
-        guards.register_guard(guard_fpr, times_seen)
-        logging.debug("Registered %s seen %d times", guard_fpr, times_seen)
+    return guards, consensuses_read_n
 
-    # Done. Close database and get out of here.
-    db_conn.close()
+def read_db_file_windows(db_conn, db_cursor, max_days, windows, delete_expired=False):
+    """
+    Like read_db_file(), but register the guards active in each of
+    several windows of past days. All the windows are counted in one
+    pass over the guard intervals of the largest one (see
+    sqlite_db.count_interval_windows()).
+
+    'windows' is a list of window sizes in days. If 'delete_expired'
+    is set, only the consensuses older than the largest window are
+    deleted, and the running guard counters are moved to 'max_days'
+    like in read_db_file().
+
+    Return a dictionary mapping <window size> to a (guards, number of
+    consensuses parsed) tuple. Like in read_db_file(), the guards are
+    streamed out of the database as they are read.
+    """
+    window_starts = [sqlite_db.get_window_start(db_cursor, days) for days in windows]
 
-    return guards, consensuses_read_n
+    # If the user wants, remove old consensus measurements from the database.
+    if delete_expired:
+        with stats.timer("expire"):
+            sqlite_db.update_guard_counts(db_conn, db_cursor, max_days,
+                                          sqlite_db.get_window_start(db_cursor, max_days))
+            sqlite_db.drop_expired_consensuses(db_conn, min(window_starts))
 
-def find_missing_hours_from_list(date_list):
-    """Given a list of datetimes, find which hours are missing."""
-    hours_gap = (date_list[-1]-date_list[0]).total_seconds()/(60*60)
+    with stats.timer("aggregate"):
+        sqlite_db.count_interval_windows(db_conn, db_cursor, window_starts)
 
-    all_hours_set = set(date_list[0]+ datetime.timedelta(hours=x) for x in range(int(hours_gap)))
+    windows_guards = {}
+    for window_i, (days, window_start) in enumerate(zip(windows, window_starts)):
+        db_cursor.execute(sqlite_db.WINDOW_CONSENSUS_COUNT_SQL, (window_start,))
+        consensuses_read_n = int(db_cursor.fetchone()[0])
+        logging.info("Read %d consensuses for the past %d days", consensuses_read_n, days)
 
-    missing = sorted(all_hours_set - set(date_list))
+        guards = guard_ds.Guards()
+        if consensuses_read_n == 0:
+            logging.warning("No consensus measurements for the past %d days in the database.", days)
+        else:
+            # Bind this window now, not when the guards get read.
+            guards = guard_ds.StreamedGuards(lambda window_i=window_i: stats.timed_iter(
+                "aggregate", sqlite_db.iter_window_count_guards(db_conn, window_i)))
 
-    return missing
+        windows_guards[days] = (guards, consensuses_read_n)
 
+    return windows_guards
 
-def print_missing_consensuses(db_conn, db_cursor, max_days):
-    # The days argument to datetime() so that we filter old consensuses.
-    date_sql_parameter = "-%s days" % max_days
+def read_db_file_decayed(db_conn, db_cursor, max_days, delete_expired=False):
+    """
+    Read the exponentially decayed guard scores that databaser.py
+    keeps when run with --decay-half-life-days, and register all the
+    guards that have a score. 'max_days' and 'delete_expired' are
+    only used to delete old consensuses like in read_db_file(); the
+    scores don't need them.
+
+    Scores are rounded to whole consensuses so that they fit in the
+    output file, so the guardfraction of a guard is its decayed number
+    of appearances over the decayed number of consensuses.
+
+    Return the guards, streamed out of the database like in
+    read_db_file(), the decayed number of consensuses, and the decayed
+    number of consensuses that an unbroken history would add up to.
+    Return None if the database keeps no decayed scores.
+    """
+    # If the user wants, remove old consensus measurements from the database.
+    if delete_expired:
+        with stats.timer("expire"):
+            window_start = sqlite_db.get_window_start(db_cursor, max_days)
+            sqlite_db.update_guard_counts(db_conn, db_cursor, max_days, window_start)
+            sqlite_db.drop_expired_consensuses(db_conn, window_start)
+
+    db_cursor.execute("SELECT half_life_days, total FROM guard_decay_state")
+    row = db_cursor.fetchone()
+    if not row:
+        return None
+
+    half_life_days, total = row
+    consensuses_read_n = int(round(total))
+    ideal_consensuses_n = int(round(sqlite_db.get_decay_ideal_total(half_life_days)))
+    logging.info("Read decayed scores worth %d consensuses", consensuses_read_n)
 
-    db_cursor.execute("SELECT consensus.consensus_date FROM consensus WHERE consensus.consensus_date >= (datetime('now', ?))", (date_sql_parameter,))
-    sql_date_list = db_cursor.fetchall()
+    guards = guard_ds.Guards()
+    if consensuses_read_n == 0:
+        logging.warning("No consensus measurements at all in the database.")
+    else:
+        guards = guard_ds.StreamedGuards(lambda: stats.timed_iter(
+            "aggregate", ((identity, int(round(score))) for identity, score in sqlite_db.iter_guard_decay(db_conn))))
+
+    return guards, consensuses_read_n, ideal_consensuses_n
+
+def find_missing_ranges(db_cursor, max_days, now=None):
+    """
+    Find the hours of the past 'max_days' that we have no consensus
+    for, up to the current hour. 'now' is the current UTC datetime, if
+    it's not utcnow().
+
+    Return a list of (first missing hour, last missing hour) datetime
+    tuples, oldest first.
+    """
 
-    # Get all the dates in a list
-    consensus_date_list = []
-    for date in sql_date_list:
-        date_datetime = datetime.datetime.strptime(date[0], "%Y-%m-%d %H:%M:%S")
-        consensus_date_list.append(date_datetime)
-    logging.debug("These are all the dates we have: %s", str(consensus_date_list))
+    # The first and last hours that we should have consensuses for.
+    if now is None:
+        now = datetime.datetime.utcnow()
+    first_hour = sqlite_db.get_window_start(db_cursor, max_days, now)
+    last_hour = sqlite_db.datetime_to_hour(now)
 
-    # Find the missing hours and print them.
-    missing_list = find_missing_hours_from_list(consensus_date_list)
+    missing_ranges = []
+
+    db_cursor.execute(sqlite_db.WINDOW_EDGES_SQL, (first_hour,))
+    first_consensus_hour, last_consensus_hour = db_cursor.fetchone()
+    if first_consensus_hour is None:
+        if first_hour <= last_hour:
+            missing_ranges.append((first_hour, last_hour))
+    else:
+        if first_consensus_hour > first_hour:
+            missing_ranges.append((first_hour, first_consensus_hour - 1))
+
+        # Let sqlite find the gaps between the consensuses we have, so
+        # that we only look at their edges.
+        for consensus_hour, next_hour in sqlite_db.get_window_gaps(db_cursor, first_hour):
+            missing_ranges.append((consensus_hour + 1, next_hour - 1))
+
+        if last_consensus_hour < last_hour:
+            missing_ranges.append((last_consensus_hour + 1, last_hour))
+
+    return [(sqlite_db.hour_to_datetime(first_missing), sqlite_db.hour_to_datetime(last_missing))
+            for first_missing, last_missing in missing_ranges]
+
+def print_missing_consensuses(db_conn, db_cursor, max_days):
+    """Print the ranges of hours of the past 'max_days' that we have no consensus for."""
+
+    missing_ranges = find_missing_ranges(db_cursor, max_days)
+    logging.debug("These are the ranges we miss: %s", str(missing_ranges))
 
     print "Here is a list of the missing consensuses:"
-    for missing in missing_list:
-        print "%s" % missing
+    for first_missing, last_missing in missing_ranges:
+        if first_missing == last_missing:
+            print "%s" % first_missing
+        else:
+            hours_n = int((last_missing - first_missing).total_seconds() // (60*60)) + 1
+            print "%s - %s (%d hours)" % (first_missing, last_missing, hours_n)
+
+def write_backfill_plan(db_conn, db_cursor, max_days, plan_fname):
+    """
+    Write a JSON plan for fetching the consensuses that we miss from
+    the past 'max_days' out of the CollecTor archives, to 'plan_fname'
+    (or to stdout if it's '-').
+    """
+
+    missing_ranges = find_missing_ranges(db_cursor, max_days)
+    plan_str = json.dumps(collector.make_backfill_plan(missing_ranges), indent=2, sort_keys=True)
+
+    if plan_fname == "-":
+        print plan_str
+    else:
+        with open(plan_fname, "w") as plan_fd:
+            plan_fd.write(plan_str + "\n")
+
+def print_guard_history(db_conn, db_cursor, max_days, fingerprints):
+    """
+    Print a JSON report of when the relays with 'fingerprints' were
+    guards in the past 'max_days', and of their daily guardfraction.
+    """
+    start_hour = sqlite_db.get_window_start(db_cursor, max_days)
+    end_hour = sqlite_db.datetime_to_hour(datetime.datetime.utcnow()) + 1
+
+    guard_intervals = history.get_guard_intervals(db_cursor, fingerprints, start_hour, end_hour)
+    daily_guardfraction = history.get_daily_guardfraction(db_cursor, fingerprints, start_hour, end_hour)
+
+    report = {
+        "window" : [str(sqlite_db.hour_to_datetime(start_hour)), str(sqlite_db.hour_to_datetime(end_hour - 1))],
+        "guards" : dict((fingerprint, {
+            "intervals" : [[str(first_hour), str(last_hour)]
+                           for first_hour, last_hour in guard_intervals[fingerprint]],
+            "daily_guardfraction" : [[str(day), round(guardfraction, 4)]
+                                     for day, guardfraction in daily_guardfraction[fingerprint]],
+        }) for fingerprint in fingerprints),
+    }
+
+    print json.dumps(report, indent=2, sort_keys=True)
+
+def parse_fingerprints(fingerprints_str):
+    """Parse a comma-separated list of relay fingerprints."""
+    fingerprints = [fingerprint.strip().lstrip("$").upper()
+                    for fingerprint in fingerprints_str.split(",") if fingerprint.strip()]
+    for fingerprint in fingerprints:
+        if len(fingerprint) != 40 or fingerprint.strip("0123456789ABCDEF"):
+            raise argparse.ArgumentTypeError("'%s' is not a relay fingerprint" % fingerprint)
+
+    return fingerprints
+
+AS_OF_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]
+
+def parse_as_of(as_of_str):
+    """
+    Parse a UTC date and time, or a comma-separated range of two of
+    them. Return a (first, last) tuple of datetimes; 'last' is None if
+    there is no range.
+    """
+    as_of_dates = []
+    for date_str in as_of_str.split(","):
+        for date_format in AS_OF_FORMATS:
+            try:
+                as_of_dates.append(datetime.datetime.strptime(date_str.strip(), date_format))
+                break
+            except ValueError:
+                continue
+        else:
+            raise argparse.ArgumentTypeError("'%s' is not a 'YYYY-MM-DD[ HH:MM[:SS]]' date" % date_str)
+
+    if len(as_of_dates) == 1:
+        return as_of_dates[0], None
+    if len(as_of_dates) != 2 or as_of_dates[0] > as_of_dates[1]:
+        raise argparse.ArgumentTypeError("'%s' is not a 'first,last' range of dates" % as_of_str)
+
+    return as_of_dates[0], as_of_dates[1]
+
+def parse_windows(windows_str):
+    """Parse a comma-separated list of window sizes in days."""
+    try:
+        return [int(days) for days in windows_str.split(",") if days.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError("'%s' is not a comma-separated list of days" % windows_str)
 
-def parse_cmd_args():
+def parse_cmd_args(argv=None):
     parser = argparse.ArgumentParser("guardfraction.py",
                                       formatter_class = argparse.ArgumentDefaultsHelpFormatter)
 
@@ -110,12 +322,43 @@ def parse_cmd_args():
                         help="Path to the guard database file.")
     parser.add_argument("--delete-expired", action="store_true", default=False,
                         help="Delete expired database records based on max_days.")
-    parser.add_argument("-o", "--output", type=str, default=DEFAULT_OUTPUT_FNAME,
-                        help="Path to place the guardfraction output file.")
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="Path to place the guardfraction output file (default: '%s', or '%s' with a "
+                        "single --as-of date)." % (DEFAULT_OUTPUT_FNAME, DEFAULT_AS_OF_FNAME))
     parser.add_argument("-m", "--list-missing", action="store_true", default=False,
                         help="List any missing consensuses from the db and exit.")
-
-    return parser.parse_args()
+    parser.add_argument("--backfill-plan", type=str, default=None,
+                        help="Write a JSON plan for fetching the missing consensuses from CollecTor "
+                        "to this file ('-' for stdout) and exit.")
+    parser.add_argument("--history", type=parse_fingerprints, default=None,
+                        help="Print a JSON report of when the relays with these comma-separated fingerprints "
+                        "were guards in the past max_days, and of their daily guardfraction, and exit.")
+    parser.add_argument("--windows", type=parse_windows, default=[],
+                        help="Comma-separated list of extra windows in days (e.g. 30,180) to calculate "
+                        "guardfraction for in the same run. Each one is written next to the output file, "
+                        "with '.<days>days' appended to its name.")
+    parser.add_argument("--decayed", action="store_true", default=False,
+                        help="Output the exponentially decayed guardfraction that databaser.py keeps "
+                        "with --decay-half-life-days, instead of the one over the past max_days.")
+    parser.add_argument("--as-of", type=parse_as_of, default=None,
+                        help="Write the guardfraction as it would have been at this UTC date and time "
+                        "('YYYY-MM-DD[ HH:MM[:SS]]'). Given a comma-separated 'first,last' range, replay "
+                        "the guardfraction of every step of the range to --replay-output instead.")
+    parser.add_argument("--step-hours", type=int, default=1,
+                        help="Hours between the steps of an --as-of range.")
+    parser.add_argument("--replay-output", type=str, default=DEFAULT_REPLAY_FNAME,
+                        help="Path to place the replay file of an --as-of range ('.gz' to compress it).")
+    parser.add_argument("--replay-diffs", action="store_true", default=False,
+                        help="Only write the guards that changed since the previous step to the replay file.")
+    parser.add_argument("--db-profile", type=str, default=None,
+                        choices=sorted(sqlite_db.CONNECTION_PROFILES),
+                        help="Database connection profile (default: 'aggregate', or 'import' with --delete-expired).")
+    parser.add_argument("--stats-file", type=str, default=None,
+                        help="Append a JSON line with the timers and counters of this run to this file.")
+    parser.add_argument("--profile", type=str, default=None,
+                        help="Run under cProfile and dump the profile to this file.")
+
+    return parser.parse_args(argv)
 
 def check_clock_correctness(db_cursor):
     """
@@ -125,9 +368,8 @@ def check_clock_correctness(db_cursor):
 
     # Get the latest consensus from the database and make sure it
     # happened in the past.
-    db_cursor.execute("SELECT max(consensus_date) FROM consensus")
-    latest_date_in_db = db_cursor.fetchone()[0]
-    latest_date_in_db = datetime.datetime.strptime(latest_date_in_db, "%Y-%m-%d %H:%M:%S")
+    db_cursor.execute("SELECT max(consensus_hour) FROM consensus")
+    latest_date_in_db = sqlite_db.hour_to_datetime(db_cursor.fetchone()[0])
 
     if datetime.datetime.utcnow() < latest_date_in_db:
         raise DesynchronizedClock("Current time is in the past (%s compared to %s)" %
@@ -144,26 +386,73 @@ def main():
     # Parse CLI
     args = parse_cmd_args()
 
-    output_file = args.output
+    stats.run_instrumented("guardfraction", run_guardfraction, args, args.stats_file, args.profile)
+
+def run_guardfraction(args):
+    """Output guardfraction data according to the parsed command line 'args'."""
+
     max_days = args.max_days
     db_file = args.db_file
     delete_expired = args.delete_expired
     list_missing = args.list_missing
+    backfill_plan = args.backfill_plan
+    guard_history = args.history
+    db_profile = args.db_profile
+    windows = args.windows
+    decayed = args.decayed
+    as_of = args.as_of
+    step_hours = args.step_hours
+    replay_output = args.replay_output
+    replay_diffs = args.replay_diffs
+    output_file = args.output or (DEFAULT_AS_OF_FNAME if as_of else DEFAULT_OUTPUT_FNAME)
+
+    # Deleting expired consensuses needs a connection that can write.
+    if not db_profile:
+        db_profile = "import" if delete_expired else "aggregate"
 
     # Make sure that max_days is a positive integer but not too
     # positive. The maximum value is currently set to 5 years.
-    if max_days <= 0 or max_days > (5*12*30):
-        logging.warning("Bad max_days value (%d)", max_days)
-        sys.exit(2)
+    for days in [max_days] + windows:
+        if days <= 0 or days > (5*12*30):
+            logging.warning("Bad max_days value (%d)", days)
+            sys.exit(2)
 
     # Read database file and calculate guardfraction
-    db_conn, db_cursor = sqlite_db.init_db(db_file)
+    db_conn, db_cursor = sqlite_db.init_db(db_file, profile=db_profile)
 
     # Just print missing consensuses and bail
     if list_missing:
         print_missing_consensuses(db_conn, db_cursor, max_days)
         sys.exit(1)
 
+    # Just plan the backfill of the missing consensuses and bail
+    if backfill_plan:
+        write_backfill_plan(db_conn, db_cursor, max_days, backfill_plan)
+        sys.exit(0)
+
+    # Just report the history of some guards and bail
+    if guard_history:
+        print_guard_history(db_conn, db_cursor, max_days, guard_history)
+        sys.exit(0)
+
+    # The past is read-only, and only has one window.
+    if as_of and (delete_expired or decayed or windows):
+        logging.warning("--as-of doesn't mix with --delete-expired, --decayed or --windows.")
+        sys.exit(2)
+    if step_hours <= 0:
+        logging.warning("Bad --step-hours value (%d)", step_hours)
+        sys.exit(2)
+
+    # Just replay the guardfraction of a stretch of history and bail
+    if as_of and as_of[1]:
+        try:
+            replay.write_replay_file(db_conn, db_cursor, max_days, as_of[0], as_of[1], step_hours,
+                                     replay_output, replay_diffs)
+        except IOError, err:
+            logging.warning("Could not write replay file: %s", err)
+            sys.exit(1)
+        sys.exit(0)
+
     # Make sure that our clock is not horribly desynchronized.
     try:
         check_clock_correctness(db_cursor)
@@ -171,15 +460,60 @@ def main():
         logging.warning("Clock issue (%s). Exiting.", err)
         sys.exit(1)
 
-    guards, consensuses_read_n = read_db_file(db_conn, db_cursor, max_days, delete_expired)
+    # Maps a <window output file> to its <window size in days>.
+    window_output_files = {output_file : max_days}
 
-    # Caclulate guardfraction and write output file.
-    try:
-        guards.write_output_file(output_file, max_days, consensuses_read_n)
-    except IOError, err:
-        logging.warning("Could not write output file: %s", err)
+    if decayed and windows:
+        logging.warning("--decayed and --windows don't mix.")
+        sys.exit(2)
 
-    logging.info("Done! Wrote output file at %s.", output_file)
+    # Maps the <days> of an output file to its <ideal number of
+    # consensuses>, when that isn't one per hour.
+    ideal_consensuses_ns = {}
+
+    if decayed:
+        decayed_guards = read_db_file_decayed(db_conn, db_cursor, max_days, delete_expired)
+        if decayed_guards is None:
+            logging.warning("No decayed guard scores in the database. "
+                            "Run databaser.py with --decay-half-life-days first.")
+            sys.exit(1)
+
+        # n-inputs gets the decayed numbers of consensuses, and the
+        # days of hourly consensuses that the ideal one is worth.
+        guards, consensuses_read_n, ideal_consensuses_n = decayed_guards
+        days = int(round(ideal_consensuses_n / 24.))
+        window_output_files = {output_file : days}
+        windows_guards = {days : (guards, consensuses_read_n)}
+        ideal_consensuses_ns[days] = ideal_consensuses_n
+    elif windows:
+        for days in windows:
+            if days != max_days:
+                window_output_files[WINDOW_OUTPUT_FORMAT % (output_file, days)] = days
+
+        windows_guards = read_db_file_windows(db_conn, db_cursor, max_days,
+                                              sorted(set(window_output_files.values())), delete_expired)
+    else:
+        windows_guards = {max_days : read_db_file(db_conn, db_cursor, max_days, delete_expired,
+                                                  as_of and as_of[0])}
+
+    # Caclulate guardfraction and write output files. The guards are
+    # read out of the database as the files get written.
+    for window_output_file, days in sorted(window_output_files.iteritems()):
+        guards, consensuses_read_n = windows_guards[days]
+        try:
+            with stats.timer("output"):
+                written = guard_ds.write_output_file(window_output_file, days, consensuses_read_n,
+                                                     stats.counted_iter("guards_written", guards),
+                                                     ideal_consensuses_ns.get(days))
+            if written:
+                logging.info("Done! Wrote output file at %s.", window_output_file)
+            else:
+                logging.info("Done! Output file at %s is unchanged.", window_output_file)
+        except (IOError, OSError), err:
+            logging.warning("Could not write output file: %s", err)
+
+    # Done. Close database and get out of here.
+    db_conn.close()
 
 if __name__ == '__main__':
     try:
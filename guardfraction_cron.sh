@@ -20,17 +20,46 @@ STATE_DIR=""
 # Defaults to: $STATE_DIR/guardfraction.output
 GUARDFRACTION_OUTPUT_FILE=""
 
-WGET_PREFIX="" # one option might be "torify"
+WGET_PREFIX="" # one option might be "torify". Also wraps the Python fetcher.
 
 # Where to fetch the consensus from. This should be set in the
 # configuration file. Please set it to something like:
 # CONSENSUS_SOURCE=http://128.31.0.39:9131/tor/status-vote/current/consensus
+# It can be a space-separated list of several directory mirrors, in
+# which case they are all asked at once and the first fresh consensus
+# wins.
 CONSENSUS_SOURCE=""
 
 # How many days of consensuses should we consider? This should be
 # equal to the guard lifetime period. Leave it as is for now.
 DAYS_WORTH=90
 
+# Comma-separated list of extra windows in days (e.g. "30,180") to
+# calculate guardfraction for, in the same pass as DAYS_WORTH. Each one
+# is written next to GUARDFRACTION_OUTPUT_FILE, with ".<days>days"
+# appended to its name.
+EXTRA_WINDOWS=""
+
+# If set, write a JSON plan for fetching the consensuses missing from
+# the past DAYS_WORTH days out of the CollecTor archives to this file,
+# for a backfill job to pick up.
+BACKFILL_PLAN_FILE=""
+
+# If set, databaser.py and guardfraction.py append a JSON line with
+# the timers and counters of their run to this file.
+STATS_FILE=""
+
+# Database connection profiles (see CONNECTION_PROFILES in
+# guardiness/sqlite_db.py) for importing consensuses and for
+# calculating guardfraction.
+IMPORT_DB_PROFILE="import"
+AGGREGATE_DB_PROFILE="aggregate"
+
+# If you run guardfraction_daemon.py, set this to the spool directory
+# it watches. This script will then just drop the downloaded consensus
+# there and leave the rest to the daemon.
+SPOOL_DIR=""
+
 # Set to 1 if you want verbose output.
 VERBOSE=${VERBOSE:-0}
 
@@ -64,37 +93,70 @@ if ! flock -n -e 9; then
         exit 1
 fi
 
-tmpdir=`mktemp -d "/tmp/guardfraction-XXXXXX"`
-trap "rm -rf '$tmpdir'" EXIT
+# Hand the consensus over to the daemon. Copy it under a dotfile name
+# first, so that the daemon never sees half of it.
+if [ -n "$SPOOL_DIR" ]; then
+    tmpdir=`mktemp -d "/tmp/guardfraction-XXXXXX"`
+    trap "rm -rf '$tmpdir'" EXIT
+
+    [ "$VERBOSE" -gt 0 ] &&  echo "[*] About to download consensus"
+
+    # Download latest consensus from the first source that has it.
+    fetched=0
+    for source in $CONSENSUS_SOURCE; do
+        if $WGET_PREFIX wget -q "$source" -O "$tmpdir/consensus"; then
+            fetched=1
+            break
+        fi
+    done
+    if [ "$fetched" -eq 0 ]; then
+        echo >&2 "Failed while getting newest consensus."
+        exit 1
+    fi
 
-[ "$VERBOSE" -gt 0 ] &&  echo "[*] About to download consensus"
+    [ "$VERBOSE" -gt 0 ] &&  echo "[*] Downloaded latest consensus"
 
-# Download latest consensus.
-if ! $WGET_PREFIX wget -q "$CONSENSUS_SOURCE" -O "$tmpdir/consensus"
-then
-    echo >&2 "Failed while getting newest consensus."
-    exit 1
+    spooled="consensus-$(date -u +%Y-%m-%d-%H-%M-%S)"
+    cp "$tmpdir/consensus" "$SPOOL_DIR/.$spooled"
+    mv "$SPOOL_DIR/.$spooled" "$SPOOL_DIR/$spooled"
+    [ "$VERBOSE" -gt 0 ] && echo "[*] Spooled!"
+    exit 0
 fi
 
-[ "$VERBOSE" -gt 0 ] &&  echo "[*] Downloaded latest consensus"
-
 cd "$GUARDFRACTION_SRC"
 
-# Import latest consensus to our database.
+# Fetch the latest consensus from all our sources at once and import
+# it to our database, without touching the disk.
 # (suppress any output because of cron job)
-if ! python databaser.py --db-file="$STATE_DIR/guardfraction.db" "$tmpdir"
+fetch_args=""
+for source in $CONSENSUS_SOURCE; do
+    fetch_args="$fetch_args --fetch-from=$source"
+done
+
+[ "$VERBOSE" -gt 0 ] &&  echo "[*] About to fetch and import consensus"
+
+if ! $WGET_PREFIX python databaser.py --db-file="$STATE_DIR/guardfraction.db" --db-profile="$IMPORT_DB_PROFILE" --window-days="$DAYS_WORTH" ${STATS_FILE:+--stats-file="$STATS_FILE"} $fetch_args
 then
-    echo >&2 "Failed during database import."
+    echo >&2 "Failed during consensus fetch or database import."
     exit 1
 fi
 
 [ "$VERBOSE" -gt 0 ] && echo "[*] Imported!"
 
 # Calculate guardfraction
-if ! python guardfraction.py --db-file="$STATE_DIR/guardfraction.db" --output="$GUARDFRACTION_OUTPUT_FILE" "$DAYS_WORTH"
+if ! python guardfraction.py --db-file="$STATE_DIR/guardfraction.db" --db-profile="$AGGREGATE_DB_PROFILE" --output="$GUARDFRACTION_OUTPUT_FILE" ${EXTRA_WINDOWS:+--windows="$EXTRA_WINDOWS"} ${STATS_FILE:+--stats-file="$STATS_FILE"} "$DAYS_WORTH"
 then
     echo >&2 "Failed during guardfraction calculation."
     exit 1
 fi
 
+# Queue up backfills of the consensuses we missed.
+if [ -n "$BACKFILL_PLAN_FILE" ]; then
+    if ! python guardfraction.py --db-file="$STATE_DIR/guardfraction.db" --db-profile="$AGGREGATE_DB_PROFILE" --backfill-plan="$BACKFILL_PLAN_FILE" "$DAYS_WORTH"
+    then
+        echo >&2 "Failed while planning backfill."
+        exit 1
+    fi
+fi
+
 [ "$VERBOSE" -gt 0 ] && echo "[*] Done!"
@@ -0,0 +1,245 @@
+#!/usr/bin/python
+
+"""
+Long-running alternative to guardfraction_cron.sh: watch a spool
+directory for new consensus files, import them to the guard database
+and rewrite the guardfraction output file as soon as they arrive.
+
+The database connection, the identity->relay_id map and the guard
+counters stay warm in memory between consensuses.
+"""
+
+import logging
+import argparse
+import sys
+import os
+import time
+import collections
+
+import guardiness.consensus as consensus
+import guardiness.sqlite_db as sqlite_db
+import guardiness.guard_ds as guard_ds
+import guardfraction
+
+SQLITE_DB_FILE = "./guardfraction.db"
+SQLITE_DB_SCHEMA = "./db_schema.sql"
+DEFAULT_OUTPUT_FNAME = "./guardfraction.output"
+# Spooled files that we can't parse are moved to this subdirectory of
+# the spool directory, for someone to have a look at.
+FAILED_SUBDIR = "failed"
+
+class GuardfractionDaemon(object):
+    """
+    Imports the consensuses dropped in a spool directory and keeps the
+    guardfraction output file up to date.
+    """
+
+    def __init__(self, db_conn, db_cursor, spool_dir, output_file, max_days, fast=False):
+        """
+        Watch 'spool_dir' for consensuses, import them to the database
+        at 'db_conn' and write the guardfraction of the past 'max_days'
+        to 'output_file'.
+
+        If 'fast' is set, parse consensuses with our own line-based
+        parser instead of stem.
+        """
+        self.db_conn = db_conn
+        self.db_cursor = db_cursor
+        self.spool_dir = spool_dir
+        self.output_file = output_file
+        self.max_days = max_days
+
+        # Commit every consensus as soon as it's imported.
+        self.consensus_parser = consensus.ConsensusParser(commit_every=1, fast=fast)
+        self.consensus_parser.load_relay_ids(db_cursor)
+
+        # Start of the window that 'times_seen_counter' counts.
+        self.window_start = sqlite_db.get_window_start(db_cursor, max_days)
+        # Maps a <relay_id> to the <number of consensuses> it was a guard
+        # in, since 'window_start'.
+        self.times_seen_counter = None
+        # Number of consensuses in our window, as of the last output file.
+        self.consensuses_read_n = None
+
+        # Start from the running counters of the database.
+        sqlite_db.update_guard_counts(db_conn, db_cursor, max_days, self.window_start)
+        db_cursor.execute("SELECT relay_id, times_seen FROM guard_count")
+        self.times_seen_counter = collections.Counter(dict((row[0], row[1]) for row in db_cursor.fetchall()))
+
+    def _spooled_files(self):
+        """
+        Return the consensus files waiting in the spool directory,
+        oldest name first. Dotfiles are still being written.
+        """
+        spooled = [os.path.join(self.spool_dir, filename)
+                   for filename in sorted(os.listdir(self.spool_dir))
+                   if not filename.startswith(".")]
+        return [f for f in spooled if os.path.isfile(f)]
+
+    def _set_aside(self, consensus_f):
+        """Move the spooled 'consensus_f' to the FAILED_SUBDIR of the spool directory."""
+        failed_dir = os.path.join(self.spool_dir, FAILED_SUBDIR)
+        if not os.path.isdir(failed_dir):
+            os.mkdir(failed_dir)
+
+        failed_f = os.path.join(failed_dir, os.path.basename(consensus_f))
+        os.rename(consensus_f, failed_f)
+        return failed_f
+
+    def import_spooled(self):
+        """
+        Import and remove all consensuses waiting in the spool directory.
+        Files that can't be parsed are moved out of the way instead.
+        Return the number of new consensuses imported.
+        """
+        imported_n = 0
+
+        for consensus_f in self._spooled_files():
+            record = self.consensus_parser.parse_consensus_file(consensus_f)
+            if not record:
+                logging.error("Could not parse spooled consensus %s. Moved it to %s.",
+                              consensus_f, self._set_aside(consensus_f))
+                continue
+
+            valid_after, guard_fprs = record
+            if self.consensus_parser.import_guards(valid_after, guard_fprs, self.db_cursor):
+                imported_n += 1
+                logging.info("Imported consensus %s.", valid_after)
+
+                # The importer counted it in the database if it falls
+                # in the window. Count it here too.
+                if sqlite_db.datetime_to_hour(valid_after) >= self.window_start:
+                    relay_ids = self.consensus_parser.relay_ids
+                    self.times_seen_counter.update(relay_ids[guard_fpr] for guard_fpr in guard_fprs)
+
+            os.remove(consensus_f)
+
+        return imported_n
+
+    def slide_window(self):
+        """Forget about the consensuses that left our window since last time."""
+
+        window_start = sqlite_db.get_window_start(self.db_cursor, self.max_days)
+
+        expired_counter = sqlite_db.count_window_guardsets(self.db_conn, self.window_start, window_start)
+        if expired_counter:
+            self.times_seen_counter.subtract(expired_counter)
+            self.times_seen_counter = collections.Counter(dict(
+                (relay_id, times_seen) for relay_id, times_seen in self.times_seen_counter.iteritems()
+                if times_seen > 0))
+
+        # Keep the counters of the database in step, for anyone running
+        # guardfraction.py by hand.
+        sqlite_db.update_guard_counts(self.db_conn, self.db_cursor, self.max_days, window_start)
+        self.window_start = window_start
+
+    def write_output_file(self):
+        """Write the guardfraction output file out of our counters."""
+
+        identities = dict((relay_id, identity)
+                          for identity, relay_id in self.consensus_parser.relay_ids.iteritems())
+
+        guards = guard_ds.Guards()
+        for relay_id, times_seen in self.times_seen_counter.iteritems():
+            guards.register_guard(identities[relay_id], times_seen, relay_id)
+
+        if guards.write_output_file(self.output_file, self.max_days, self.consensuses_read_n):
+            logging.info("Wrote output file at %s (%d consensuses, %d guards).",
+                         self.output_file, self.consensuses_read_n, len(guards))
+
+    def poll(self):
+        """
+        Import any new consensuses, move our window to the present and
+        rewrite the output file if anything changed.
+
+        Return True if the output file was rewritten.
+        """
+        imported_n = self.import_spooled()
+        self.slide_window()
+
+        self.db_cursor.execute(sqlite_db.WINDOW_CONSENSUS_COUNT_SQL, (self.window_start,))
+        consensuses_read_n = int(self.db_cursor.fetchone()[0])
+
+        if not imported_n and consensuses_read_n == self.consensuses_read_n:
+            return False
+        self.consensuses_read_n = consensuses_read_n
+
+        if consensuses_read_n == 0:
+            logging.warning("No consensus measurements at all in the database.")
+            return False
+
+        # Make sure that our clock is not horribly desynchronized.
+        try:
+            guardfraction.check_clock_correctness(self.db_cursor)
+        except guardfraction.DesynchronizedClock, err:
+            logging.warning("Clock issue (%s). Not writing output file.", err)
+            return False
+
+        try:
+            self.write_output_file()
+        except (IOError, OSError), err:
+            logging.warning("Could not write output file: %s", err)
+            return False
+
+        return True
+
+    def run(self, poll_interval):
+        """Poll the spool directory every 'poll_interval' seconds, forever."""
+        while True:
+            self.poll()
+            time.sleep(poll_interval)
+
+def parse_cmd_args():
+    parser = argparse.ArgumentParser("guardfraction_daemon.py",
+                                      formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("max_days", type=int,
+                        help="Only consider guards active in the past max_days.")
+    parser.add_argument("spool_dir", type=str,
+                        help="Directory to watch for new consensus files. Files are removed once imported.")
+    parser.add_argument("--db-file", type=str, default=SQLITE_DB_FILE,
+                        help="Path to the guard database file.")
+    parser.add_argument("--schema-file", type=str, default=SQLITE_DB_SCHEMA,
+                        help="Path to the database schema file, used if the database doesn't exist yet.")
+    parser.add_argument("-o", "--output", type=str, default=DEFAULT_OUTPUT_FNAME,
+                        help="Path to place the guardfraction output file.")
+    parser.add_argument("--poll-interval", type=float, default=10,
+                        help="Seconds between looks at the spool directory.")
+    parser.add_argument("--fast-parse", action="store_true", default=False,
+                        help="Only extract guard flags from consensuses instead of fully parsing them with stem.")
+
+    return parser.parse_args()
+
+def main():
+    """Import spooled consensuses and output guardfraction data, forever."""
+
+    logging.getLogger("").setLevel(logging.INFO)
+
+    # Parse CLI
+    args = parse_cmd_args()
+
+    # Make sure that max_days is a positive integer but not too
+    # positive. The maximum value is currently set to 5 years.
+    if args.max_days <= 0 or args.max_days > (5*12*30):
+        logging.warning("Bad max_days value (%d)", args.max_days)
+        sys.exit(2)
+
+    if not os.path.isdir(args.spool_dir):
+        logging.error("%s is not a directory!", args.spool_dir)
+        sys.exit(2)
+
+    first_time = not os.path.exists(args.db_file)
+    db_conn, db_cursor = sqlite_db.init_db(args.db_file,
+                                           args.schema_file if first_time else None,
+                                           "import")
+
+    daemon = GuardfractionDaemon(db_conn, db_cursor, args.spool_dir, args.output,
+                                 args.max_days, args.fast_parse)
+    daemon.run(args.poll_interval)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        logging.warning("Caught ^C. Closing.")
+        sys.exit(1)
@@ -0,0 +1,62 @@
+import datetime
+
+"""This file knows where CollecTor keeps the consensuses we might miss"""
+
+# Where CollecTor keeps its monthly microdesc consensus archives.
+COLLECTOR_ARCHIVE_URL = "https://collector.torproject.org/archive/relay-descriptors/microdescs/"
+
+def get_consensus_filename(valid_after):
+    """Return the name CollecTor gives to the consensus valid after 'valid_after'."""
+    return valid_after.strftime("%Y-%m-%d-%H-%M-%S-consensus-microdesc")
+
+def get_archive_name(valid_after):
+    """Return the name of the CollecTor archive with the consensus valid after 'valid_after'."""
+    return valid_after.strftime("microdescs-%Y-%m.tar.xz")
+
+def get_archive_member(valid_after):
+    """
+    Return the name of the consensus valid after 'valid_after' inside
+    its CollecTor archive.
+    """
+    return valid_after.strftime("microdescs-%Y-%m/consensus-microdesc/%d/") + get_consensus_filename(valid_after)
+
+def make_backfill_plan(missing_ranges):
+    """
+    Return a plan for fetching the consensuses of 'missing_ranges', a
+    list of (first missing hour, last missing hour) datetime tuples.
+
+    The plan is a dictionary that can be dumped as JSON:
+
+    {{{
+    {
+      "missing_ranges" : [["<first missing hour>", "<last missing hour>"], ...],
+      "missing_n" : <number of missing consensuses>,
+      "archives" : [
+        {"url" : "<CollecTor archive url>",
+         "members" : ["<name of missing consensus in the archive>", ...]},
+        ...
+      ]
+    }
+    }}}
+
+    Archives are listed oldest first.
+    """
+    # Maps an <archive name> to the <list of members> we need from it.
+    archive_members = {}
+    missing_n = 0
+
+    for first_missing, last_missing in missing_ranges:
+        valid_after = first_missing
+        while valid_after <= last_missing:
+            archive_members.setdefault(get_archive_name(valid_after), []).append(get_archive_member(valid_after))
+            missing_n += 1
+            valid_after += datetime.timedelta(hours=1)
+
+    return {
+        "missing_ranges" : [[str(first_missing), str(last_missing)]
+                            for first_missing, last_missing in missing_ranges],
+        "missing_n" : missing_n,
+        "archives" : [{"url" : COLLECTOR_ARCHIVE_URL + archive_name,
+                       "members" : archive_members[archive_name]}
+                      for archive_name in sorted(archive_members)],
+    }
@@ -1,72 +1,312 @@
 import logging
 import datetime
 import sqlite3
+import binascii
+import StringIO
 
 import stem
+import guardiness.sqlite_db as sqlite_db
+import guardiness.stats as stats
 from stem.descriptor import parse_file, DocumentHandler
 
+def read_valid_after(consensus_fd):
+    """
+    Read lines from 'consensus_fd' until we find the 'valid-after'
+    line, and return its date as a datetime.
+
+    Raise ValueError if there is no such line.
+    """
+    for line in consensus_fd:
+        if line.startswith("valid-after "):
+            return datetime.datetime.strptime(line[12:].strip(), "%Y-%m-%d %H:%M:%S")
+        if line.startswith("r "): # we are past the header
+            break
+
+    raise ValueError("No valid-after line in consensus")
+
+def iter_guard_flags(consensus_fd):
+    """
+    Read the router entries from 'consensus_fd' line by line, and
+    yield a (fingerprint, is_guard) tuple for each one of them.
+
+    Only looks at the 'r' and 's' lines. Raise ValueError if an 'r'
+    line is malformed.
+    """
+    fingerprint = None
+
+    for line in consensus_fd:
+        if line.startswith("r "):
+            if fingerprint: # previous router had no 's' line
+                yield fingerprint, False
+
+            fields = line.split()
+            if len(fields) < 8:
+                raise ValueError("Malformed r line: %s" % line.strip())
+            identity = fields[2]
+            try:
+                fingerprint = binascii.b2a_hex(binascii.a2b_base64(identity + "=" * (-len(identity) % 4))).upper()
+            except (binascii.Error, TypeError), err:
+                raise ValueError("Malformed identity in r line (%s): %s" % (err, line.strip()))
+            if len(fingerprint) != 40:
+                raise ValueError("Malformed identity in r line: %s" % line.strip())
+        elif line.startswith("s ") and fingerprint:
+            yield fingerprint, "Guard" in line.split()[1:]
+            fingerprint = None
+        elif line.startswith("directory-footer"):
+            break
+
+    if fingerprint:
+        yield fingerprint, False
+
 class ConsensusParser(object):
     """
     Singleton that parses consensuses and imports them to a database.
     """
 
-    def __init__(self):
-        """Initialize the consensus parser."""
-        pass
+    def __init__(self, commit_every=None, fast=False):
+        """
+        Initialize the consensus parser.
+
+        If 'commit_every' is set, the database transaction is committed
+        every time that many consensuses have been imported. Otherwise,
+        committing is left to the caller.
+
+        If 'fast' is set, consensuses are first parsed with our own
+        line-based guard flag extractor, and stem is only used if that
+        fails.
+        """
+        self.commit_every = commit_every
+        self.fast = fast
+
+        # Maps a <relay identity fpr> to its <relay_id> in the database.
+        # Loaded from the database the first time we import a consensus.
+        self.relay_ids = None
+
+        # Number of consensuses imported since the last commit.
+        self.uncommitted_n = 0
+
+        # A (consensus_hour, frozenset of relay_ids) tuple with the
+        # guards of the newest consensus we imported, so that the next
+        # one only has to be diffed against it.
+        self.newest_guardset = None
 
     def _router_is_guard(self, router):
         """Return true if the router is a guard according on its consensus flags."""
         return stem.Flag.GUARD in router.flags
 
-    def parse_and_import_consensus(self, consensus_filename, db_cursor):
-        """Parse consensus file and import it to the database at db_cursor"""
+    def parse_consensus(self, consensus_fd):
+        """
+        Parse the consensus in 'consensus_fd'.
 
-        with open(consensus_filename, 'rb') as consensus_fd:
+        Return a (valid_after, guard_fprs) tuple with the date of the
+        consensus and the fingerprints of its guards.
+        """
+
+        if self.fast:
             try:
-                self._parse_and_import_consensus(consensus_fd, db_cursor)
-            except (ValueError, IOError, UnicodeEncodeError), err:
-                logging.warning(u"Can't parse %s because '%s'", consensus_filename, err) # XXX info?
-                return
+                return self._parse_consensus_fast(consensus_fd)
+            except ValueError, err:
+                logging.info("Fast parsing failed (%s). Falling back to stem.", err)
+                consensus_fd.seek(0)
+
+        return self._parse_consensus_stem(consensus_fd)
+
+    def _parse_consensus_fast(self, consensus_fd):
+        """Parse the consensus in 'consensus_fd' without stem."""
+
+        valid_after = read_valid_after(consensus_fd)
+        guard_fprs = [fingerprint for fingerprint, is_guard in iter_guard_flags(consensus_fd)
+                      if is_guard]
+
+        return valid_after, guard_fprs
 
-    def _parse_and_import_consensus(self, consensus_fd, db_cursor):
-        """Friend of parse_and_import_consensus()."""
+    def _parse_consensus_stem(self, consensus_fd):
+        """Parse the consensus in 'consensus_fd' using stem."""
 
         # Use stem to parse the consensus.
         consensus =  parse_file(consensus_fd, 'network-status-microdesc-consensus-3 1.0',
                                 document_handler = DocumentHandler.DOCUMENT).next()
+        # stem doesn't validate by default, so garbage parses too.
+        if consensus.valid_after is None:
+            raise ValueError("No valid-after line in consensus")
+
+        guard_fprs = [router.fingerprint for router in consensus.routers.values()
+                      if self._router_is_guard(router)]
+
+        return consensus.valid_after, guard_fprs
+
+    def parse_consensus_file(self, consensus_filename):
+        """
+        Parse consensus file and return a (valid_after, guard_fprs)
+        tuple, or None if the file could not be parsed.
+        """
+
+        with open(consensus_filename, 'rb') as consensus_fd:
+            try:
+                return self.parse_consensus(consensus_fd)
+            except (ValueError, IOError, UnicodeEncodeError), err:
+                logging.warning(u"Can't parse %s because '%s'", consensus_filename, err) # XXX info?
+                return None
+
+    def parse_consensus_string(self, consensus_str, consensus_name):
+        """
+        Parse the consensus in 'consensus_str' and return a
+        (valid_after, guard_fprs) tuple, or None if it could not be
+        parsed. 'consensus_name' is only used for logging.
+        """
+
+        try:
+            return self.parse_consensus(StringIO.StringIO(consensus_str))
+        except (ValueError, UnicodeEncodeError), err:
+            logging.warning(u"Can't parse %s because '%s'", consensus_name, err)
+            return None
+
+    def parse_and_import_consensus(self, consensus_filename, db_cursor):
+        """Parse consensus file and import it to the database at db_cursor"""
+
+        record = self.parse_consensus_file(consensus_filename)
+        if record:
+            valid_after, guard_fprs = record
+            self.import_guards(valid_after, guard_fprs, db_cursor)
+
+    def load_relay_ids(self, db_cursor):
+        """Fill our identity->relay_id cache with all the relays in the database."""
+        db_cursor.execute("SELECT identity, relay_id FROM relay")
+        self.relay_ids = dict((sqlite_db.unpack_identity(row[0]), row[1]) for row in db_cursor.fetchall())
+
+    def _register_new_relays(self, identities, db_cursor):
+        """
+        Insert the relays with 'identities' to the database and add
+        them to our identity->relay_id cache.
+
+        Must be called inside a write transaction, so that no one else
+        can insert relays between our INSERT and our SELECT.
+        """
+        db_cursor.execute("SELECT coalesce(max(relay_id), 0) FROM relay")
+        last_relay_id = db_cursor.fetchone()[0]
+
+        db_cursor.executemany("INSERT OR IGNORE INTO relay (identity) VALUES (?)",
+                              [(sqlite_db.pack_identity(identity),) for identity in identities])
+
+        db_cursor.execute("SELECT identity, relay_id FROM relay WHERE relay_id > ?", (last_relay_id,))
+        for identity, relay_id in db_cursor.fetchall():
+            identity = sqlite_db.unpack_identity(identity)
+            self.relay_ids[identity] = relay_id
+            logging.debug("Inserted new guard %s", identity)
+
+        # Relays that someone else registered behind our back are not
+        # in the cache yet. Look them up one by one.
+        for identity in identities:
+            if identity not in self.relay_ids:
+                row = db_cursor.execute("SELECT relay_id FROM relay WHERE identity=?",
+                                        (sqlite_db.pack_identity(identity),)).fetchone()
+                self.relay_ids[identity] = row[0]
+
+    def import_guards(self, valid_after, guard_fprs, db_cursor):
+        """
+        Import a consensus that was valid after 'valid_after' and
+        had the guards with fingerprints 'guard_fprs' to the database
+        at 'db_cursor'.
+
+        Return True if the consensus was imported and False if it was
+        already in the database.
+        """
+
+        if self.relay_ids is None:
+            self.load_relay_ids(db_cursor)
+
+        consensus_hour = sqlite_db.datetime_to_hour(valid_after)
+        newest_hour = sqlite_db.get_newest_consensus_hour(db_cursor)
+
+        # Make sure the guardset partition of this consensus exists
+        # before we start, since creating it commits.
+        sqlite_db.get_guardset_partition(db_cursor, consensus_hour)
 
         # Insert the consensus to the database
         try:
-            db_cursor.execute("INSERT INTO consensus (consensus_date) VALUES (?)", (consensus.valid_after,))
+            db_cursor.execute("INSERT INTO consensus (consensus_hour) VALUES (?)", (consensus_hour,))
         except sqlite3.IntegrityError, err:
-            logging.info("Didn't add duplicate consensus (%s) (%s).", consensus.valid_after, err)
-            return
+            logging.info("Didn't add duplicate consensus (%s) (%s).", valid_after, err)
+            stats.count("consensuses_duplicate")
+            return False
 
         consensus_db_idx = db_cursor.lastrowid # note down the index of this consensus on the database
 
-        """
-        Register all the guard relays to the database
-        and associate them with this consensus.
-        """
-        for router in consensus.routers.values():
-            if not self._router_is_guard(router): # skip if not a guard
-                continue
+        # Register all the guard relays we haven't seen before.
+        with stats.timer("relay_lookup"):
+            new_identities = [identity for identity in guard_fprs if identity not in self.relay_ids]
+            if new_identities:
+                self._register_new_relays(new_identities, db_cursor)
+            relay_ids = [self.relay_ids[identity] for identity in guard_fprs]
+
+        # Associate all the guards with this consensus in one go.
+        with stats.timer("guardset_insert"):
+            sqlite_db.insert_guardset(db_cursor, consensus_db_idx, consensus_hour, relay_ids)
 
-            identity = router.fingerprint
-            relay_db_idx = None # the index of this relay on the database
+        with stats.timer("guard_counters"):
+            sqlite_db.count_imported_guardset(db_cursor, consensus_hour, relay_ids)
+            sqlite_db.decay_imported_guardset(db_cursor, consensus_hour, relay_ids)
 
-            # Check if we've seen this guard before.
-            # If it's a new guard, no row should be returned.
-            row = db_cursor.execute("SELECT relay_id FROM relay WHERE identity=?", (identity,)).fetchone()
+        with stats.timer("guard_intervals"):
+            newest_relay_ids = None
+            if self.newest_guardset and self.newest_guardset[0] == newest_hour:
+                newest_relay_ids = self.newest_guardset[1]
+            sqlite_db.extend_guard_intervals(db_cursor, consensus_hour, relay_ids, newest_hour, newest_relay_ids)
 
-            if not row: # This is a new guard, register it!
-                db_cursor.execute("INSERT INTO relay (identity) VALUES (?)", (identity,))
-                relay_db_idx = db_cursor.lastrowid
-                logging.debug("Inserted new guard %s", identity)
-            else: # Seen this guard before, get its index.
-                relay_db_idx = row['relay_id']
+        if newest_hour is None or consensus_hour > newest_hour:
+            self.newest_guardset = (consensus_hour, frozenset(relay_ids))
 
-            # Associate this guard index with the consensus index in the database.
-            db_cursor.execute("INSERT INTO guarddata (relay_id,consensus_id) VALUES (?,?)",
-                              (relay_db_idx, consensus_db_idx))
+        stats.count("consensuses_imported")
+        stats.count("guards_inserted", len(relay_ids))
+        stats.count("new_relays", len(new_identities))
+
+        self.uncommitted_n += 1
+        if self.commit_every and self.uncommitted_n >= self.commit_every:
+            self.commit(db_cursor)
+
+        return True
+
+    def commit(self, db_cursor):
+        """Commit the consensuses we've imported so far."""
+        with stats.timer("commit"):
+            db_cursor.connection.commit()
+        self.uncommitted_n = 0
+
+def parse_consensus_file(consensus_filename, fast=False):
+    """
+    Parse the consensus at 'consensus_filename' and return a
+    (valid_after, guard_fprs) tuple or None.
+
+    Module-level so that it can be handed to multiprocessing workers.
+    """
+    return ConsensusParser(fast=fast).parse_consensus_file(consensus_filename)
+
+def parse_consensus_member(consensus_member, fast=False):
+    """
+    Parse a (name, consensus string) tuple, like the ones we read out
+    of consensus archives, and return a (valid_after, guard_fprs)
+    tuple or None.
+
+    Module-level so that it can be handed to multiprocessing workers.
+    """
+    consensus_name, consensus_str = consensus_member
+    return ConsensusParser(fast=fast).parse_consensus_string(consensus_str, consensus_name)
+
+def sniff_consensus_file(consensus_filename):
+    """
+    Return the valid-after date of the consensus at
+    'consensus_filename' by only reading its header, or None if we
+    can't find it there.
+    """
+    try:
+        with open(consensus_filename, 'rb') as consensus_fd:
+            return read_valid_after(consensus_fd)
+    except (ValueError, IOError):
+        return None
 
+def sniff_consensus_member(consensus_member):
+    """Like sniff_consensus_file() but for a (name, consensus string) tuple."""
+    try:
+        return read_valid_after(StringIO.StringIO(consensus_member[1]))
+    except ValueError:
+        return None
@@ -0,0 +1,197 @@
+import logging
+import datetime
+import email.utils
+import calendar
+import httplib
+import socket
+import threading
+import Queue
+import StringIO
+import time
+import urllib2
+import zlib
+
+import guardiness.consensus as consensus
+
+"""This file fetches the latest consensus from several directory mirrors at once"""
+
+# Consensuses are valid for three hours after their valid-after time.
+# Anything older than that is stale.
+MAX_CONSENSUS_AGE = datetime.timedelta(hours=3)
+# Consensuses are fresh for an hour after their valid-after time, until
+# the next one comes out. A mirror that only has an older one is
+# lagging behind.
+FRESH_CONSENSUS_AGE = datetime.timedelta(hours=1)
+
+DEFAULT_TIMEOUT = 60
+DEFAULT_RETRIES = 2
+DEFAULT_RETRY_DELAY = 5
+
+class FetchError(Exception): pass
+
+class NotModified(Exception):
+    """Raised when a source tells us that it has nothing newer than what we asked for."""
+    pass
+
+def _http_date(date):
+    """Format the UTC datetime 'date' for HTTP headers like If-Modified-Since."""
+    return email.utils.formatdate(calendar.timegm(date.timetuple()), usegmt=True)
+
+def _decompress(body, content_encoding, url):
+    """Undo the 'content_encoding' of the 'body' of a response from 'url'."""
+    content_encoding = (content_encoding or "").strip().lower()
+
+    try:
+        if content_encoding == "gzip":
+            return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        # Directory servers send zlib streams for 'deflate', and for
+        # their '.z' URLs without saying so.
+        if content_encoding in ("deflate", "x-zlib") or url.endswith(".z"):
+            return zlib.decompress(body)
+    except zlib.error, err:
+        raise FetchError("Can't decompress the response of %s (%s)" % (url, err))
+
+    return body
+
+def fetch_url(url, timeout=DEFAULT_TIMEOUT, if_modified_since=None):
+    """
+    Download the document at 'url', asking for a compressed transfer,
+    and return it decompressed.
+
+    If 'if_modified_since' is set, only ask for a document newer than
+    that UTC datetime, and raise NotModified if the source has none.
+    """
+    request = urllib2.Request(url, headers={"Accept-Encoding" : "deflate, gzip"})
+    if if_modified_since:
+        request.add_header("If-Modified-Since", _http_date(if_modified_since))
+
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError, err:
+        if err.code == 304:
+            raise NotModified(url)
+        raise
+
+    try:
+        body = response.read()
+    finally:
+        response.close()
+
+    return _decompress(body, response.info().getheader("Content-Encoding"), url)
+
+def check_consensus(consensus_str, min_valid_after):
+    """
+    Return the valid-after date of 'consensus_str'. Raise FetchError
+    if it doesn't look like a consensus or if it's from before
+    'min_valid_after'.
+    """
+    try:
+        valid_after = consensus.read_valid_after(StringIO.StringIO(consensus_str))
+    except ValueError, err:
+        raise FetchError("Not a consensus (%s)" % err)
+
+    if min_valid_after and valid_after < min_valid_after:
+        raise FetchError("Stale consensus from %s" % valid_after)
+
+    return valid_after
+
+def _fetch_from_source(url, results, timeout, retries, retry_delay, min_valid_after, if_modified_since):
+    """
+    Try to get a fresh consensus from 'url', up to 'retries' more times
+    if the source misbehaves, and put a (url, outcome) tuple on the
+    'results' queue. The outcome is a (valid_after, consensus_str)
+    tuple, or the exception that we gave up on.
+    """
+    for attempt in xrange(retries + 1):
+        if attempt:
+            time.sleep(retry_delay)
+
+        try:
+            consensus_str = fetch_url(url, timeout, if_modified_since)
+            valid_after = check_consensus(consensus_str, min_valid_after)
+        except NotModified, err:
+            results.put((url, err))
+            return
+        except (FetchError, urllib2.URLError, httplib.HTTPException, socket.error), err:
+            logging.info("Fetching %s failed (attempt %d): %s", url, attempt + 1, err)
+            outcome = err
+            continue
+
+        results.put((url, (valid_after, consensus_str)))
+        return
+
+    results.put((url, outcome))
+
+def fetch_consensus(urls, min_valid_after=None, if_modified_since=None,
+                    timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, retry_delay=DEFAULT_RETRY_DELAY,
+                    now=None):
+    """
+    Race all the sources in 'urls' for the latest consensus, and return
+    a (url, valid_after, consensus_str) tuple.
+
+    The first fresh consensus at 'now' (UTC, by default the current
+    time) wins. If a source only has an older one, wait up to 'timeout'
+    more seconds for the others to come up with a fresh one, and settle
+    for the newest one we got.
+
+    Consensuses from before 'min_valid_after' don't count. If
+    'if_modified_since' is set, sources are only asked for consensuses
+    newer than that, and None is returned if none of them has one.
+
+    Each source gets 'timeout' seconds per attempt, and is retried
+    'retries' times, 'retry_delay' seconds apart, if it fails. Raise
+    FetchError if all of them fail.
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    results = Queue.Queue()
+
+    for url in urls:
+        fetcher = threading.Thread(target=_fetch_from_source,
+                                   args=(url, results, timeout, retries, retry_delay,
+                                         min_valid_after, if_modified_since))
+        # Don't wait for the losers of the race on exit.
+        fetcher.daemon = True
+        fetcher.start()
+
+    errors = []
+    not_modified_n = 0
+    # The newest (url, valid_after, consensus_str) that is not fresh,
+    # and until when we wait for a better one.
+    best = None
+    deadline = None
+    for _ in urls:
+        try:
+            if deadline is None:
+                url, outcome = results.get()
+            else:
+                url, outcome = results.get(timeout=max(deadline - time.time(), 0))
+        except Queue.Empty:
+            break
+
+        if isinstance(outcome, NotModified):
+            not_modified_n += 1
+        elif isinstance(outcome, Exception):
+            errors.append("%s: %s" % (url, outcome))
+        else:
+            valid_after, consensus_str = outcome
+            if valid_after + FRESH_CONSENSUS_AGE > now:
+                logging.info("Fetched consensus %s from %s.", valid_after, url)
+                return url, valid_after, consensus_str
+
+            logging.info("%s only has the older consensus %s.", url, valid_after)
+            if not best or valid_after > best[1]:
+                best = (url, valid_after, consensus_str)
+            if deadline is None:
+                deadline = time.time() + timeout
+
+    if best:
+        logging.info("Settling for consensus %s from %s.", best[1], best[0])
+        return best
+
+    if not_modified_n:
+        logging.info("No consensus newer than %s.", if_modified_since)
+        return None
+
+    raise FetchError("Could not fetch a consensus from any source (%s)" % "; ".join(errors))
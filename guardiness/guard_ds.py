@@ -1,80 +1,235 @@
 import logging
 import datetime
+import array
+import hashlib
+import itertools
+import os
+import tempfile
 
 """This file holds guard-related data structures"""
 
-class Guard(object):
-    def __init__(self, guard_fpr, times_seen):
-        """
-        Initialize a guard node with identity fingerprint 'guard_fpr'
-        that has appeared in 'times_seen' consensuses lately.
-        """
-        self.fingerprint = guard_fpr
-        self.times_seen = times_seen
+# Suffix of the file next to the output file that holds the digest of
+# its guard data (see write_output_file()).
+DIGEST_SUFFIX = ".sha256"
+
+# Number of guards that write_output_file() formats and writes at a time.
+OUTPUT_BATCH_ROWS = 4096
+
+class DiscardFile(Exception):
+    """Raised by write functions of _write_file_atomically() to bail out."""
+    pass
+
+def _write_file_atomically(fname, write_func):
+    """
+    Call 'write_func' with a file object, and atomically replace
+    'fname' with whatever it wrote. Readers of 'fname' see either the
+    old or the new file, never a partial one.
+
+    Return the return value of 'write_func', or None without touching
+    'fname' if 'write_func' raised DiscardFile.
+    """
+    dirname = os.path.dirname(os.path.abspath(fname))
+    temp_fd, temp_path = tempfile.mkstemp(dir=dirname, prefix="." + os.path.basename(fname))
+
+    try:
+        with os.fdopen(temp_fd, 'w', 1 << 16) as f:
+            try:
+                ret = write_func(f)
+            except DiscardFile:
+                return None
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, fname)
+        temp_path = None
+    finally:
+        if temp_path:
+            os.remove(temp_path)
+
+    # Make sure the rename itself hits the disk.
+    dir_fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+    return ret
+
+def read_output_digest(output_fname):
+    """
+    Return the digest of the guard data of the output file at
+    'output_fname' as of its last rewrite, or None if we don't know it.
+    """
+    try:
+        with open(output_fname + DIGEST_SUFFIX) as digest_fd:
+            return digest_fd.read().strip()
+    except IOError:
+        return None
+
+def format_guard_lines(guard_rows, consensuses_read_n):
+    """
+    Return the 'guard-seen' lines of the output file for 'guard_rows',
+    a list of (guard fingerprint, times seen) tuples, in order.
+
+    Guardfraction is an integer percentage (a value in [0,100]) of how
+    much a relay has been a guard according to the parsed consensuses.
+    Rounds halves up, using integer arithmetic so that we don't pick up
+    floating point errors.
+    """
+    double_n = 2 * consensuses_read_n
+    return ["guard-seen %s %d %d\n" % (guard_fpr, (200 * times_seen + consensuses_read_n) // double_n, times_seen)
+            for guard_fpr, times_seen in guard_rows]
 
 class Guards(object):
     """
     Keeps track of the guards we've encountered while parsing the various consensuses.
+
+    Guards are kept in columns instead of per-guard objects: the i-th
+    guard has fingerprint self.fingerprints[i], relay_id
+    self.relay_ids[i], and has appeared in self.times_seen[i]
+    consensuses lately.
     """
 
     def __init__(self):
-        # Keeps track of guards. Maps a <guard identity fpr> to a <Guard object>.
-        self.guards = {}
+        # Identity fingerprints of the guards.
+        self.fingerprints = []
+        # Database relay_ids of the guards.
+        self.relay_ids = array.array('l')
+        # Number of consensuses each guard has appeared in.
+        self.times_seen = array.array('l')
 
-    def register_guard(self, guard_fpr, times_seen):
-        """Make a Guard object and keep track of it."""
+    def __len__(self):
+        return len(self.fingerprints)
 
-        guard = Guard(guard_fpr, times_seen)
-        self.guards[guard_fpr] = guard
-
-    def _get_guard_guardfraction_percentage(self, guard, consensuses_read_n):
+    def register_guard(self, guard_fpr, times_seen, relay_id=0):
         """
-        Calculate and return the guardfraction of 'guard'.
-
-        Guardfraction is an integer percentage (a value in [0,100]) of
-        how much this relay has been a guard according to the parsed
-        consensuses.
+        Keep track of guard 'guard_fpr' that appeared in 'times_seen'
+        consensuses. 'relay_id' is its relay_id in the database, if
+        it has one.
         """
 
-        guardfraction = guard.times_seen / float(consensuses_read_n)
-        guardfraction_percentage = int(round(guardfraction*100))
+        self.fingerprints.append(guard_fpr)
+        self.relay_ids.append(relay_id)
+        self.times_seen.append(times_seen)
 
-        return guardfraction_percentage
+    def items(self):
+        """Return a list of (guard fingerprint, times seen) tuples."""
+        return zip(self.fingerprints, self.times_seen)
 
-    def write_output_file(self, output_fname, max_days, consensuses_read_n):
+    def __iter__(self):
         """
-        Write a guardfraction output file
-
-        {{{
-        guardfraction-file-version <version>
-        written-at <date and time>
-        n-inputs <number of consesuses parsed> <number of days considered> <ideal number of consensuses>
-
-        guard-seen <guard fpr 1> <guardfraction percentage> <number of consensus appearances>
-        guard-seen <guard fpr 2> <guardfraction percentage> <number of consensus appearances>
-        guard-seen <guard fpr 3> <guardfraction percentage> <number of consensus appearances>
-        guard-seen <guard fpr 4> <guardfraction percentage> <number of consensus appearances>
-        guard-seen <guard fpr 5> <guardfraction percentage> <number of consensus appearances>
-        ...
-        }}}
-
-        Might raise IOError.
+        Yield a (guard fingerprint, times seen) tuple for each guard,
+        most seen guards first. Ties are broken by relay_id, like when
+        streaming guards out of the database, so that the output file
+        comes out the same either way.
         """
-        now = datetime.datetime.utcnow() # get the current date
-        now = now.replace(microsecond=0) # leave out the microsecond part
+        for i in sorted(xrange(len(self.fingerprints)), key=lambda i: (-self.times_seen[i], self.relay_ids[i])):
+            yield self.fingerprints[i], self.times_seen[i]
+
+    def write_output_file(self, output_fname, max_days, consensuses_read_n):
+        """Write a guardfraction output file with our guards. See write_output_file()."""
+        return write_output_file(output_fname, max_days, consensuses_read_n, self)
+
+class StreamedGuards(object):
+    """
+    The guards of a window, read lazily: every pass over them gets a
+    fresh iterator out of 'iter_func', which yields (guard fingerprint,
+    times seen) tuples most seen guards first. Writing the output file
+    streams them straight through, so they are never all in memory.
+    """
+
+    def __init__(self, iter_func):
+        self.iter_func = iter_func
+
+    def __iter__(self):
+        return iter(self.iter_func())
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def items(self):
+        """Return a list of (guard fingerprint, times seen) tuples."""
+        return list(self)
+
+    def write_output_file(self, output_fname, max_days, consensuses_read_n):
+        """Write a guardfraction output file with our guards. See write_output_file()."""
+        return write_output_file(output_fname, max_days, consensuses_read_n, self)
+
+def write_output_file(output_fname, max_days, consensuses_read_n, guard_rows, ideal_consensuses_n=None):
+    """
+    Write a guardfraction output file
+
+    {{{
+    guardfraction-file-version <version>
+    written-at <date and time>
+    n-inputs <number of consesuses parsed> <number of days considered> <ideal number of consensuses>
+
+    guard-seen <guard fpr 1> <guardfraction percentage> <number of consensus appearances>
+    guard-seen <guard fpr 2> <guardfraction percentage> <number of consensus appearances>
+    guard-seen <guard fpr 3> <guardfraction percentage> <number of consensus appearances>
+    guard-seen <guard fpr 4> <guardfraction percentage> <number of consensus appearances>
+    guard-seen <guard fpr 5> <guardfraction percentage> <number of consensus appearances>
+    ...
+    }}}
+
+    The ideal number of consensuses is 'ideal_consensuses_n', or one
+    per hour of 'max_days' if that's None.
+
+    'guard_rows' yields a (guard fingerprint, times seen) tuple for
+    each guard, most seen guards first. The guards are formatted with
+    format_guard_lines() and written OUTPUT_BATCH_ROWS at a time, so
+    that only one batch is ever in memory.
+
+    The file is replaced atomically. If everything but the
+    'written-at' line is the same as in the existing file, the file
+    is only touched. The SHA256 digest of everything after the
+    'written-at' line is kept next to the file, in a file with
+    DIGEST_SUFFIX appended to its name.
+
+    Return True if the file was rewritten, False if it was only touched.
+
+    Might raise IOError or OSError.
+    """
+    now = datetime.datetime.utcnow() # get the current date
+    now = now.replace(microsecond=0) # leave out the microsecond part
+
+    old_digest = read_output_digest(output_fname) if os.path.exists(output_fname) else None
+
+    def write_guards(f):
+        digest = hashlib.sha256()
+
+        f.write("guardfraction-file-version 1\n")
+        f.write("written-at %s\n" % now.isoformat(sep=" ")) # separate year from time with space
+
+        if ideal_consensuses_n is None:
+            line = "n-inputs %d %d %d\n" % (consensuses_read_n, max_days, max_days*24)
+        else:
+            line = "n-inputs %d %d %d\n" % (consensuses_read_n, max_days, ideal_consensuses_n)
+        digest.update(line)
+        f.write(line)
+
+        guard_rows_iter = iter(guard_rows)
+        while True:
+            batch = list(itertools.islice(guard_rows_iter, OUTPUT_BATCH_ROWS))
+            if not batch:
+                break
 
-        with open(output_fname, 'w+') as f:
-            f_str = ""
+            chunk = "".join(format_guard_lines(batch, consensuses_read_n))
+            digest.update(chunk)
+            f.write(chunk)
 
-            f_str += "guardfraction-file-version 1\n"
-            f_str += "written-at %s\n" % now.isoformat(sep=" ") # separate year from time with space
-            f_str += "n-inputs %d %d %d\n" % (consensuses_read_n, max_days, max_days*24)
+        if digest.hexdigest() == old_digest:
+            raise DiscardFile()
 
-            sorted_guards = sorted(self.guards.values(), key=lambda x: x.times_seen, reverse=True)
+        return digest.hexdigest()
 
-            for guard in sorted_guards:
-                f_str += "guard-seen %s %d %d\n" % (guard.fingerprint,
-                        self._get_guard_guardfraction_percentage(guard, consensuses_read_n),
-                        guard.times_seen)
+    new_digest = _write_file_atomically(output_fname, write_guards)
+    if new_digest is None:
+        logging.info("Guard data unchanged. Only touching %s.", output_fname)
+        os.utime(output_fname, None)
+        return False
 
-            f.write(f_str)
+    _write_file_atomically(output_fname + DIGEST_SUFFIX,
+                           lambda f: f.write(new_digest + "\n"))
+    return True
@@ -0,0 +1,121 @@
+import collections
+import datetime
+
+import guardiness.sqlite_db as sqlite_db
+
+"""This file answers questions about the guard history of single relays"""
+
+def get_relay_ids(db_cursor, fingerprints):
+    """
+    Return a dict mapping each of the hex 'fingerprints' that we know
+    of to its relay_id.
+    """
+    relay_ids = {}
+    for fingerprint in fingerprints:
+        db_cursor.execute("SELECT relay_id FROM relay WHERE identity = ?", (sqlite_db.pack_identity(fingerprint),))
+        row = db_cursor.fetchone()
+        if row:
+            relay_ids[fingerprint] = row[0]
+
+    return relay_ids
+
+def _iter_intervals(db_cursor, relay_id, start_hour, end_hour):
+    """
+    Yield the (start hour, end hour) guard intervals of 'relay_id' that
+    overlap with 'start_hour' up to 'end_hour', cut down to them.
+    """
+    # Intervals don't overlap, so only the one before 'start_hour' can
+    # reach into our window from before it.
+    db_cursor.execute("SELECT start_hour, end_hour FROM guard_interval "
+                      "WHERE relay_id = ? AND start_hour < ? ORDER BY start_hour DESC LIMIT 1",
+                      (relay_id, start_hour))
+    rows = db_cursor.fetchall()
+    db_cursor.execute("SELECT start_hour, end_hour FROM guard_interval "
+                      "WHERE relay_id = ? AND start_hour >= ? AND start_hour < ? ORDER BY start_hour",
+                      (relay_id, start_hour, end_hour))
+    rows.extend(db_cursor.fetchall())
+
+    for interval_start, interval_end in rows:
+        if interval_end > start_hour:
+            yield max(interval_start, start_hour), min(interval_end, end_hour)
+
+def _get_history_end(db_cursor, end_hour):
+    """
+    Cut 'end_hour' down to the hour after the newest consensus, where
+    the open guard intervals end for now.
+    """
+    newest_hour = sqlite_db.get_newest_consensus_hour(db_cursor)
+    if newest_hour is None:
+        return sqlite_db.MIN_HOUR
+    return min(end_hour, newest_hour + 1)
+
+def get_guard_intervals(db_cursor, fingerprints, start_hour=sqlite_db.MIN_HOUR, end_hour=sqlite_db.MAX_HOUR):
+    """
+    Find when the relays with 'fingerprints' were guards, between
+    'start_hour' and 'end_hour'.
+
+    Return a dict mapping each fingerprint to a list of (first hour,
+    last hour) datetime tuples, oldest first: the relay was a guard in
+    all the consensuses of each of those hours. Missing consensuses
+    split an interval in two. Relays that we never saw as guards get
+    an empty list.
+    """
+    relay_ids = get_relay_ids(db_cursor, fingerprints)
+    end_hour = _get_history_end(db_cursor, end_hour)
+
+    guard_intervals = {}
+    for fingerprint in fingerprints:
+        if fingerprint not in relay_ids:
+            guard_intervals[fingerprint] = []
+            continue
+
+        guard_intervals[fingerprint] = [
+            (sqlite_db.hour_to_datetime(interval_start), sqlite_db.hour_to_datetime(interval_end - 1))
+            for interval_start, interval_end in _iter_intervals(db_cursor, relay_ids[fingerprint],
+                                                                start_hour, end_hour)]
+
+    return guard_intervals
+
+def get_daily_consensus_counts(db_cursor, start_hour, end_hour):
+    """
+    Return a dict mapping each day (as a number of days since the
+    epoch) to the number of consensuses that we have for it, between
+    'start_hour' and 'end_hour'.
+    """
+    db_cursor.execute("SELECT consensus_hour / 24, count(*) FROM consensus "
+                      "WHERE consensus_hour >= ? AND consensus_hour < ? GROUP BY consensus_hour / 24",
+                      (start_hour, end_hour))
+    return dict((row[0], row[1]) for row in db_cursor.fetchall())
+
+def get_daily_guardfraction(db_cursor, fingerprints, start_hour, end_hour):
+    """
+    Calculate the guardfraction of each day between 'start_hour' and
+    'end_hour' for the relays with 'fingerprints': the fraction of
+    the consensuses of that day that the relay was a guard in.
+
+    Return a dict mapping each fingerprint to a list of (date,
+    guardfraction) tuples, one for every day that we have consensuses
+    for, oldest first.
+    """
+    consensus_counts = get_daily_consensus_counts(db_cursor, start_hour, end_hour)
+    relay_ids = get_relay_ids(db_cursor, fingerprints)
+    end_hour = _get_history_end(db_cursor, end_hour)
+
+    daily_guardfraction = {}
+    for fingerprint in fingerprints:
+        # Maps a <day> to the <number of consensuses> of the day that
+        # the relay was a guard in.
+        guard_hours = collections.Counter()
+        if fingerprint in relay_ids:
+            for interval_start, interval_end in _iter_intervals(db_cursor, relay_ids[fingerprint],
+                                                                start_hour, end_hour):
+                # Intervals only cover hours that we have consensuses for.
+                for day in xrange(interval_start // 24, (interval_end - 1) // 24 + 1):
+                    guard_hours[day] += min(interval_end, (day + 1) * 24) - max(interval_start, day * 24)
+
+        daily_guardfraction[fingerprint] = [
+            ((sqlite_db.EPOCH + datetime.timedelta(days=day)).date(),
+             guard_hours[day] / float(consensus_counts[day]))
+            for day in sorted(consensus_counts)]
+
+    return daily_guardfraction
@@ -0,0 +1,177 @@
+import logging
+import datetime
+import collections
+import gzip
+
+import guardiness.guard_ds as guard_ds
+import guardiness.sqlite_db as sqlite_db
+import guardiness.stats as stats
+
+"""This file replays the guardfraction that would have been published over a stretch of history"""
+
+# A replay file has a header, and then a block for each point in time
+# that we replay, oldest first:
+#
+#   guardfraction-replay-version 1
+#   window-days <max days> step-hours <hours between blocks> format <snapshots|diffs>
+#   as-of <date and time> n-inputs <number of consensuses> <number of days considered> <ideal number of consensuses>
+#   guard-seen <guard fpr> <guardfraction percentage> <number of consensus appearances>
+#   ...
+#   guard-gone <guard fpr>
+#   ...
+#
+# In 'snapshots' format each block lists all the guards of its window,
+# like the guardfraction output file, most seen guards first. In
+# 'diffs' format only the first block does; the rest only list the
+# guards whose line changed since the previous block, and the guards
+# that left the window with a guard-gone line.
+REPLAY_VERSION = 1
+
+def get_window_bounds(db_cursor, max_days, as_of):
+    """
+    Return the (start hour, end hour) of the window that guardfraction
+    would have looked at if it was run at 'as_of': the consensuses of
+    the past 'max_days', up to and including the hour of 'as_of'.
+    """
+    return (sqlite_db.get_window_start(db_cursor, max_days, as_of),
+            sqlite_db.datetime_to_hour(as_of) + 1)
+
+def iter_replay_windows(db_conn, db_cursor, max_days, first_as_of, last_as_of, step_hours):
+    """
+    Slide a window of 'max_days' across history, from 'first_as_of' up
+    to 'last_as_of', 'step_hours' at a time.
+
+    For each step, yield a (as_of, consensuses_read_n, times_seen_counter,
+    changed_relay_ids) tuple. 'times_seen_counter' maps each <relay_id>
+    of the window to its <times seen>, and is updated in place at every
+    step. 'changed_relay_ids' is the set of the relay_ids whose counts
+    might have changed since the previous step, or None if the window
+    was counted from scratch.
+
+    Each step only reads the consensuses that entered the window and
+    the ones that left it since the previous step.
+    """
+    times_seen_counter = collections.Counter()
+    consensuses_read_n = 0
+    window_start = window_end = None
+
+    as_of = first_as_of
+    while as_of <= last_as_of:
+        new_start, new_end = get_window_bounds(db_cursor, max_days, as_of)
+
+        with stats.timer("replay_slide"):
+            if window_end is None or new_start >= window_end:
+                # Steps longer than the window: nothing to carry over.
+                times_seen_counter = sqlite_db.count_window_guardsets(db_conn, new_start, new_end)
+                consensuses_read_n = sqlite_db.count_range_consensuses(db_cursor, new_start, new_end)
+                changed_relay_ids = None
+            else:
+                added_counter = sqlite_db.count_window_guardsets(db_conn, window_end, new_end)
+                removed_counter = sqlite_db.count_window_guardsets(db_conn, window_start, new_start)
+
+                times_seen_counter.update(added_counter)
+                times_seen_counter.subtract(removed_counter)
+                for relay_id in removed_counter:
+                    if times_seen_counter[relay_id] <= 0:
+                        del times_seen_counter[relay_id]
+
+                consensuses_read_n += (sqlite_db.count_range_consensuses(db_cursor, window_end, new_end) -
+                                       sqlite_db.count_range_consensuses(db_cursor, window_start, new_start))
+                changed_relay_ids = set(added_counter)
+                changed_relay_ids.update(removed_counter)
+
+        window_start, window_end = new_start, new_end
+        stats.count("replay_steps")
+
+        yield as_of, consensuses_read_n, times_seen_counter, changed_relay_ids
+
+        as_of += datetime.timedelta(hours=step_hours)
+
+def write_replay_file(db_conn, db_cursor, max_days, first_as_of, last_as_of, step_hours, replay_fname,
+                      diffs=False):
+    """
+    Replay the guardfraction of the past 'max_days' that would have
+    been published every 'step_hours' from 'first_as_of' up to
+    'last_as_of', and write it to a replay file at 'replay_fname'
+    (gzipped if its name ends in '.gz'). If 'diffs' is set, only
+    write the guards that changed from one step to the next.
+
+    Return the number of steps written.
+
+    Might raise IOError.
+    """
+    # Maps a <relay_id> to its <fingerprint>, for all the relays we
+    # have written about so far.
+    identities = {}
+    # Maps a <relay_id> to the <guard-seen line> that we last wrote for
+    # it. Only kept for diffs.
+    previous_lines = {}
+    previous_consensuses_read_n = None
+    steps_n = 0
+
+    if replay_fname.endswith(".gz"):
+        # zlib's default level: level 9 is much slower for little gain.
+        replay_fd = gzip.open(replay_fname, "wb", 6)
+    else:
+        replay_fd = open(replay_fname, "wb")
+
+    with replay_fd:
+        replay_fd.write("guardfraction-replay-version %d\n" % REPLAY_VERSION)
+        replay_fd.write("window-days %d step-hours %d format %s\n" %
+                        (max_days, step_hours, "diffs" if diffs else "snapshots"))
+
+        for as_of, consensuses_read_n, times_seen_counter, changed_relay_ids in iter_replay_windows(
+                db_conn, db_cursor, max_days, first_as_of, last_as_of, step_hours):
+            with stats.timer("replay_output"):
+                # Percentages only move for the guards whose counts
+                # changed, unless the number of consensuses did.
+                if not diffs:
+                    relay_ids = set(times_seen_counter)
+                elif changed_relay_ids is None or consensuses_read_n != previous_consensuses_read_n:
+                    relay_ids = set(times_seen_counter)
+                    relay_ids.update(previous_lines)
+                else:
+                    relay_ids = changed_relay_ids
+
+                missing_identities = [relay_id for relay_id in relay_ids if relay_id not in identities]
+                if missing_identities:
+                    identities.update(sqlite_db.get_relay_identities(db_cursor, missing_identities))
+
+                # Write each block in one go: gzip is slow with small writes.
+                block = ["as-of %s n-inputs %d %d %d\n" %
+                         (as_of.isoformat(sep=" "), consensuses_read_n, max_days, max_days*24)]
+
+                seen_relay_ids = []
+                guard_rows = []
+                gone_relay_ids = []
+                for relay_id in sorted(relay_ids, key=lambda relay_id: (-times_seen_counter[relay_id], relay_id)):
+                    times_seen = times_seen_counter[relay_id]
+                    if not times_seen:
+                        gone_relay_ids.append(relay_id)
+                        continue
+
+                    seen_relay_ids.append(relay_id)
+                    guard_rows.append((identities[relay_id], times_seen))
+
+                lines = guard_ds.format_guard_lines(guard_rows, consensuses_read_n)
+                if not diffs:
+                    block.extend(lines)
+                else:
+                    for relay_id, line in zip(seen_relay_ids, lines):
+                        if previous_lines.get(relay_id) == line:
+                            continue
+                        previous_lines[relay_id] = line
+                        block.append(line)
+
+                for relay_id in gone_relay_ids:
+                    if relay_id in previous_lines:
+                        del previous_lines[relay_id]
+                        block.append("guard-gone %s\n" % identities[relay_id])
+
+                replay_fd.write("".join(block))
+
+            previous_consensuses_read_n = consensuses_read_n
+            steps_n += 1
+
+    logging.info("Replayed %d steps from %s to %s into %s.", steps_n, first_as_of, last_as_of, replay_fname)
+    return steps_n
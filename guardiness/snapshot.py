@@ -0,0 +1,209 @@
+import logging
+import sqlite3
+import array
+import hashlib
+import sys
+import zlib
+
+import guardiness.sqlite_db as sqlite_db
+import guardiness.stats as stats
+
+"""This file exports and loads snapshots of the guard history of a database"""
+
+# A snapshot is a header line followed by a zlib-compressed payload:
+#
+#   guardiness-snapshot <version> <sha256 of the compressed payload>\n
+#
+# The payload is a series of columns, all of little-endian 32-bit
+# integers except for the fingerprint dictionary:
+#
+#   counts:     <relays_n> <consensuses_n> <guards_n>
+#   dictionary: <relays_n> 20-byte relay identity digests
+#   hours:      <consensuses_n> consensus hours, oldest first, each
+#               stored as the difference from the previous one
+#   lengths:    <consensuses_n> numbers of guards per consensus
+#   guards:     <guards_n> dictionary indices, the guards of each
+#               consensus in turn, sorted
+SNAPSHOT_MAGIC = "guardiness-snapshot"
+SNAPSHOT_VERSION = 1
+IDENTITY_LEN = 20
+
+class SnapshotError(Exception): pass
+
+def _pack_uint32s(values):
+    """Pack 'values' into a string of little-endian 32-bit integers."""
+    values_array = array.array('I', values)
+    if sys.byteorder == 'big':
+        values_array.byteswap()
+    return values_array.tostring()
+
+def _unpack_uint32s(payload, offset, n):
+    """
+    Unpack 'n' little-endian 32-bit integers from 'payload' at
+    'offset'. Return them as an array, and the offset after them.
+    """
+    end = offset + 4*n
+    if end > len(payload):
+        raise SnapshotError("Snapshot payload is truncated")
+
+    values_array = array.array('I')
+    values_array.fromstring(payload[offset:end])
+    if sys.byteorder == 'big':
+        values_array.byteswap()
+    return values_array, end
+
+def export_snapshot(db_conn, db_cursor, snapshot_fname):
+    """
+    Write the guard history of the database at 'db_cursor' to a
+    snapshot at 'snapshot_fname'. Return the number of consensuses
+    in the snapshot.
+    """
+    # The fingerprint dictionary, in relay_id order.
+    db_cursor.execute("SELECT relay_id, identity FROM relay ORDER BY relay_id")
+    relay_rows = db_cursor.fetchall()
+    # Maps a <relay_id> to its <index in the dictionary>.
+    relay_indices = dict((row[0], i) for i, row in enumerate(relay_rows))
+
+    hours = []
+    lengths = []
+    guards = array.array('I')
+    for partition in sqlite_db.get_guardset_partitions(db_conn):
+        for row in db_conn.execute("SELECT consensus.consensus_hour, guardset.relay_ids FROM consensus "
+                                   "JOIN %s AS guardset ON guardset.consensus_id = consensus.consensus_id "
+                                   "ORDER BY consensus.consensus_hour" % partition):
+            relay_ids = sqlite_db.unpack_relay_ids(row[1])
+            hours.append(row[0])
+            lengths.append(len(relay_ids))
+            guards.extend(sorted(relay_indices[relay_id] for relay_id in relay_ids))
+
+    hour_deltas = [hour - previous for hour, previous in zip(hours, [0] + hours[:-1])]
+
+    payload = zlib.compress("".join([
+        _pack_uint32s([len(relay_rows), len(hours), len(guards)]),
+        "".join(str(row[1]) for row in relay_rows),
+        _pack_uint32s(hour_deltas),
+        _pack_uint32s(lengths),
+        _pack_uint32s(guards),
+    ]), 9)
+
+    with open(snapshot_fname, "wb") as snapshot_fd:
+        snapshot_fd.write("%s %d %s\n" % (SNAPSHOT_MAGIC, SNAPSHOT_VERSION, hashlib.sha256(payload).hexdigest()))
+        snapshot_fd.write(payload)
+
+    logging.info("Exported %d consensuses and %d relays to %s.", len(hours), len(relay_rows), snapshot_fname)
+    return len(hours)
+
+def read_snapshot(snapshot_fname):
+    """
+    Read and check the snapshot at 'snapshot_fname'.
+
+    Return a (identities, consensuses) tuple: 'identities' is the list
+    of relay identity digests of the snapshot, and 'consensuses' is a
+    list of (consensus_hour, array of guard indices into 'identities')
+    tuples, oldest first.
+
+    Raise SnapshotError if the snapshot is not one of ours or if it
+    is corrupt.
+    """
+    with open(snapshot_fname, "rb") as snapshot_fd:
+        header = snapshot_fd.readline().split()
+        payload = snapshot_fd.read()
+
+    if len(header) != 3 or header[0] != SNAPSHOT_MAGIC:
+        raise SnapshotError("%s is not a guardiness snapshot" % snapshot_fname)
+    if header[1] != str(SNAPSHOT_VERSION):
+        raise SnapshotError("Unsupported snapshot version %s" % header[1])
+    if hashlib.sha256(payload).hexdigest() != header[2]:
+        raise SnapshotError("Snapshot checksum mismatch")
+
+    try:
+        payload = zlib.decompress(payload)
+    except zlib.error, err:
+        raise SnapshotError("Snapshot payload is corrupt (%s)" % err)
+
+    (relays_n, consensuses_n, guards_n), offset = _unpack_uint32s(payload, 0, 3)
+
+    identities = [payload[i:i+IDENTITY_LEN]
+                  for i in xrange(offset, offset + relays_n*IDENTITY_LEN, IDENTITY_LEN)]
+    offset += relays_n*IDENTITY_LEN
+
+    hour_deltas, offset = _unpack_uint32s(payload, offset, consensuses_n)
+    lengths, offset = _unpack_uint32s(payload, offset, consensuses_n)
+    guards, offset = _unpack_uint32s(payload, offset, guards_n)
+
+    if offset != len(payload) or sum(lengths) != guards_n or (guards and max(guards) >= relays_n):
+        raise SnapshotError("Snapshot columns don't add up")
+
+    consensuses = []
+    hour = 0
+    start = 0
+    for hour_delta, length in zip(hour_deltas, lengths):
+        hour += hour_delta
+        consensuses.append((hour, guards[start:start+length]))
+        start += length
+
+    return identities, consensuses
+
+def load_snapshot(db_conn, db_cursor, snapshot_fname):
+    """
+    Bulk load the snapshot at 'snapshot_fname' to the database at
+    'db_cursor', in a single transaction that is left open. Consensuses
+    that are already in the database are left alone.
+
+    Check the loaded consensuses, and then either call
+    commit_snapshot() or roll back with db_conn.rollback().
+
+    Return the sorted list of the consensus hours loaded.
+    """
+    with stats.timer("snapshot_read"):
+        identities, consensuses = read_snapshot(snapshot_fname)
+
+    imported_hours = sqlite_db.get_consensus_hours(db_cursor)
+    consensuses = [(hour, guards) for hour, guards in consensuses if hour not in imported_hours]
+    if not consensuses:
+        logging.info("Nothing new in snapshot %s.", snapshot_fname)
+        return []
+
+    # Run in an explicit transaction, so that sqlite3 doesn't commit
+    # behind our back when we create partitions, and a rollback takes
+    # them back along with everything else.
+    isolation_level = db_conn.isolation_level
+    db_conn.isolation_level = None
+
+    try:
+        db_conn.execute("BEGIN")
+        with stats.timer("snapshot_load"):
+            partitions = dict((hour, sqlite_db.get_guardset_partition(db_cursor, hour))
+                              for hour in set(hour for hour, _ in consensuses))
+
+            db_cursor.executemany("INSERT OR IGNORE INTO relay (identity) VALUES (?)",
+                                  [(sqlite3.Binary(identity),) for identity in identities])
+            db_cursor.execute("SELECT identity, relay_id FROM relay")
+            relay_ids_by_identity = dict((str(row[0]), row[1]) for row in db_cursor.fetchall())
+            relay_ids = [relay_ids_by_identity[identity] for identity in identities]
+
+            for hour, guards in consensuses:
+                db_cursor.execute("INSERT INTO consensus (consensus_hour) VALUES (?)", (hour,))
+                db_cursor.execute("INSERT INTO %s (consensus_id,relay_ids) VALUES (?,?)" % partitions[hour],
+                                  (db_cursor.lastrowid, sqlite_db.pack_relay_ids(relay_ids[i] for i in guards)))
+    except sqlite3.Error:
+        db_conn.execute("ROLLBACK")
+        raise
+    finally:
+        db_conn.isolation_level = isolation_level
+
+    stats.count("snapshot_consensuses_loaded", len(consensuses))
+    logging.info("Loaded %d consensuses from snapshot %s.", len(consensuses), snapshot_fname)
+    return sorted(hour for hour, _ in consensuses)
+
+def commit_snapshot(db_conn, db_cursor):
+    """
+    Commit a snapshot loaded by load_snapshot(). The guard intervals,
+    running guard counters and decayed scores are recomputed from
+    scratch afterwards, if the database keeps them.
+    """
+    with stats.timer("commit"):
+        db_conn.commit()
+
+    with stats.timer("guard_stats_rebuild"):
+        sqlite_db.rebuild_guard_stats(db_conn, db_cursor)
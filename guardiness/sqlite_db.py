@@ -1,20 +1,1123 @@
 import sqlite3
 import sys
 import logging
+import heapq
+import array
+import zlib
+import collections
+import datetime
+import binascii
 
-def init_db(db_filename, schema_filename=None):
+import guardiness.stats as stats
+
+# Version of the database schema in db_schema.sql. Kept in the
+# database's user_version so that we know when to migrate old databases.
+SCHEMA_VERSION = 9
+
+# The queries over the consensuses of a window. They are all meant to
+# be served by a range search over the consensus_hour index (which
+# also covers consensus_id), plus primary key lookups in a guardset
+# partition. The guardset query takes the name of the partition table
+# as its format argument, and gets run once for each partition that
+# overlaps with the window, with the window cut down to the hours of
+# the partition. CROSS JOIN keeps sqlite from scanning the partition
+# instead.
+# test_guardfraction.py checks their query plans.
+WINDOW_CONSENSUS_COUNT_SQL = ("SELECT count(*) FROM consensus "
+                              "WHERE consensus.consensus_hour >= ?")
+RANGE_CONSENSUS_COUNT_SQL = ("SELECT count(*) FROM consensus "
+                             "WHERE consensus.consensus_hour >= ? AND consensus.consensus_hour < ?")
+PARTITION_GUARDSETS_SQL = ("SELECT guardset.relay_ids FROM consensus "
+                           "CROSS JOIN %s AS guardset ON guardset.consensus_id = consensus.consensus_id "
+                           "WHERE consensus.consensus_hour >= ? AND consensus.consensus_hour < ?")
+# The gaps of more than an hour between two consecutive consensuses of
+# a window: the hour of the consensus before each gap and of the one
+# after it.
+WINDOW_GAPS_SQL = ("SELECT consensus_hour, next_hour FROM ("
+                   " SELECT consensus.consensus_hour,"
+                   " lead(consensus.consensus_hour) OVER (ORDER BY consensus.consensus_hour) AS next_hour"
+                   " FROM consensus WHERE consensus.consensus_hour >= ?) "
+                   "WHERE next_hour > consensus_hour + 1")
+# The same without window functions, which sqlite only has since 3.25:
+# the consensuses without one an hour later, and the next consensus
+# after each of them.
+WINDOW_GAPS_COMPAT_SQL = ("SELECT consensus_hour, next_hour FROM ("
+                          " SELECT consensus.consensus_hour,"
+                          " (SELECT min(later.consensus_hour) FROM consensus AS later"
+                          "  WHERE later.consensus_hour > consensus.consensus_hour) AS next_hour"
+                          " FROM consensus WHERE consensus.consensus_hour >= ? AND NOT EXISTS"
+                          " (SELECT 1 FROM consensus AS later WHERE later.consensus_hour = consensus.consensus_hour + 1)) "
+                          "WHERE next_hour IS NOT NULL")
+HAVE_WINDOW_FUNCTIONS = sqlite3.sqlite_version_info >= (3, 25, 0)
+WINDOW_EDGES_SQL = ("SELECT min(consensus.consensus_hour), max(consensus.consensus_hour) FROM consensus "
+                    "WHERE consensus.consensus_hour >= ?")
+
+# Connection profiles for init_db(). Each one maps pragma names to the
+# values we set on the connection. 'busy_timeout' is how long to wait
+# for other connections to let go of the database, in milliseconds.
+CONNECTION_PROFILES = {
+    # sqlite defaults, but for waiting as long as for imports.
+    "default" : [("busy_timeout", 900*1000)],
+
+    # For bulk imports and anything else that writes. Write-ahead
+    # logging lets readers carry on while we write (and the other
+    # way around), and only syncs the log at checkpoints. Waits out
+    # long imports and migrations of other processes.
+    "import" : [("busy_timeout", 900*1000),
+                ("journal_mode", "WAL"),
+                ("synchronous", "NORMAL"),
+                ("cache_size", -64000), # in KiB
+                ("mmap_size", 256*1024*1024),
+                ("temp_store", "MEMORY")],
+
+    # For reading the database to calculate guardfraction. Refuses to
+    # write to the database. Sorts bigger than the cache spill to temp
+    # files, so that streaming guards out in order stays flat in memory.
+    # Gives up quickly instead of piling up behind a stuck writer.
+    "aggregate" : [("busy_timeout", 30*1000),
+                   ("cache_size", -64000), # in KiB
+                   ("mmap_size", 256*1024*1024),
+                   ("temp_store", "FILE"),
+                   ("query_only", "ON")],
+}
+
+# Consensuses are stored by the hour since the epoch that they were
+# valid after.
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def datetime_to_hour(date):
+    """Return the hour since the epoch of the UTC datetime 'date', rounded down."""
+    delta = date - EPOCH
+    return delta.days * 24 + delta.seconds // (60*60)
+
+def hour_to_datetime(hour):
+    """Return the UTC datetime of the hour since the epoch 'hour'."""
+    return EPOCH + datetime.timedelta(hours=hour)
+
+def pack_identity(fingerprint):
+    """Pack the hex 'fingerprint' of a relay into the 20 bytes that we store."""
+    return sqlite3.Binary(binascii.a2b_hex(fingerprint))
+
+def unpack_identity(blob):
+    """Unpack a blob made by pack_identity() back to a hex fingerprint."""
+    return binascii.b2a_hex(blob).upper()
+
+def pack_relay_ids(relay_ids):
+    """
+    Pack a list of relay_ids into a compact blob that can be stored in
+    the guardset table.
+
+    The blob is a zlib-compressed array of sorted little-endian 32-bit
+    integers.
+    """
+    relay_ids_array = array.array('I', sorted(relay_ids))
+    if sys.byteorder == 'big':
+        relay_ids_array.byteswap()
+
+    return sqlite3.Binary(zlib.compress(relay_ids_array.tostring()))
+
+def unpack_relay_ids(blob):
+    """Unpack a blob made by pack_relay_ids() back to an array of relay_ids."""
+    relay_ids_array = array.array('I')
+    relay_ids_array.fromstring(zlib.decompress(blob))
+    if sys.byteorder == 'big':
+        relay_ids_array.byteswap()
+
+    return relay_ids_array
+
+# The guardsets are split into one table per month of consensuses,
+# named after the month, so that old consensuses can be thrown away
+# a whole table at a time. The guardset_partition table keeps track
+# of them.
+GUARDSET_PARTITION_FORMAT = "guardset_%04d_%02d"
+GUARDSET_PARTITION_SCHEMA = ("CREATE TABLE IF NOT EXISTS %s ("
+                             " consensus_id INTEGER PRIMARY KEY REFERENCES consensus(consensus_id) ON DELETE CASCADE,"
+                             " relay_ids BLOB NOT NULL)")
+
+def _get_month_partition(year, month):
+    """
+    Return the name of the guardset partition of the consensuses of
+    'month' of 'year', and the datetimes that it starts and ends at.
+    """
+    start = datetime.datetime(year, month, 1)
+    end = datetime.datetime(year + month // 12, month % 12 + 1, 1)
+
+    return GUARDSET_PARTITION_FORMAT % (year, month), start, end
+
+def _get_partition_bounds(consensus_hour):
+    """
+    Return the name of the guardset partition of the consensuses from
+    'consensus_hour', and the hours that it starts and ends at.
+    """
+    consensus_date = hour_to_datetime(consensus_hour)
+    partition, start, end = _get_month_partition(consensus_date.year, consensus_date.month)
+
+    return partition, datetime_to_hour(start), datetime_to_hour(end)
+
+def _create_partition(db_cursor, partition, start, end):
+    """Create the guardset 'partition' table and register it."""
+    db_cursor.execute(GUARDSET_PARTITION_SCHEMA % partition)
+    db_cursor.execute("INSERT OR IGNORE INTO guardset_partition (name, start_hour, end_hour) VALUES (?,?,?)",
+                      (partition, start, end))
+
+def get_guardset_partition(db_cursor, consensus_hour):
+    """
+    Return the name of the guardset partition that the consensus from
+    'consensus_hour' belongs to, and create it if it doesn't exist yet.
+
+    Creating a table makes sqlite3 commit the current transaction, so
+    call this before starting to import a consensus.
+    """
+    partition, start, end = _get_partition_bounds(consensus_hour)
+
+    db_cursor.execute("SELECT count(*) FROM guardset_partition WHERE name=?", (partition,))
+    if not db_cursor.fetchone()[0]:
+        logging.info("Creating guardset partition %s.", partition)
+        _create_partition(db_cursor, partition, start, end)
+
+    return partition
+
+# Consensus hours always fall between these two.
+MIN_HOUR = 0
+MAX_HOUR = 1 << 62
+
+def _get_window_partitions(db_conn, window_start, window_end):
+    """
+    Return a (name, start, end) tuple for each guardset partition
+    with consensuses from 'window_start' up to 'window_end', oldest
+    first. The window is cut down to the hours that the partition
+    covers.
+    """
+    db_rows = db_conn.execute("SELECT name, start_hour, end_hour FROM guardset_partition "
+                              "WHERE end_hour > ? AND start_hour < ? ORDER BY start_hour",
+                              (window_start, window_end)).fetchall()
+
+    return [(row[0], max(row[1], window_start), min(row[2], window_end)) for row in db_rows]
+
+def get_guardset_partitions(db_conn, window_start=None, window_end=None):
+    """
+    Return the names of the guardset partitions, oldest first. If
+    'window_start' or 'window_end' are set, only return the partitions
+    with consensuses from 'window_start' up to 'window_end'.
+    """
+    return [partition for partition, _, _ in
+            _get_window_partitions(db_conn, window_start or MIN_HOUR, window_end or MAX_HOUR)]
+
+def insert_guardset(db_cursor, consensus_id, consensus_hour, relay_ids):
+    """
+    Store the guards with 'relay_ids' of the consensus with
+    'consensus_id' from 'consensus_hour' in its guardset partition.
+    """
+    partition = get_guardset_partition(db_cursor, consensus_hour)
+    db_cursor.execute("INSERT INTO %s (consensus_id,relay_ids) VALUES (?,?)" % partition,
+                      (consensus_id, pack_relay_ids(relay_ids)))
+
+def drop_expired_consensuses(db_conn, window_start):
+    """
+    Delete the consensuses from before 'window_start', along with
+    their guardsets, and commit.
+
+    Partitions that are all before 'window_start' are dropped as a
+    whole, so only the consensuses of the partition that the window
+    starts in get deleted one by one.
+    """
+    # Run in an explicit transaction, so that sqlite3 doesn't commit
+    # behind our back when it sees DROP TABLE.
+    isolation_level = db_conn.isolation_level
+    db_conn.isolation_level = None
+
+    try:
+        db_conn.execute("BEGIN")
+        expired_partitions = [row[0] for row in db_conn.execute(
+            "SELECT name FROM guardset_partition WHERE end_hour <= ?", (window_start,)).fetchall()]
+        for partition in expired_partitions:
+            logging.info("Dropping expired guardset partition %s.", partition)
+            db_conn.execute("DROP TABLE %s" % partition)
+        db_conn.execute("DELETE FROM guardset_partition WHERE end_hour <= ?", (window_start,))
+        db_conn.execute("DELETE FROM consensus WHERE consensus_hour < ?", (window_start,))
+        # Forget about the guard intervals of the deleted consensuses.
+        db_conn.execute("DELETE FROM guard_interval WHERE end_hour <= ?", (window_start,))
+        db_conn.execute("UPDATE guard_interval SET start_hour = ? WHERE start_hour < ?", (window_start, window_start))
+        db_conn.execute("COMMIT")
+    except sqlite3.Error:
+        db_conn.execute("ROLLBACK")
+        raise
+    finally:
+        db_conn.isolation_level = isolation_level
+
+    # Give the pages of the dropped partitions back to the filesystem.
+    # The pragma frees a page per step, so step it to the end.
+    if expired_partitions:
+        db_conn.execute("PRAGMA incremental_vacuum").fetchall()
+
+def _migrate_v1_to_v2(db_conn):
+    """
+    Move from one guarddata row per guard per consensus, to a single
+    guardset row per consensus with the packed relay_ids of its guards.
+    """
+    db_cursor = db_conn.cursor()
+
+    db_cursor.execute("CREATE TABLE guardset ("
+                      " consensus_id INTEGER PRIMARY KEY REFERENCES consensus(consensus_id) ON DELETE CASCADE,"
+                      " relay_ids BLOB NOT NULL)")
+
+    consensus_ids = [row[0] for row in
+                     db_cursor.execute("SELECT consensus_id FROM consensus").fetchall()]
+
+    for consensus_id in consensus_ids:
+        db_cursor.execute("SELECT relay_id FROM guarddata WHERE consensus_id=?", (consensus_id,))
+        relay_ids = [row[0] for row in db_cursor.fetchall()]
+        db_cursor.execute("INSERT INTO guardset (consensus_id, relay_ids) VALUES (?,?)",
+                          (consensus_id, pack_relay_ids(relay_ids)))
+
+    db_cursor.execute("DROP TABLE guarddata")
+
+def _migrate_v2_to_v3(db_conn):
+    """
+    Add the running guard counters. They start out empty and get
+    filled the next time guardfraction.py runs.
+    """
+    db_conn.execute("CREATE TABLE guard_count ("
+                    " relay_id INTEGER PRIMARY KEY REFERENCES relay(relay_id),"
+                    " times_seen INTEGER NOT NULL)")
+    db_conn.execute("CREATE TABLE guard_count_window ("
+                    " max_days INTEGER NOT NULL,"
+                    " window_start DATETIME NOT NULL)")
+
+def _migrate_v3_to_v4(db_conn):
+    """
+    Drop the consensus_date index. It duplicates the index behind
+    UNIQUE(consensus_date) and only slowed down imports.
+    """
+    db_conn.execute("DROP INDEX IF EXISTS consensus_consensus_date_idx")
+
+def _migrate_v4_to_v5(db_conn):
+    """
+    Split the guardset table into monthly partitions, so that expiring
+    old consensuses doesn't mean deleting their guardsets one by one.
+    """
+    db_conn.execute("CREATE TABLE guardset_partition ("
+                    " name TEXT PRIMARY KEY,"
+                    " start_date DATETIME NOT NULL,"
+                    " end_date DATETIME NOT NULL)")
+
+    months = [row[0] for row in db_conn.execute(
+        "SELECT DISTINCT substr(consensus_date, 1, 7) FROM consensus").fetchall()]
+
+    for month in months:
+        partition, start, end = _get_month_partition(int(month[0:4]), int(month[5:7]))
+        start, end = str(start), str(end)
+        db_conn.execute(GUARDSET_PARTITION_SCHEMA % partition)
+        db_conn.execute("INSERT INTO guardset_partition (name, start_date, end_date) VALUES (?,?,?)",
+                        (partition, start, end))
+        db_conn.execute("INSERT INTO %s (consensus_id, relay_ids) "
+                        "SELECT guardset.consensus_id, guardset.relay_ids FROM consensus "
+                        "JOIN guardset ON guardset.consensus_id = consensus.consensus_id "
+                        "WHERE consensus.consensus_date >= ? AND consensus.consensus_date < ?" % partition,
+                        (start, end))
+
+    db_conn.execute("DROP TABLE guardset")
+
+def _migrate_v5_to_v6(db_conn):
+    """
+    Add the decayed guard scores. They start out empty and get filled
+    the next time databaser.py runs with --decay-half-life-days.
+    """
+    db_conn.execute("CREATE TABLE guard_decay ("
+                    " relay_id INTEGER PRIMARY KEY REFERENCES relay(relay_id),"
+                    " score REAL NOT NULL)")
+    db_conn.execute("CREATE TABLE guard_decay_state ("
+                    " half_life_days INTEGER NOT NULL,"
+                    " total REAL NOT NULL,"
+                    " last_date DATETIME)")
+
+# Turns a consensus_date or other DATETIME text column of the older
+# schemas into an hour since the epoch, rounding down.
+_DATE_TO_HOUR_SQL = "CAST(strftime('%%s', %s) AS INTEGER) / 3600"
+
+def _migrate_v6_to_v7(db_conn):
+    """
+    Store relay identities as 20 raw bytes instead of 40 hex digits,
+    and consensus dates as hours since the epoch instead of text.
+
+    migrate_db() turns foreign keys off, so that rebuilding the relay
+    and consensus tables doesn't cascade to the tables that point to
+    them.
+    """
+    db_conn.create_function("pack_identity", 1, pack_identity)
+
+    db_conn.execute("CREATE TABLE relay_v7 ("
+                    " relay_id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                    " identity BLOB NOT NULL,"
+                    " UNIQUE(identity))")
+    db_conn.execute("INSERT INTO relay_v7 (relay_id, identity) "
+                    "SELECT relay_id, pack_identity(identity) FROM relay")
+    db_conn.execute("DROP TABLE relay")
+    db_conn.execute("ALTER TABLE relay_v7 RENAME TO relay")
+
+    db_conn.execute("CREATE TABLE consensus_v7 ("
+                    " consensus_id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                    " consensus_hour INTEGER NOT NULL,"
+                    " UNIQUE(consensus_hour))")
+    db_conn.execute("INSERT INTO consensus_v7 (consensus_id, consensus_hour) "
+                    "SELECT consensus_id, %s FROM consensus" % (_DATE_TO_HOUR_SQL % "consensus_date"))
+    db_conn.execute("DROP TABLE consensus")
+    db_conn.execute("ALTER TABLE consensus_v7 RENAME TO consensus")
+
+    db_conn.execute("CREATE TABLE guardset_partition_v7 ("
+                    " name TEXT PRIMARY KEY,"
+                    " start_hour INTEGER NOT NULL,"
+                    " end_hour INTEGER NOT NULL)")
+    db_conn.execute("INSERT INTO guardset_partition_v7 (name, start_hour, end_hour) "
+                    "SELECT name, %s, %s FROM guardset_partition" %
+                    (_DATE_TO_HOUR_SQL % "start_date", _DATE_TO_HOUR_SQL % "end_date"))
+    db_conn.execute("DROP TABLE guardset_partition")
+    db_conn.execute("ALTER TABLE guardset_partition_v7 RENAME TO guardset_partition")
+
+    # The running counters count the consensuses from the first whole
+    # hour of their window.
+    db_conn.execute("CREATE TABLE guard_count_window_v7 ("
+                    " max_days INTEGER NOT NULL,"
+                    " window_start INTEGER NOT NULL)")
+    db_conn.execute("INSERT INTO guard_count_window_v7 (max_days, window_start) "
+                    "SELECT max_days, (CAST(strftime('%s', window_start) AS INTEGER) + 3599) / 3600 "
+                    "FROM guard_count_window")
+    db_conn.execute("DROP TABLE guard_count_window")
+    db_conn.execute("ALTER TABLE guard_count_window_v7 RENAME TO guard_count_window")
+
+    db_conn.execute("CREATE TABLE guard_decay_state_v7 ("
+                    " half_life_days INTEGER NOT NULL,"
+                    " total REAL NOT NULL,"
+                    " last_hour INTEGER)")
+    db_conn.execute("INSERT INTO guard_decay_state_v7 (half_life_days, total, last_hour) "
+                    "SELECT half_life_days, total, %s FROM guard_decay_state" % (_DATE_TO_HOUR_SQL % "last_date"))
+    db_conn.execute("DROP TABLE guard_decay_state")
+    db_conn.execute("ALTER TABLE guard_decay_state_v7 RENAME TO guard_decay_state")
+
+def _migrate_v7_to_v8(db_conn):
+    """Add the guard intervals, and fill them from the guardsets."""
+    for statement in GUARD_INTERVAL_SCHEMA:
+        db_conn.execute(statement)
+    _rebuild_guard_intervals(db_conn)
+
+def _migrate_v8_to_v9(db_conn):
+    """Leave the guard intervals that reach the newest consensus open."""
+    db_conn.execute("UPDATE guard_interval SET end_hour = ? "
+                    "WHERE end_hour = (SELECT max(consensus_hour) + 1 FROM consensus)", (OPEN_END_HOUR,))
+
+# Maps a <schema version> to the <function> that migrates a database
+# from that version to the next one.
+MIGRATIONS = {
+    1 : _migrate_v1_to_v2,
+    2 : _migrate_v2_to_v3,
+    3 : _migrate_v3_to_v4,
+    4 : _migrate_v4_to_v5,
+    5 : _migrate_v5_to_v6,
+    6 : _migrate_v6_to_v7,
+    7 : _migrate_v7_to_v8,
+    8 : _migrate_v8_to_v9,
+}
+
+def add_to_guard_counts(db_cursor, relay_ids):
+    """Count one more appearance for each of 'relay_ids' in guard_count."""
+    relay_id_rows = [(relay_id,) for relay_id in relay_ids]
+
+    db_cursor.executemany("INSERT OR IGNORE INTO guard_count (relay_id, times_seen) VALUES (?, 0)",
+                          relay_id_rows)
+    db_cursor.executemany("UPDATE guard_count SET times_seen = times_seen + 1 WHERE relay_id=?",
+                          relay_id_rows)
+
+def remove_from_guard_counts(db_cursor, relay_ids):
+    """Count one less appearance for each of 'relay_ids' in guard_count."""
+    db_cursor.executemany("UPDATE guard_count SET times_seen = times_seen - 1 WHERE relay_id=?",
+                          [(relay_id,) for relay_id in relay_ids])
+    db_cursor.execute("DELETE FROM guard_count WHERE times_seen <= 0")
+
+def count_imported_guardset(db_cursor, consensus_hour, relay_ids):
+    """
+    Add the guards with 'relay_ids' of a freshly imported consensus
+    from 'consensus_hour' to guard_count, if the consensus falls in
+    the window that guard_count covers.
+    """
+    db_cursor.execute("SELECT count(*) FROM guard_count_window WHERE window_start <= ?", (consensus_hour,))
+    if db_cursor.fetchone()[0]:
+        add_to_guard_counts(db_cursor, relay_ids)
+
+def get_consensus_hours(db_cursor):
+    """Return the set of the hours of all the consensuses in the database."""
+    db_cursor.execute("SELECT consensus_hour FROM consensus")
+    return set(row[0] for row in db_cursor.fetchall())
+
+def get_window_start(db_cursor, max_days, as_of=None):
+    """
+    Return the first hour since the epoch that is less than 'max_days'
+    ago, like consensus_hour. If 'as_of' is set, return the one that
+    was less than 'max_days' before that UTC datetime instead.
+    """
+    if as_of is not None:
+        return (int((as_of - EPOCH).total_seconds()) - max_days * 24*60*60 + 3599) // 3600
+
+    db_cursor.execute("SELECT (CAST(strftime('%s', 'now') AS INTEGER) - ? + 3599) / 3600",
+                      (max_days * 24*60*60,))
+    return db_cursor.fetchone()[0]
+
+def get_window_gaps(db_cursor, window_start):
+    """
+    Return a (consensus hour, next consensus hour) tuple for each gap
+    of more than an hour between the consensuses from 'window_start'
+    on, oldest first.
+    """
+    db_cursor.execute(WINDOW_GAPS_SQL if HAVE_WINDOW_FUNCTIONS else WINDOW_GAPS_COMPAT_SQL, (window_start,))
+    return [(row[0], row[1]) for row in db_cursor.fetchall()]
+
+def count_range_consensuses(db_cursor, window_start, window_end):
+    """Return the number of consensuses from 'window_start' up to (not including) 'window_end'."""
+    db_cursor.execute(RANGE_CONSENSUS_COUNT_SQL, (window_start, window_end))
+    return db_cursor.fetchone()[0]
+
+def iter_window_guardsets(db_conn, window_start, window_end=None):
+    """
+    Yield the packed guardsets of the consensuses from 'window_start'
+    up to 'window_end' (or until now), only looking into the guardset
+    partitions that overlap with that window.
+    """
+    for partition, start, end in _get_window_partitions(db_conn, window_start,
+                                                        MAX_HOUR if window_end is None else window_end):
+        for row in db_conn.execute(PARTITION_GUARDSETS_SQL % partition, (start, end)):
+            stats.count("guardsets_read")
+            yield row[0]
+
+def count_window_guardsets(db_conn, window_start, window_end=None):
+    """
+    Count how many times each relay appears in the guardsets of the
+    consensuses from 'window_start' up to 'window_end' (or until now).
+
+    Return a Counter mapping <relay_id> to <times seen>.
+    """
+    times_seen_counter = collections.Counter()
+
+    for relay_ids_blob in iter_window_guardsets(db_conn, window_start, window_end):
+        times_seen_counter.update(unpack_relay_ids(relay_ids_blob))
+
+    return times_seen_counter
+
+def _rebuild_guard_counts(db_conn, db_cursor, max_days, window_start):
+    """
+    Throw away the running guard counters and recount all the guard
+    appearances of the consensuses after 'window_start'.
+    """
+    logging.info("Recounting guards of the past %d days.", max_days)
+
+    times_seen_counter = count_window_guardsets(db_conn, window_start)
+
+    db_cursor.execute("DELETE FROM guard_count")
+    db_cursor.executemany("INSERT INTO guard_count (relay_id, times_seen) VALUES (?,?)",
+                          times_seen_counter.iteritems())
+
+    db_cursor.execute("DELETE FROM guard_count_window")
+    db_cursor.execute("INSERT INTO guard_count_window (max_days, window_start) VALUES (?,?)",
+                      (max_days, window_start))
+
+def update_guard_counts(db_conn, db_cursor, max_days, window_start):
+    """
+    Make the running guard counters of the database count the guards
+    of the past 'max_days', that is of the consensuses after
+    'window_start', and commit.
+
+    Normally this means forgetting about the few consensuses that
+    fell out of the window since our last run. If the counters are
+    missing or were counting a different window, count from scratch.
+    """
+    db_cursor.execute("SELECT max_days, window_start FROM guard_count_window")
+    row = db_cursor.fetchone()
+
+    if not row or row[0] != max_days or row[1] > window_start:
+        _rebuild_guard_counts(db_conn, db_cursor, max_days, window_start)
+        db_conn.commit()
+        return
+
+    # Forget about the consensuses that fell out of the window.
+    for relay_ids_blob in list(iter_window_guardsets(db_conn, row[1], window_start)):
+        remove_from_guard_counts(db_cursor, unpack_relay_ids(relay_ids_blob))
+
+    db_cursor.execute("UPDATE guard_count_window SET window_start = ?", (window_start,))
+    db_conn.commit()
+
+# The running guard counters, most seen guards first, with their
+# identities. Ties are broken by relay_id, like in _iter_counter_rows(),
+# so that the output file comes out the same whichever way we counted.
+GUARD_COUNT_ROWS_SQL = ("SELECT guard_count.relay_id, relay.identity, guard_count.times_seen FROM guard_count "
+                        "JOIN relay ON relay.relay_id = guard_count.relay_id "
+                        "ORDER BY guard_count.times_seen DESC, guard_count.relay_id")
+GUARD_DECAY_ROWS_SQL = ("SELECT guard_decay.relay_id, relay.identity, guard_decay.score FROM guard_decay "
+                        "JOIN relay ON relay.relay_id = guard_decay.relay_id "
+                        "ORDER BY guard_decay.score DESC, guard_decay.relay_id")
+
+# The guards of the consensuses from one hour up to (not including)
+# another, most seen first like above, counted from the guard
+# intervals that overlap with those hours. Intervals only cover hours
+# that we have consensuses for, so the hours of an interval that fall
+# in the window are its number of appearances there. The ORDER BY
+# sorts one row per guard, which sqlite spills to disk if it has to.
+# Left to itself, sqlite walks the whole primary key for the GROUP BY
+# instead, so make it only read the intervals that end in the window.
+INTERVAL_GUARD_ROWS_SQL = ("SELECT guard_interval.relay_id, relay.identity, "
+                           " sum(min(guard_interval.end_hour, ?) - max(guard_interval.start_hour, ?)) AS times_seen "
+                           "FROM guard_interval INDEXED BY guard_interval_end_hour_idx "
+                           "JOIN relay ON relay.relay_id = guard_interval.relay_id "
+                           "WHERE guard_interval.end_hour > ? AND guard_interval.start_hour < ? "
+                           "GROUP BY guard_interval.relay_id "
+                           "ORDER BY times_seen DESC, guard_interval.relay_id")
+
+# Number of rows that we pull out of sqlite at a time when streaming
+# guards to the output file. Also stays well below
+# SQLITE_MAX_VARIABLE_NUMBER in our IN (...) lookups.
+STREAM_CHUNK_SIZE = 500
+
+def _iter_rows(cursor):
+    """Yield the rows of the query that 'cursor' just ran, STREAM_CHUNK_SIZE at a time."""
+    while True:
+        rows = cursor.fetchmany(STREAM_CHUNK_SIZE)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+def _iter_counter_rows(db_cursor, times_seen_counter):
+    """
+    Yield a (-times seen, relay_id, fingerprint) tuple for each relay
+    of 'times_seen_counter', most seen first. Only the fingerprints of
+    one chunk of relays are looked up at a time.
+    """
+    relay_ids = sorted(times_seen_counter, key=lambda relay_id: (-times_seen_counter[relay_id], relay_id))
+
+    for i in xrange(0, len(relay_ids), STREAM_CHUNK_SIZE):
+        chunk = relay_ids[i:i+STREAM_CHUNK_SIZE]
+        identities = get_relay_identities(db_cursor, chunk)
+        for relay_id in chunk:
+            yield -times_seen_counter[relay_id], relay_id, identities[relay_id]
+
+def iter_counter_guards(db_cursor, times_seen_counter):
+    """
+    Yield a (fingerprint, times seen) tuple for each relay of
+    'times_seen_counter', a Counter mapping <relay_id> to <times seen>,
+    most seen first.
+    """
+    for negative_times_seen, _, identity in _iter_counter_rows(db_cursor, times_seen_counter):
+        yield identity, -negative_times_seen
+
+def iter_interval_guards(db_conn, db_cursor, window_start, window_end=None):
+    """
+    Count how many times each relay was a guard in the consensuses
+    from 'window_start' up to 'window_end' (or until now), from the
+    guard intervals. Yield a (fingerprint, times seen) tuple for each
+    relay, most seen first, straight out of the database.
+    """
+    # Open intervals run until the hour after the newest consensus.
+    newest_hour = get_newest_consensus_hour(db_cursor)
+    if newest_hour is None:
+        return
+    window_end = newest_hour + 1 if window_end is None else min(window_end, newest_hour + 1)
+
+    for _, identity, times_seen in _iter_rows(db_conn.execute(INTERVAL_GUARD_ROWS_SQL,
+                                                              (window_end, window_start, window_start, window_end))):
+        yield unpack_identity(identity), times_seen
+
+def count_interval_windows(db_conn, db_cursor, window_starts):
+    """
+    Count how many times each relay was a guard in the consensuses from
+    each of 'window_starts' until now, in one pass over the guard
+    intervals that overlap the largest window, like
+    INTERVAL_GUARD_ROWS_SQL does for a single window.
+
+    The counts go to the temporary table window_guard_count, with a
+    times_seen_<i> column for the i-th window, so that
+    iter_window_count_guards() can stream out each window in turn. The
+    table holds a row per guard, which sqlite spills to disk like any
+    other temporary data.
+    """
+    newest_hour = get_newest_consensus_hour(db_cursor)
+    window_end = 1 if newest_hour is None else newest_hour + 1
+
+    columns = ", ".join("times_seen_%d INTEGER" % i for i in xrange(len(window_starts)))
+    sums = ", ".join("sum(max(min(end_hour, ?) - max(start_hour, ?), 0))" for _ in window_starts)
+    params = []
+    for window_start in window_starts:
+        params += [window_end, window_start]
+    params.append(min(window_starts))
+
+    # The aggregate profile is query_only, which also covers temporary
+    # tables. We never write anything else in here.
+    query_only = db_conn.execute("PRAGMA query_only").fetchone()[0]
+    db_conn.execute("PRAGMA query_only = OFF")
+    try:
+        db_conn.execute("DROP TABLE IF EXISTS temp.window_guard_count")
+        db_conn.execute("CREATE TEMP TABLE window_guard_count (relay_id INTEGER PRIMARY KEY, %s)" % columns)
+        db_conn.execute("INSERT INTO temp.window_guard_count "
+                        "SELECT relay_id, %s FROM guard_interval INDEXED BY guard_interval_end_hour_idx "
+                        "WHERE end_hour > ? GROUP BY relay_id" % sums, params)
+        # Don't keep the database locked while the windows get written out.
+        db_conn.commit()
+    finally:
+        db_conn.execute("PRAGMA query_only = %d" % query_only)
+
+def iter_window_count_guards(db_conn, window_i):
+    """
+    Yield a (fingerprint, times seen) tuple for each relay that was a
+    guard in the 'window_i'-th window of count_interval_windows(),
+    most seen first, straight out of the database.
+    """
+    column = "window_guard_count.times_seen_%d" % window_i
+    rows = db_conn.execute("SELECT relay.identity, %s FROM temp.window_guard_count "
+                           "JOIN relay ON relay.relay_id = window_guard_count.relay_id "
+                           "WHERE %s > 0 ORDER BY %s DESC, window_guard_count.relay_id" % (column, column, column))
+    for identity, times_seen in _iter_rows(rows):
+        yield unpack_identity(identity), times_seen
+
+def _get_guard_counts(db_cursor, relay_ids):
+    """Return a dict mapping each of 'relay_ids' that has a running guard counter to its times seen."""
+    relay_ids = list(relay_ids)
+    times_seen = {}
+
+    for i in xrange(0, len(relay_ids), STREAM_CHUNK_SIZE):
+        chunk = relay_ids[i:i+STREAM_CHUNK_SIZE]
+        db_cursor.execute("SELECT relay_id, times_seen FROM guard_count WHERE relay_id IN (%s)" %
+                          ",".join("?" * len(chunk)), chunk)
+        times_seen.update(db_cursor.fetchall())
+
+    return times_seen
+
+def iter_guard_counts(db_conn, db_cursor, max_days, window_start):
+    """
+    Count how many times each relay was a guard in the past 'max_days',
+    that is in the consensuses after 'window_start', without writing
+    to the database. Yield a (fingerprint, times seen) tuple for each
+    relay, most seen first.
+
+    If the running counters count a window of 'max_days' that is
+    behind ours, stream them straight out of the database, and only
+    hold the guards of the consensuses that expired since in memory:
+    their counts go down, so they are sorted again on the side and
+    merged back in. Otherwise count the window from the guard
+    intervals, also straight out of the database.
+    """
+    db_cursor.execute("SELECT max_days, window_start FROM guard_count_window")
+    row = db_cursor.fetchone()
+
+    if not row or row[0] != max_days or row[1] > window_start:
+        logging.info("No running guard counters for the past %d days. Counting guard intervals.", max_days)
+        for guard_row in iter_interval_guards(db_conn, db_cursor, window_start):
+            yield guard_row
+        return
+
+    expired_counter = count_window_guardsets(db_conn, row[1], window_start)
+    times_seen_counter = collections.Counter(dict(
+        (relay_id, times_seen - expired_counter[relay_id])
+        for relay_id, times_seen in _get_guard_counts(db_cursor, expired_counter).iteritems()
+        if times_seen > expired_counter[relay_id]))
+
+    # Use a cursor of our own, since db_cursor looks up the
+    # fingerprints of the expired guards in the meantime.
+    guard_count_rows = ((-times_seen, relay_id, unpack_identity(identity))
+                        for relay_id, identity, times_seen in _iter_rows(db_conn.execute(GUARD_COUNT_ROWS_SQL))
+                        if relay_id not in expired_counter)
+
+    for negative_times_seen, _, identity in heapq.merge(guard_count_rows,
+                                                        _iter_counter_rows(db_cursor, times_seen_counter)):
+        yield identity, -negative_times_seen
+
+# Decayed scores below this are forgotten, so that relays that stopped
+# being guards don't stay in guard_decay forever. They would show up
+# with zero appearances in the output file anyway.
+DECAY_MIN_SCORE = 0.5
+
+def _get_decay_factor(half_life_days, earlier_hour, later_hour):
+    """
+    Return how much the score of a consensus from 'earlier_hour' has
+    decayed by 'later_hour', if scores halve every 'half_life_days'.
+    """
+    return 0.5 ** ((later_hour - earlier_hour) / (half_life_days * 24.))
+
+def get_decay_ideal_total(half_life_days):
+    """
+    Return the decayed number of consensuses that an unbroken history
+    of hourly consensuses adds up to, if scores halve every
+    'half_life_days'.
+    """
+    return 1 / (1 - _get_decay_factor(half_life_days, 0, 1))
+
+def decay_imported_guardset(db_cursor, consensus_hour, relay_ids):
+    """
+    Add the guards with 'relay_ids' of a freshly imported consensus
+    from 'consensus_hour' to the decayed guard scores, if we keep any.
+
+    All the scores are kept as of the hour of the newest consensus we
+    have seen. A newer consensus first decays all the scores up to its
+    own hour and then adds one to the score of each of its guards.
+    An older one adds the weight that it has left by that hour instead.
+    """
+    db_cursor.execute("SELECT half_life_days, total, last_hour FROM guard_decay_state")
+    row = db_cursor.fetchone()
+    if not row:
+        return
+
+    half_life_days, total, last_hour = row
+
+    if last_hour is None or consensus_hour >= last_hour:
+        if last_hour is not None:
+            decay_factor = _get_decay_factor(half_life_days, last_hour, consensus_hour)
+            db_cursor.execute("UPDATE guard_decay SET score = score * ?", (decay_factor,))
+            db_cursor.execute("DELETE FROM guard_decay WHERE score < ?", (DECAY_MIN_SCORE,))
+            total *= decay_factor
+        last_hour = consensus_hour
+        weight = 1.0
+    else:
+        weight = _get_decay_factor(half_life_days, consensus_hour, last_hour)
+
+    db_cursor.executemany("INSERT OR IGNORE INTO guard_decay (relay_id, score) VALUES (?, 0)",
+                          [(relay_id,) for relay_id in relay_ids])
+    db_cursor.executemany("UPDATE guard_decay SET score = score + ? WHERE relay_id=?",
+                          [(weight, relay_id) for relay_id in relay_ids])
+
+    db_cursor.execute("UPDATE guard_decay_state SET total = ?, last_hour = ?",
+                      (total + weight, last_hour))
+
+def _rebuild_guard_decay(db_conn, db_cursor, half_life_days):
+    """
+    Throw away the decayed guard scores and score all the consensuses
+    of the database from scratch, with scores that halve every
+    'half_life_days'.
+    """
+    logging.info("Rescoring guards with a half-life of %d days.", half_life_days)
+
+    db_cursor.execute("SELECT max(consensus_hour) FROM consensus")
+    last_hour = db_cursor.fetchone()[0]
+
+    scores = collections.defaultdict(float)
+    total = 0.0
+
+    for partition in get_guardset_partitions(db_conn):
+        for row in db_conn.execute("SELECT consensus.consensus_hour, guardset.relay_ids FROM consensus "
+                                   "JOIN %s AS guardset ON guardset.consensus_id = consensus.consensus_id"
+                                   % partition):
+            weight = _get_decay_factor(half_life_days, row[0], last_hour)
+            total += weight
+            for relay_id in unpack_relay_ids(row[1]):
+                scores[relay_id] += weight
+
+    db_cursor.execute("DELETE FROM guard_decay")
+    db_cursor.executemany("INSERT INTO guard_decay (relay_id, score) VALUES (?,?)",
+                          [(relay_id, score) for relay_id, score in scores.iteritems()
+                           if score >= DECAY_MIN_SCORE])
+
+    db_cursor.execute("DELETE FROM guard_decay_state")
+    db_cursor.execute("INSERT INTO guard_decay_state (half_life_days, total, last_hour) VALUES (?,?,?)",
+                      (half_life_days, total, last_hour))
+
+def update_guard_decay(db_conn, db_cursor, half_life_days):
+    """
+    Make sure that the database keeps decayed guard scores that halve
+    every 'half_life_days', and commit.
+
+    Once they are there, the importer keeps them up to date. If they
+    are missing or use a different half-life, score from scratch.
+    """
+    db_cursor.execute("SELECT half_life_days FROM guard_decay_state")
+    row = db_cursor.fetchone()
+
+    if not row or row[0] != half_life_days:
+        _rebuild_guard_decay(db_conn, db_cursor, half_life_days)
+        db_conn.commit()
+
+# The guard_interval table, as in db_schema.sql.
+GUARD_INTERVAL_SCHEMA = [
+    "CREATE TABLE guard_interval ("
+    " relay_id INTEGER NOT NULL REFERENCES relay(relay_id),"
+    " start_hour INTEGER NOT NULL,"
+    " end_hour INTEGER NOT NULL,"
+    " PRIMARY KEY (relay_id, start_hour))",
+    "CREATE INDEX guard_interval_end_hour_idx ON guard_interval(end_hour)",
+    "CREATE INDEX guard_interval_start_hour_idx ON guard_interval(start_hour)",
+]
+
+# The end hour of the guard intervals that are still going on as of
+# the newest consensus.
+OPEN_END_HOUR = MAX_HOUR
+
+def get_newest_consensus_hour(db_cursor):
+    """Return the hour of the newest consensus in the database, or None if there is none."""
+    db_cursor.execute("SELECT max(consensus_hour) FROM consensus")
+    return db_cursor.fetchone()[0]
+
+def get_open_guard_relay_ids(db_cursor):
+    """Return the set of the relay_ids of the guards of the newest consensus."""
+    db_cursor.execute("SELECT relay_id FROM guard_interval WHERE end_hour = ?", (OPEN_END_HOUR,))
+    return set(row[0] for row in db_cursor.fetchall())
+
+def extend_guard_intervals(db_cursor, consensus_hour, relay_ids, newest_hour, newest_relay_ids=None):
+    """
+    Add the guards with 'relay_ids' of a freshly imported consensus
+    from 'consensus_hour' to the guard intervals. 'newest_hour' is the
+    hour of the newest consensus we had before this one, or None.
+
+    The intervals of the guards of the newest consensus are left open,
+    so when the consensus right after it comes in, only the guards
+    that gained or lost the flag in between need to be touched: we
+    diff 'relay_ids' against 'newest_relay_ids', the guards of the
+    newest consensus, or against the open intervals if the caller
+    doesn't have them handy.
+
+    Older consensuses are joined to the intervals of the consensuses
+    right before and after them.
+    """
+    if newest_hour is not None and consensus_hour == newest_hour + 1:
+        if newest_relay_ids is None:
+            newest_relay_ids = get_open_guard_relay_ids(db_cursor)
+
+        relay_ids = set(relay_ids)
+        closed = [(consensus_hour, relay_id, OPEN_END_HOUR) for relay_id in newest_relay_ids
+                  if relay_id not in relay_ids]
+        opened = [(relay_id, consensus_hour, OPEN_END_HOUR) for relay_id in relay_ids
+                  if relay_id not in newest_relay_ids]
+
+        # The unary + keeps sqlite from looking the relay up through
+        # all the open intervals in the end_hour index.
+        db_cursor.executemany("UPDATE guard_interval SET end_hour = ? WHERE relay_id = ? AND +end_hour = ?", closed)
+        db_cursor.executemany("INSERT INTO guard_interval (relay_id, start_hour, end_hour) VALUES (?,?,?)", opened)
+        stats.count("guard_intervals_closed", len(closed))
+        stats.count("guard_intervals_opened", len(opened))
+        return
+
+    if newest_hour is None or consensus_hour > newest_hour:
+        # Consensuses are missing since the newest one, so its guards
+        # stopped being guards as far as we know.
+        if newest_hour is not None:
+            db_cursor.execute("UPDATE guard_interval SET end_hour = ? WHERE end_hour = ?",
+                              (newest_hour + 1, OPEN_END_HOUR))
+        db_cursor.executemany("INSERT INTO guard_interval (relay_id, start_hour, end_hour) VALUES (?,?,?)",
+                              [(relay_id, consensus_hour, OPEN_END_HOUR) for relay_id in relay_ids])
+        stats.count("guard_intervals_opened", len(relay_ids))
+        return
+
+    # Maps a <relay_id> to the <start hour> of its interval that ends
+    # right before this consensus.
+    db_cursor.execute("SELECT relay_id, start_hour FROM guard_interval WHERE end_hour = ?", (consensus_hour,))
+    starts = dict((row[0], row[1]) for row in db_cursor.fetchall())
+
+    # Maps a <relay_id> to the <end hour> of its interval that starts
+    # right after this consensus. Only there if we are filling a gap.
+    db_cursor.execute("SELECT relay_id, end_hour FROM guard_interval WHERE start_hour = ?", (consensus_hour + 1,))
+    ends = dict((row[0], row[1]) for row in db_cursor.fetchall())
+
+    # Replacing the interval that ended right before us extends it.
+    db_cursor.executemany("INSERT OR REPLACE INTO guard_interval (relay_id, start_hour, end_hour) VALUES (?,?,?)",
+                          [(relay_id, starts.get(relay_id, consensus_hour), ends.get(relay_id, consensus_hour + 1))
+                           for relay_id in relay_ids])
+    db_cursor.executemany("DELETE FROM guard_interval WHERE relay_id = ? AND start_hour = ?",
+                          [(relay_id, consensus_hour + 1) for relay_id in relay_ids if relay_id in ends])
+
+def _rebuild_guard_intervals(db_conn):
+    """
+    Throw away the guard intervals and find them again in all the
+    guardsets of the database.
+    """
+    logging.info("Rebuilding guard intervals.")
+
+    intervals = []
+    # Maps a <relay_id> to the <start hour> of its interval that is
+    # still going on as of 'last_hour'.
+    open_intervals = {}
+    last_hour = None
+
+    for partition in get_guardset_partitions(db_conn):
+        for row in db_conn.execute("SELECT consensus.consensus_hour, guardset.relay_ids FROM consensus "
+                                   "JOIN %s AS guardset ON guardset.consensus_id = consensus.consensus_id "
+                                   "ORDER BY consensus.consensus_hour" % partition):
+            consensus_hour, relay_ids = row[0], set(unpack_relay_ids(row[1]))
+
+            # Close the intervals of the relays that aren't guards
+            # anymore, or all of them if consensuses are missing.
+            if last_hour is not None and consensus_hour != last_hour + 1:
+                relay_ids_left = set()
+            else:
+                relay_ids_left = relay_ids
+            for relay_id in [relay_id for relay_id in open_intervals if relay_id not in relay_ids_left]:
+                intervals.append((relay_id, open_intervals.pop(relay_id), last_hour + 1))
+
+            for relay_id in relay_ids:
+                open_intervals.setdefault(relay_id, consensus_hour)
+            last_hour = consensus_hour
+
+    intervals.extend((relay_id, start_hour, OPEN_END_HOUR) for relay_id, start_hour in open_intervals.iteritems())
+
+    db_conn.execute("DELETE FROM guard_interval")
+    db_conn.executemany("INSERT INTO guard_interval (relay_id, start_hour, end_hour) VALUES (?,?,?)", intervals)
+
+def rebuild_guard_stats(db_conn, db_cursor):
+    """
+    Rebuild the guard intervals, and recount the running guard counters
+    and rescore the decayed guard scores from scratch for the same
+    window and half-life as before, and commit. Needed after loading
+    consensuses without the importer.
+    """
+    _rebuild_guard_intervals(db_conn)
+
+    db_cursor.execute("SELECT max_days, window_start FROM guard_count_window")
+    row = db_cursor.fetchone()
+    if row:
+        _rebuild_guard_counts(db_conn, db_cursor, row[0], row[1])
+
+    db_cursor.execute("SELECT half_life_days FROM guard_decay_state")
+    row = db_cursor.fetchone()
+    if row:
+        _rebuild_guard_decay(db_conn, db_cursor, row[0])
+
+    db_conn.commit()
+
+def read_guard_decay(db_cursor):
+    """
+    Return a (Counter, total) tuple with the decayed guard scores of
+    the database: the Counter maps <relay_id> to <decayed number of
+    consensuses it was a guard in>, and 'total' is the decayed number
+    of consensuses. Return None if the database keeps no such scores.
+    """
+    db_cursor.execute("SELECT total FROM guard_decay_state")
+    row = db_cursor.fetchone()
+    if not row:
+        return None
+
+    db_cursor.execute("SELECT relay_id, score FROM guard_decay")
+    scores = collections.Counter(dict((relay_id, score) for relay_id, score in db_cursor.fetchall()))
+
+    return scores, row[0]
+
+def iter_guard_decay(db_conn):
+    """
+    Yield a (fingerprint, decayed number of consensuses) tuple for
+    each relay that has a decayed guard score, highest scores first.
+    See read_guard_decay().
+    """
+    for _, identity, score in _iter_rows(db_conn.execute(GUARD_DECAY_ROWS_SQL)):
+        yield unpack_identity(identity), score
+
+def get_relay_identities(db_cursor, relay_ids):
+    """Return a dict mapping each of 'relay_ids' to its hex identity fingerprint."""
+    relay_ids = list(relay_ids)
+    identities = {}
+
+    for i in xrange(0, len(relay_ids), STREAM_CHUNK_SIZE):
+        chunk = relay_ids[i:i+STREAM_CHUNK_SIZE]
+        db_cursor.execute("SELECT relay_id, identity FROM relay WHERE relay_id IN (%s)" %
+                          ",".join("?" * len(chunk)), chunk)
+        identities.update((row[0], unpack_identity(row[1])) for row in db_cursor.fetchall())
+
+    return identities
+
+def get_consensus_guards(db_cursor, consensus_hour):
+    """
+    Return the set of the hex fingerprints of the guards of the
+    consensus from 'consensus_hour', or None if we don't have it.
+    """
+    partition, _, _ = _get_partition_bounds(consensus_hour)
+
+    db_cursor.execute("SELECT count(*) FROM guardset_partition WHERE name=?", (partition,))
+    if not db_cursor.fetchone()[0]:
+        return None
+
+    db_cursor.execute("SELECT guardset.relay_ids FROM consensus "
+                      "JOIN %s AS guardset ON guardset.consensus_id = consensus.consensus_id "
+                      "WHERE consensus.consensus_hour = ?" % partition, (consensus_hour,))
+    row = db_cursor.fetchone()
+    if not row:
+        return None
+
+    return set(get_relay_identities(db_cursor, unpack_relay_ids(row[0])).values())
+
+def _get_schema_version(db_cursor):
+    """
+    Return the schema version of the database at 'db_cursor', or None
+    if the database is empty.
+    """
+    version = db_cursor.execute("PRAGMA user_version").fetchone()[0]
+    if version:
+        return version
+
+    # Databases made before we started versioning our schema have a
+    # user_version of 0. Tell them apart from empty databases.
+    row = db_cursor.execute("SELECT count(*) FROM sqlite_master WHERE type='table'").fetchone()
+    return 1 if row[0] else None
+
+def migrate_db(db_conn, db_filename):
+    """
+    Bring the database at 'db_conn' up to SCHEMA_VERSION.
+    Exit with an informative message if that can't be done.
+    """
+    db_cursor = db_conn.cursor()
+    version = _get_schema_version(db_cursor)
+
+    if version is None or version == SCHEMA_VERSION:
+        return
+
+    if version > SCHEMA_VERSION:
+        logging.error("The database at '%s' has schema version %d, but we only " +
+                      "know up to version %d. Exiting.",
+                      db_filename, version, SCHEMA_VERSION)
+        sys.exit(4)
+
+    # Run each migration in its own explicit transaction, so that
+    # sqlite3 doesn't commit behind our back when it sees DDL.
+    isolation_level = db_conn.isolation_level
+    db_conn.isolation_level = None
+
+    # Migrations rebuild tables that others point to. Check the foreign
+    # keys once each migration is done instead of cascading deletes.
+    db_conn.execute("PRAGMA foreign_keys = OFF")
+
+    while version < SCHEMA_VERSION:
+        logging.warning("Migrating the database at '%s' from schema version %d to %d.",
+                        db_filename, version, version + 1)
+        try:
+            db_conn.execute("BEGIN")
+            MIGRATIONS[version](db_conn)
+            if db_conn.execute("PRAGMA foreign_key_check").fetchall():
+                raise sqlite3.IntegrityError("foreign key check failed")
+            version += 1
+            db_conn.execute("PRAGMA user_version = %d" % version)
+            db_conn.execute("COMMIT")
+        except sqlite3.Error, err:
+            db_conn.execute("ROLLBACK")
+            logging.error("There was an error migrating the database at '%s'. " +
+                          "The error message is '%s'. Exiting.",
+                          db_filename, err)
+            sys.exit(4)
+
+    # Give back the space of the dropped tables. Older databases also
+    # switch to incremental vacuuming here, so that dropping expired
+    # guardset partitions can give back their space later.
+    db_conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    db_conn.execute("VACUUM")
+    db_conn.execute("PRAGMA foreign_keys = ON")
+    db_conn.isolation_level = isolation_level
+
+def init_db(db_filename, schema_filename=None, profile="default"):
     """
     Initialize the sqlite3 database at 'db_filename'.
     Exit with an informative message if any fatal errors occur.
 
     If a 'schema_filename' is provided, it's a file with SQL commands
-    that load the database schema.
+    that load the database schema. Otherwise, databases with an older
+    schema are migrated to the current one.
+
+    'profile' is the name of the CONNECTION_PROFILES entry to tune
+    the connection with.
     """
 
-    # Initialize the database
+    # Initialize the database. The profile's busy timeout applies
+    # from the start, so that migrations wait like everything else.
+    busy_timeout = dict(CONNECTION_PROFILES[profile])["busy_timeout"]
     try:
         db_conn = sqlite3.connect(db_filename,
-                                  timeout = 900,# XXX timeout?
+                                  timeout = busy_timeout / 1000.,
                                   detect_types = sqlite3.PARSE_DECLTYPES + sqlite3.PARSE_COLNAMES)
     except sqlite3.OperationalError, err:
         logging.error("Error connecting to the database. " +
@@ -41,5 +1144,12 @@ def init_db(db_filename, schema_filename=None):
                               "The error message is '%s'. Exiting.",
                               db_filename, err)
                 sys.exit(4)
+    else:
+        migrate_db(db_conn, db_filename)
+
+    # Tune the connection. Comes last so that read-only profiles
+    # don't get in the way of migrations.
+    for pragma, value in CONNECTION_PROFILES[profile]:
+        db_cursor.execute("PRAGMA %s = %s" % (pragma, value))
 
     return db_conn, db_cursor
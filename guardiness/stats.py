@@ -0,0 +1,123 @@
+import time
+import datetime
+import json
+import logging
+import cProfile
+import contextlib
+import collections
+
+"""This file keeps the timers and counters of the hot paths of a run"""
+
+class RunStats(object):
+    """
+    Time spent in each stage of a run, and counters of the work done.
+    """
+
+    def __init__(self):
+        self.started_at = datetime.datetime.utcnow()
+        self.start_time = time.time()
+
+        # Maps a <stage name> to the <seconds> spent in it.
+        self.seconds = collections.defaultdict(float)
+        # Maps a <stage name> to the <number of times> we entered it.
+        self.calls = collections.Counter()
+        # Maps a <counter name> to its <value>.
+        self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Add the time spent in the 'with' block to 'stage'."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.time() - start
+            self.calls[stage] += 1
+
+    def count(self, counter, n=1):
+        """Add 'n' to 'counter'."""
+        self.counters[counter] += n
+
+    def summary(self, script):
+        """Return the stats of this run of 'script' as a dictionary that can be dumped as JSON."""
+        return {
+            "script" : script,
+            "started_at" : self.started_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "seconds" : round(time.time() - self.start_time, 4),
+            "stages" : dict((stage, {"seconds" : round(seconds, 4), "calls" : self.calls[stage]})
+                            for stage, seconds in self.seconds.iteritems()),
+            "counters" : dict(self.counters),
+        }
+
+# The stats of the current run. The instrumented code reports to it
+# through the module-level functions below.
+_run_stats = RunStats()
+
+def reset():
+    """Forget everything and start counting a new run."""
+    global _run_stats
+    _run_stats = RunStats()
+
+def timer(stage):
+    """Context manager that adds the time spent in it to 'stage'."""
+    return _run_stats.timer(stage)
+
+def count(counter, n=1):
+    """Add 'n' to 'counter'."""
+    _run_stats.count(counter, n)
+
+def timed_iter(stage, iterable):
+    """Yield the items of 'iterable', adding the time spent producing them to 'stage'."""
+    iterator = iter(iterable)
+    while True:
+        with timer(stage):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+def counted_iter(counter, iterable):
+    """Yield the items of 'iterable', adding one to 'counter' for each of them."""
+    for item in iterable:
+        count(counter)
+        yield item
+
+def get_summary(script):
+    """Return the stats of the current run of 'script' as a dictionary."""
+    return _run_stats.summary(script)
+
+def write_summary(script, stats_fname=None):
+    """
+    Append the stats of the current run of 'script' as a JSON line to
+    'stats_fname', or just log them if it's None.
+    """
+    summary_str = json.dumps(get_summary(script), sort_keys=True)
+    logging.info("Run stats: %s", summary_str)
+
+    if stats_fname:
+        try:
+            with open(stats_fname, "a") as stats_fd:
+                stats_fd.write(summary_str + "\n")
+        except IOError, err:
+            logging.warning("Could not write run stats to %s: %s", stats_fname, err)
+
+def run_instrumented(script, func, args, stats_fname=None, profile_fname=None):
+    """
+    Call 'func' with 'args' as a fresh run of 'script', and write its
+    stats summary with write_summary() however it ends.
+
+    If 'profile_fname' is set, run 'func' under cProfile and dump the
+    profile there, for 'python -m pstats' to read.
+    """
+    reset()
+    profiler = cProfile.Profile() if profile_fname else None
+
+    try:
+        if profiler:
+            return profiler.runcall(func, args)
+        return func(args)
+    finally:
+        if profiler:
+            profiler.dump_stats(profile_fname)
+        write_summary(script, stats_fname)
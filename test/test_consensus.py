@@ -0,0 +1,79 @@
+import unittest
+import os
+import StringIO
+
+import guardiness.consensus as consensus
+
+TEST_CONSENSUSES_DIR = "./test/test_consensuses/" # XXX
+
+class testFastParser(unittest.TestCase):
+    def test_fast_parser_matches_stem(self):
+        """Check that our line-based parser finds the same guards as stem."""
+
+        fast_parser = consensus.ConsensusParser(fast=True)
+        stem_parser = consensus.ConsensusParser()
+
+        for filename in os.listdir(TEST_CONSENSUSES_DIR):
+            consensus_f = os.path.join(TEST_CONSENSUSES_DIR, filename)
+
+            with open(consensus_f, 'rb') as consensus_fd:
+                fast_valid_after, fast_guard_fprs = fast_parser._parse_consensus_fast(consensus_fd)
+            stem_valid_after, stem_guard_fprs = stem_parser.parse_consensus_file(consensus_f)
+
+            self.assertEquals(fast_valid_after, stem_valid_after)
+            self.assertEquals(sorted(fast_guard_fprs), sorted(stem_guard_fprs))
+
+    def test_iter_guard_flags(self):
+        """Check the guard flags of a tiny handmade router list."""
+
+        router_list = StringIO.StringIO(
+            "r relay1 qqqqqqqqqqqqqqqqqqqqqqqqqqo 2014-07-06 01:33:05 10.0.0.1 9001 0\n"
+            "m 6o5bzcbQv2ZQuatyLe5hJCoKdRFwUfPsQi6chi1HBiI\n"
+            "s Fast Guard Running Stable Valid\n"
+            "r relay2 u7u7u7u7u7u7u7u7u7u7u7u7u7s 2014-07-06 01:33:05 10.0.0.2 9001 0\n"
+            "s Fast Running Valid\n"
+            "r relay3 zMzMzMzMzMzMzMzMzMzMzMzMzMw 2014-07-06 01:33:05 10.0.0.3 9001 0\n"
+            "directory-footer\n")
+
+        self.assertEquals(list(consensus.iter_guard_flags(router_list)),
+                          [("AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA", True),
+                           ("BBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBB", False),
+                           ("CCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCC", False)])
+
+    def test_fallback_to_stem(self):
+        """Check that consensuses we can't parse fast are handed to stem."""
+
+        consensus_f = os.path.join(TEST_CONSENSUSES_DIR, sorted(os.listdir(TEST_CONSENSUSES_DIR))[0])
+        with open(consensus_f, 'rb') as consensus_fd:
+            consensus_str = consensus_fd.read()
+
+        # Drop the padding-free base64 identity of the first router
+        # so that our parser chokes on it.
+        broken_str = consensus_str.replace("r TorNinurtaName AA8YrCza5McQugiY3J4h5y4BF9g",
+                                           "r TorNinurtaName !!", 1)
+        self.assertRaises(ValueError, consensus.ConsensusParser()._parse_consensus_fast,
+                          StringIO.StringIO(broken_str))
+
+        # The fast parser should fall back to stem, which doesn't mind.
+        self.assertEquals(consensus.ConsensusParser(fast=True).parse_consensus(StringIO.StringIO(broken_str)),
+                          consensus.ConsensusParser().parse_consensus(StringIO.StringIO(broken_str)))
+
+    def test_truncated_identity(self):
+        """Check that identities that aren't even base64 are handed to stem too."""
+
+        router_list = StringIO.StringIO(
+            "r relay1 A 2014-07-06 01:33:05 10.0.0.1 9001 0\n"
+            "s Fast Guard Running Stable Valid\n")
+        self.assertRaises(ValueError, list, consensus.iter_guard_flags(router_list))
+
+        consensus_f = os.path.join(TEST_CONSENSUSES_DIR, sorted(os.listdir(TEST_CONSENSUSES_DIR))[0])
+        with open(consensus_f, 'rb') as consensus_fd:
+            consensus_str = consensus_fd.read()
+
+        broken_str = consensus_str.replace("r TorNinurtaName AA8YrCza5McQugiY3J4h5y4BF9g",
+                                           "r TorNinurtaName AA8YrCza5", 1)
+        self.assertEquals(consensus.ConsensusParser(fast=True).parse_consensus_string(broken_str, "broken"),
+                          consensus.ConsensusParser().parse_consensus_string(broken_str, "broken"))
+
+if __name__ == '__main__':
+    unittest.main()
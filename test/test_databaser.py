@@ -1,10 +1,16 @@
 import unittest
 import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
 
 import stem
 from stem.descriptor import parse_file, DocumentHandler
 
 import guardiness.sqlite_db as sqlite_db
+import guardiness.stats as stats
+import guardiness.snapshot as snapshot
 import databaser
 
 SQLITE_DB_FILE = ":memory:"
@@ -48,6 +54,23 @@ def parse_consensuses_naive_way(consensus_dir):
 
     return guards_dict
 
+def read_db_guards(db_cursor):
+    """
+    Return a dictionary mapping <guard fingerprints> to <times seen in
+    the consensuses of the database at 'db_cursor'>.
+    """
+
+    db_cursor.execute("SELECT relay_id, identity FROM relay")
+    identities = dict((row[0], sqlite_db.unpack_identity(row[1])) for row in db_cursor.fetchall())
+
+    guards_dict = {}
+    for relay_ids_blob in list(sqlite_db.iter_window_guardsets(db_cursor, sqlite_db.MIN_HOUR)):
+        for relay_id in sqlite_db.unpack_relay_ids(relay_ids_blob):
+            guard_fpr = identities[relay_id]
+            guards_dict[guard_fpr] = guards_dict.get(guard_fpr, 0) + 1
+
+    return guards_dict
+
 class testDatabaser(unittest.TestCase):
     def test_database_import(self):
         """Check that consensuses are parsed and imported to the db properly.
@@ -73,8 +96,7 @@ class testDatabaser(unittest.TestCase):
 
         # Now get the list of guards and their guardiness from the
         # database, and compare it with the naive guards dictionary.
-        db_cursor.execute("SELECT (SELECT identity FROM relay WHERE relay_id=guarddata.relay_id), count(*) FROM guarddata GROUP BY relay_id;")
-        guardiness_list = db_cursor.fetchall()
+        guardiness_list = read_db_guards(db_cursor).items()
 
         self.assertEquals(len(guardiness_list), len(guards_dict))
 
@@ -85,5 +107,251 @@ class testDatabaser(unittest.TestCase):
             # Make sure that the same number of guard observations were found
             self.assertEquals(guards_dict[guard_fpr], times_seen)
 
+    def test_database_reimport(self):
+        """Check that importing the same consensuses twice changes nothing.
+
+        The second import uses a fresh parser, so its relay cache gets
+        loaded from the database written by the first one.
+        """
+
+        db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+        databaser.import_consensus_dir_to_db(db_cursor, TEST_CONSENSUSES_DIR, False, commit_every=1)
+        guards_dict = read_db_guards(db_cursor)
+        db_cursor.execute("SELECT count(*) FROM relay")
+        relays_n = int(db_cursor.fetchone()[0])
+
+        stats.reset()
+        databaser.import_consensus_dir_to_db(db_cursor, TEST_CONSENSUSES_DIR, False, commit_every=1)
+
+        # Nothing got parsed the second time around.
+        summary = stats.get_summary("databaser")
+        self.assertEquals(summary["counters"], {"consensuses_skipped" : 4})
+
+        db_cursor.execute("SELECT count(*) FROM consensus")
+        self.assertEquals(int(db_cursor.fetchone()[0]), 4)
+        self.assertEquals(read_db_guards(db_cursor), guards_dict)
+        db_cursor.execute("SELECT count(*) FROM relay")
+        self.assertEquals(int(db_cursor.fetchone()[0]), relays_n)
+
+        db_conn.close()
+
+    def test_database_import_stats(self):
+        """Check that the import counts its work in the run stats."""
+
+        guards_dict = parse_consensuses_naive_way(TEST_CONSENSUSES_DIR)
+
+        stats.reset()
+        db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+        databaser.import_consensus_dir_to_db(db_cursor, TEST_CONSENSUSES_DIR, False, commit_every=2)
+        databaser.import_consensus_dir_to_db(db_cursor, TEST_CONSENSUSES_DIR, False)
+        db_conn.close()
+
+        summary = stats.get_summary("databaser")
+        self.assertEquals(summary["script"], "databaser")
+        self.assertEquals(summary["counters"]["consensuses_parsed"], 4)
+        self.assertEquals(summary["counters"]["consensuses_imported"], 4)
+        self.assertEquals(summary["counters"]["consensuses_skipped"], 4)
+        self.assertEquals(summary["counters"]["guards_inserted"], sum(guards_dict.values()))
+        self.assertEquals(summary["counters"]["new_relays"], len(guards_dict))
+        self.assertEquals(summary["stages"]["parse"]["calls"], 6)
+        self.assertEquals(summary["stages"]["guardset_insert"]["calls"], 4)
+        self.assertEquals(summary["stages"]["commit"]["calls"], 2)
+
+    def test_database_import_parallel(self):
+        """Check that parsing with worker processes imports the same data."""
+
+        db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+        databaser.import_consensus_dir_to_db(db_cursor, TEST_CONSENSUSES_DIR, False, jobs=2)
+        db_conn.commit()
+
+        guards_dict = parse_consensuses_naive_way(TEST_CONSENSUSES_DIR)
+
+        db_cursor.execute("SELECT count(*) FROM consensus")
+        self.assertEquals(int(db_cursor.fetchone()[0]), 4)
+
+        self.assertEquals(read_db_guards(db_cursor), guards_dict)
+
+        db_conn.close()
+
+    def test_database_import_tarball(self):
+        """Check that consensuses are imported straight out of tarballs."""
+
+        guards_dict = parse_consensuses_naive_way(TEST_CONSENSUSES_DIR)
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            # Make a gzipped and an xz tarball of the test consensuses
+            # in the same layout as the CollecTor archives, along with
+            # some microdescriptors.
+            micro_dir = os.path.join(temp_dir, "micro")
+            os.mkdir(micro_dir)
+            for i in xrange(20):
+                with open(os.path.join(micro_dir, "%040x" % i), "w") as micro_fd:
+                    micro_fd.write("@type microdescriptor 1.0\nonion-key\n")
+
+            tar_path = os.path.join(temp_dir, "microdescs-2014-07.tar")
+            for mode, path in (("w", tar_path), ("w:gz", tar_path + ".gz")):
+                with tarfile.open(path, mode) as tarball:
+                    tarball.add(TEST_CONSENSUSES_DIR, "microdescs-2014-07/consensus-microdesc/06")
+                    tarball.add(micro_dir, "microdescs-2014-07/micro/06")
+            subprocess.check_call(["xz", tar_path])
+
+            self.assertEquals(len(list(databaser.iter_tarball_members(tar_path + ".gz"))), 4)
+
+            for tarball_path in (tar_path + ".gz", tar_path + ".xz"):
+                self.assertTrue(databaser.is_tarball(tarball_path))
+
+                db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+                stats.reset()
+                databaser.import_consensus_tarball_to_db(db_cursor, tarball_path, True, fast=True)
+                # The microdescriptors are never parsed.
+                counters = stats.get_summary("databaser")["counters"]
+                self.assertEquals((counters["tarball_members_ignored"], counters["consensuses_parsed"]), (20, 4))
+
+                db_cursor.execute("SELECT count(*) FROM consensus")
+                self.assertEquals(int(db_cursor.fetchone()[0]), 4)
+
+                self.assertEquals(read_db_guards(db_cursor), guards_dict)
+
+                # --delete-imported removes the whole tarball.
+                self.assertFalse(os.path.exists(tarball_path))
+
+                db_conn.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_tarball_reimport_skips_parsing(self):
+        """Check that a tarball of consensuses we already have is skipped without parsing."""
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tarball_path = os.path.join(temp_dir, "microdescs-2014-07.tar.gz")
+            with tarfile.open(tarball_path, "w:gz") as tarball:
+                tarball.add(TEST_CONSENSUSES_DIR, "microdescs-2014-07/consensus-microdesc/06")
+
+            db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+            databaser.import_consensus_dir_to_db(db_cursor, TEST_CONSENSUSES_DIR, False)
+            guards_dict = read_db_guards(db_cursor)
+
+            stats.reset()
+            databaser.import_consensus_tarball_to_db(db_cursor, tarball_path, False, jobs=2)
+            self.assertEquals(stats.get_summary("databaser")["counters"], {"consensuses_skipped" : 4})
+
+            db_cursor.execute("SELECT count(*) FROM consensus")
+            self.assertEquals(int(db_cursor.fetchone()[0]), 4)
+            self.assertEquals(read_db_guards(db_cursor), guards_dict)
+
+            db_conn.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+class testSnapshot(unittest.TestCase):
+    def test_snapshot_roundtrip(self):
+        """Check that a snapshot loads to the same guard history, and passes verification."""
+
+        temp_dir = tempfile.mkdtemp()
+        snapshot_path = os.path.join(temp_dir, "guardfraction.snapshot")
+        try:
+            db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+            databaser.import_consensus_dir_to_db(db_cursor, TEST_CONSENSUSES_DIR, False)
+            db_conn.commit()
+            guards_dict = read_db_guards(db_cursor)
+            consensus_hours = sqlite_db.get_consensus_hours(db_cursor)
+            self.assertEquals(snapshot.export_snapshot(db_conn, db_cursor, snapshot_path), 4)
+            db_conn.close()
+
+            # Load it to a database that keeps running counters.
+            db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+            sqlite_db.update_guard_counts(db_conn, db_cursor, 999, sqlite_db.MIN_HOUR)
+            self.assertEquals(snapshot.load_snapshot(db_conn, db_cursor, snapshot_path), sorted(consensus_hours))
+            snapshot.commit_snapshot(db_conn, db_cursor)
+
+            self.assertEquals(sqlite_db.get_consensus_hours(db_cursor), consensus_hours)
+            self.assertEquals(read_db_guards(db_cursor), guards_dict)
+            self.assertEquals(databaser.verify_consensuses_in_db(db_cursor, TEST_CONSENSUSES_DIR, 3),
+                              (3, []))
+
+            db_cursor.execute("SELECT sum(times_seen) FROM guard_count")
+            self.assertEquals(db_cursor.fetchone()[0], sum(guards_dict.values()))
+
+            # Loading it again changes nothing.
+            self.assertEquals(databaser.import_verified_snapshot(db_conn, db_cursor, snapshot_path,
+                                                                 TEST_CONSENSUSES_DIR, 3),
+                              (0, 0, []))
+            self.assertEquals(read_db_guards(db_cursor), guards_dict)
+            db_conn.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_mismatching_snapshot_is_rolled_back(self):
+        """Check that a snapshot that disagrees with the consensuses leaves the database alone."""
+
+        temp_dir = tempfile.mkdtemp()
+        snapshot_path = os.path.join(temp_dir, "guardfraction.snapshot")
+        first_consensus_dir = os.path.join(temp_dir, "first")
+        try:
+            # Drop a guard from the second consensus before exporting.
+            db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+            databaser.import_consensus_dir_to_db(db_cursor, TEST_CONSENSUSES_DIR, False)
+            db_conn.commit()
+            second_hour = sorted(sqlite_db.get_consensus_hours(db_cursor))[1]
+            partition = sqlite_db.get_guardset_partition(db_cursor, second_hour)
+            db_cursor.execute("SELECT consensus_id FROM consensus WHERE consensus_hour = ?", (second_hour,))
+            consensus_id = db_cursor.fetchone()[0]
+            db_cursor.execute("SELECT relay_ids FROM %s WHERE consensus_id = ?" % partition, (consensus_id,))
+            relay_ids = sqlite_db.unpack_relay_ids(db_cursor.fetchone()[0])
+            db_cursor.execute("UPDATE %s SET relay_ids = ? WHERE consensus_id = ?" % partition,
+                              (sqlite_db.pack_relay_ids(relay_ids[1:]), consensus_id))
+            db_conn.commit()
+            snapshot.export_snapshot(db_conn, db_cursor, snapshot_path)
+            db_conn.close()
+
+            # The new database already has the first consensus, which
+            # the snapshot agrees with.
+            os.mkdir(first_consensus_dir)
+            first_consensus = sorted(os.listdir(TEST_CONSENSUSES_DIR))[0]
+            shutil.copy(os.path.join(TEST_CONSENSUSES_DIR, first_consensus), first_consensus_dir)
+            db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+            sqlite_db.update_guard_counts(db_conn, db_cursor, 999, sqlite_db.MIN_HOUR)
+            databaser.import_consensus_dir_to_db(db_cursor, first_consensus_dir, False)
+            db_conn.commit()
+
+            def dump_db():
+                return [(table, db_conn.execute("SELECT * FROM %s ORDER BY 1, 2" % table).fetchall())
+                        for table in ["sqlite_master"] + [row[0] for row in db_conn.execute(
+                            "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]]
+            db_dump = dump_db()
+
+            loaded_n, checked_n, mismatched = databaser.import_verified_snapshot(
+                db_conn, db_cursor, snapshot_path, TEST_CONSENSUSES_DIR, 1)
+            self.assertEquals((loaded_n, checked_n), (0, 1))
+            self.assertEquals([sqlite_db.datetime_to_hour(valid_after) for valid_after in mismatched],
+                              [second_hour])
+            self.assertEquals(dump_db(), db_dump)
+            db_conn.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_corrupt_snapshot(self):
+        """Check that damaged snapshots are refused."""
+
+        temp_dir = tempfile.mkdtemp()
+        snapshot_path = os.path.join(temp_dir, "guardfraction.snapshot")
+        try:
+            db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+            databaser.import_consensus_dir_to_db(db_cursor, TEST_CONSENSUSES_DIR, False)
+            db_conn.commit()
+            snapshot.export_snapshot(db_conn, db_cursor, snapshot_path)
+            db_conn.close()
+
+            with open(snapshot_path, "rb") as snapshot_fd:
+                snapshot_data = snapshot_fd.read()
+            with open(snapshot_path, "wb") as snapshot_fd:
+                snapshot_fd.write(snapshot_data[:-10] + chr(ord(snapshot_data[-10]) ^ 1) + snapshot_data[-9:])
+
+            self.assertRaises(snapshot.SnapshotError, snapshot.read_snapshot, snapshot_path)
+        finally:
+            shutil.rmtree(temp_dir)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,199 @@
+import unittest
+import sys
+import socket
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+import zlib
+import gzip
+import StringIO
+import email.utils
+import calendar
+from datetime import datetime, timedelta
+
+import guardiness.fetch as fetch
+import guardiness.sqlite_db as sqlite_db
+import databaser
+
+SQLITE_DB_FILE = ":memory:"
+SQLITE_DB_SCHEMA = "./db_schema.sql"
+
+TEST_CONSENSUS_FILE = "./test/test_consensuses/2014-07-06-04-00-00-consensus-microdesc" # XXX
+TEST_CONSENSUS_VALID_AFTER = datetime(2014, 7, 6, 4)
+
+NEWER_CONSENSUS_FILE = "./test/test_consensuses/2014-07-07-04-00-00-consensus-microdesc"
+NEWER_CONSENSUS_VALID_AFTER = datetime(2014, 7, 7, 4)
+
+with open(TEST_CONSENSUS_FILE, "rb") as consensus_fd:
+    TEST_CONSENSUS = consensus_fd.read()
+with open(NEWER_CONSENSUS_FILE, "rb") as consensus_fd:
+    NEWER_CONSENSUS = consensus_fd.read()
+
+# While the test consensus is fresh.
+TEST_CONSENSUS_NOW = TEST_CONSENSUS_VALID_AFTER + timedelta(minutes=30)
+
+class StandInDirectoryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the test consensus like a directory mirror would, along
+    with some badly behaved mirrors:
+
+     /deflate, /gzip: the consensus, compressed
+     /slow: the consensus, after a while
+     /slow-newer: the consensus of a day later, after a while
+     /flaky: a server error the first time, then the consensus
+     /broken: always a server error
+     /garbage: something that is not a consensus
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code, body="", headers=()):
+        self.send_response(code)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_consensus(self):
+        if_modified_since = self.headers.getheader("If-Modified-Since")
+        if if_modified_since:
+            since = datetime.utcfromtimestamp(calendar.timegm(email.utils.parsedate(if_modified_since)))
+            if since >= TEST_CONSENSUS_VALID_AFTER:
+                return self._send(304)
+
+        if self.path == "/gzip":
+            body = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=body, mode="wb") as gzip_fd:
+                gzip_fd.write(TEST_CONSENSUS)
+            return self._send(200, body.getvalue(), [("Content-Encoding", "gzip")])
+
+        self._send(200, zlib.compress(TEST_CONSENSUS), [("Content-Encoding", "deflate")])
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+
+        if self.path in ("/deflate", "/gzip"):
+            self._send_consensus()
+        elif self.path == "/slow":
+            time.sleep(2)
+            self._send_consensus()
+        elif self.path == "/slow-newer":
+            time.sleep(1)
+            self._send(200, zlib.compress(NEWER_CONSENSUS), [("Content-Encoding", "deflate")])
+        elif self.path == "/flaky" and self.server.requests.count("/flaky") > 1:
+            self._send_consensus()
+        elif self.path == "/garbage":
+            self._send(200, "Hello world!\n")
+        else:
+            self._send(500)
+
+class StandInDirectoryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The fetcher hangs up on the sources that lose the race, so
+        # their handlers write to closed sockets. That's expected.
+        if isinstance(sys.exc_info()[1], socket.error):
+            return
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+class testFetch(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInDirectoryServer(("127.0.0.1", 0), StandInDirectoryHandler)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self.server.server_address[1], path)
+
+    def test_first_valid_source_wins(self):
+        """Test that broken sources are skipped and slow ones aren't waited for."""
+
+        start = time.time()
+        url, valid_after, consensus_str = fetch.fetch_consensus(
+            [self.url(path) for path in ("/broken", "/garbage", "/slow", "/deflate")], retries=0,
+            now=TEST_CONSENSUS_NOW)
+
+        self.assertTrue(time.time() - start < 2)
+        self.assertEquals(url, self.url("/deflate"))
+        self.assertEquals(valid_after, TEST_CONSENSUS_VALID_AFTER)
+        self.assertEquals(consensus_str, TEST_CONSENSUS)
+
+        _, _, consensus_str = fetch.fetch_consensus([self.url("/gzip")])
+        self.assertEquals(consensus_str, TEST_CONSENSUS)
+
+    def test_lagging_source_loses(self):
+        """Test that a fast source with last hour's consensus doesn't beat a slower up to date one."""
+
+        now = NEWER_CONSENSUS_VALID_AFTER + timedelta(minutes=30)
+        url, valid_after, consensus_str = fetch.fetch_consensus(
+            [self.url("/deflate"), self.url("/slow-newer")], retries=0, now=now)
+        self.assertEquals(url, self.url("/slow-newer"))
+        self.assertEquals(valid_after, NEWER_CONSENSUS_VALID_AFTER)
+        self.assertEquals(consensus_str, NEWER_CONSENSUS)
+
+        # Without anything fresher, we settle for the newest one.
+        url, valid_after, _ = fetch.fetch_consensus([self.url("/deflate"), self.url("/broken")],
+                                                    retries=0, now=now)
+        self.assertEquals((url, valid_after), (self.url("/deflate"), TEST_CONSENSUS_VALID_AFTER))
+
+        # And don't wait longer than a timeout for the others.
+        start = time.time()
+        url, _, _ = fetch.fetch_consensus([self.url("/deflate"), self.url("/slow")],
+                                          timeout=0.5, retries=5, retry_delay=0, now=now)
+        self.assertTrue(time.time() - start < 2)
+        self.assertEquals(url, self.url("/deflate"))
+
+    def test_retries(self):
+        """Test that failing sources are retried, and given up on eventually."""
+
+        url, _, _ = fetch.fetch_consensus([self.url("/flaky")], retries=1, retry_delay=0)
+        self.assertEquals(url, self.url("/flaky"))
+        self.assertEquals(self.server.requests, ["/flaky", "/flaky"])
+
+        self.assertRaises(fetch.FetchError, fetch.fetch_consensus,
+                          [self.url("/broken"), self.url("/garbage")], retries=2, retry_delay=0)
+        self.assertEquals(self.server.requests.count("/broken"), 3)
+
+    def test_freshness(self):
+        """Test that stale consensuses are refused and that we don't download old news."""
+
+        self.assertRaises(fetch.FetchError, fetch.fetch_consensus, [self.url("/deflate")],
+                          min_valid_after=TEST_CONSENSUS_VALID_AFTER + timedelta(hours=1), retries=0)
+
+        self.assertEquals(fetch.fetch_consensus([self.url("/deflate"), self.url("/broken")],
+                                                if_modified_since=TEST_CONSENSUS_VALID_AFTER, retries=0),
+                          None)
+
+    def test_fetch_and_import(self):
+        """Test that databaser imports fetched consensuses straight out of memory."""
+
+        db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+        urls = [self.url("/broken"), self.url("/deflate")]
+
+        # Our test consensus is rather old.
+        self.assertRaises(fetch.FetchError, databaser.import_fetched_consensus, db_cursor, urls, retries=0)
+
+        max_consensus_age = fetch.MAX_CONSENSUS_AGE
+        fetch.MAX_CONSENSUS_AGE = datetime.utcnow() - TEST_CONSENSUS_VALID_AFTER + timedelta(days=1)
+        try:
+            self.assertTrue(databaser.import_fetched_consensus(db_cursor, urls, retries=0))
+            self.assertEquals(sqlite_db.get_consensus_hours(db_cursor),
+                              set([sqlite_db.datetime_to_hour(TEST_CONSENSUS_VALID_AFTER)]))
+
+            # The second time around the source has nothing newer for us.
+            self.assertFalse(databaser.import_fetched_consensus(db_cursor, urls, retries=0))
+        finally:
+            fetch.MAX_CONSENSUS_AGE = max_consensus_age
+
+        db_conn.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,15 @@
 import unittest
 import os
+import sqlite3
+import shutil
 
 import guardiness.sqlite_db as sqlite_db
+import guardiness.consensus as consensus
+import guardiness.guard_ds as guard_ds
+import guardiness.collector as collector
+import guardiness.history as history
+import guardiness.stats as stats
+import guardiness.replay as replay
 import tempfile
 import guardfraction
 
@@ -14,6 +22,7 @@ GUARD_1_FPR = "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
 GUARD_2_FPR = "BBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBB"
 GUARD_3_FPR = "CCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCC"
 GUARD_4_FPR = "DDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDD"
+GUARD_5_FPR = "EEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEE"
 
 def populate_db_helper(db_cursor):
     """
@@ -25,68 +34,153 @@ def populate_db_helper(db_cursor):
      * consensus_3 contains (guard_1, guard_4)
     """
 
-    # Create the consensuses
-    db_cursor.execute("INSERT INTO consensus (consensus_date) VALUES (datetime('now', '-1 day'))")
+    # Create the consensuses: a day ago, and a month ago.
+    now_hour = sqlite_db.datetime_to_hour(datetime.utcnow())
+    db_cursor.execute("INSERT INTO consensus (consensus_hour) VALUES (?)", (now_hour - 24,))
     first_consensus_idx = db_cursor.lastrowid
-    db_cursor.execute("INSERT INTO consensus (consensus_date) VALUES (datetime('now', '-1 month'))")
+    db_cursor.execute("INSERT INTO consensus (consensus_hour) VALUES (?)", (now_hour - 30*24,))
     second_consensus_idx = db_cursor.lastrowid
-    db_cursor.execute("INSERT INTO consensus (consensus_date) VALUES (datetime('now', '-1 month', '-1 hours'))")
+    db_cursor.execute("INSERT INTO consensus (consensus_hour) VALUES (?)", (now_hour - 30*24 - 1,))
     third_consensus_idx = db_cursor.lastrowid
 
     # Create the guards
-    db_cursor.execute("INSERT INTO relay (identity) VALUES (?)", (GUARD_1_FPR,))
+    db_cursor.execute("INSERT INTO relay (identity) VALUES (?)", (sqlite_db.pack_identity(GUARD_1_FPR),))
     first_guard_idx = db_cursor.lastrowid
-    db_cursor.execute("INSERT INTO relay (identity) VALUES (?)", (GUARD_2_FPR,))
+    db_cursor.execute("INSERT INTO relay (identity) VALUES (?)", (sqlite_db.pack_identity(GUARD_2_FPR),))
     second_guard_idx = db_cursor.lastrowid
-    db_cursor.execute("INSERT INTO relay (identity) VALUES (?)", (GUARD_3_FPR,))
+    db_cursor.execute("INSERT INTO relay (identity) VALUES (?)", (sqlite_db.pack_identity(GUARD_3_FPR),))
     third_guard_idx = db_cursor.lastrowid
-    db_cursor.execute("INSERT INTO relay (identity) VALUES (?)", (GUARD_4_FPR,))
+    db_cursor.execute("INSERT INTO relay (identity) VALUES (?)", (sqlite_db.pack_identity(GUARD_4_FPR),))
     fourth_guard_idx = db_cursor.lastrowid
 
-    # Populate first consensus
-    db_cursor.execute("INSERT INTO guarddata (relay_id,consensus_id) VALUES (?,?)",
-                      (first_guard_idx, first_consensus_idx))
-    db_cursor.execute("INSERT INTO guarddata (relay_id,consensus_id) VALUES (?,?)",
-                      (second_guard_idx, first_consensus_idx))
-    db_cursor.execute("INSERT INTO guarddata (relay_id,consensus_id) VALUES (?,?)",
-                      (third_guard_idx, first_consensus_idx))
-
-    # Populate second consensus
-    db_cursor.execute("INSERT INTO guarddata (relay_id,consensus_id) VALUES (?,?)",
-                      (first_guard_idx, second_consensus_idx))
-    db_cursor.execute("INSERT INTO guarddata (relay_id,consensus_id) VALUES (?,?)",
-                      (second_guard_idx, second_consensus_idx))
-
-    # Populate third consensus
-    db_cursor.execute("INSERT INTO guarddata (relay_id,consensus_id) VALUES (?,?)",
-                      (first_guard_idx, third_consensus_idx))
-    db_cursor.execute("INSERT INTO guarddata (relay_id,consensus_id) VALUES (?,?)",
-                      (fourth_guard_idx, third_consensus_idx))
+    # Populate the consensuses
+    insert_guardset_helper(db_cursor, first_consensus_idx,
+                           [first_guard_idx, second_guard_idx, third_guard_idx])
+    insert_guardset_helper(db_cursor, second_consensus_idx,
+                           [first_guard_idx, second_guard_idx])
+    insert_guardset_helper(db_cursor, third_consensus_idx,
+                           [first_guard_idx, fourth_guard_idx])
+
+    # The importer would have kept the guard intervals up to date.
+    sqlite_db.rebuild_guard_stats(db_cursor.connection, db_cursor)
+
+def insert_guardset_helper(db_cursor, consensus_id, relay_ids):
+    """Store the guards with 'relay_ids' of the consensus with 'consensus_id'."""
+    db_cursor.execute("SELECT consensus_hour FROM consensus WHERE consensus_id=?", (consensus_id,))
+    sqlite_db.insert_guardset(db_cursor, consensus_id, db_cursor.fetchone()[0], relay_ids)
+
+def read_guardsets_helper(db_cursor):
+    """Return a sorted list of (consensus_id, list of relay_ids) tuples, from all partitions."""
+    guardsets = []
+    for partition in sqlite_db.get_guardset_partitions(db_cursor):
+        db_cursor.execute("SELECT consensus_id, relay_ids FROM %s" % partition)
+        guardsets.extend((row[0], list(sqlite_db.unpack_relay_ids(row[1])))
+                         for row in db_cursor.fetchall())
+
+    return sorted(guardsets)
+
+# The database schema before we started packing guards, with one
+# guarddata row per guard per consensus, text dates and hex identities.
+V1_SCHEMA = """
+CREATE TABLE relay (
+  relay_id INTEGER PRIMARY KEY AUTOINCREMENT,
+  identity BLOB NOT NULL,
+  UNIQUE(identity)
+);
+
+CREATE TABLE consensus (
+  consensus_id INTEGER PRIMARY KEY AUTOINCREMENT,
+  consensus_date DATETIME NOT NULL,
+   UNIQUE(consensus_date)
+);
+
+CREATE TABLE guarddata (
+  relay_id INTEGER REFERENCES relay(relay_id) ON DELETE CASCADE NOT NULL,
+  consensus_id INTEGER REFERENCES consensus(consensus_id) ON DELETE CASCADE NOT NULL
+);
+
+CREATE INDEX consensus_consensus_date_idx ON consensus(consensus_date);
+CREATE INDEX guarddata_relay_id_idx ON guarddata(relay_id);
+CREATE INDEX guarddata_consensus_id_idx ON guarddata(consensus_id);
+"""
+
+def populate_v1_db_helper(db_conn):
+    """Like populate_db_helper() but for a database with the V1_SCHEMA."""
+
+    db_conn.executescript(V1_SCHEMA)
+
+    db_conn.execute("INSERT INTO consensus (consensus_date) VALUES (datetime('now', '-1 day'))")
+    db_conn.execute("INSERT INTO consensus (consensus_date) VALUES (datetime('now', '-1 month'))")
+    db_conn.execute("INSERT INTO consensus (consensus_date) VALUES (datetime('now', '-1 month', '-1 hours'))")
+    # A consensus without any guards
+    db_conn.execute("INSERT INTO consensus (consensus_date) VALUES (datetime('now', '-1 month', '-2 hours'))")
+
+    for guard_fpr in (GUARD_1_FPR, GUARD_2_FPR, GUARD_3_FPR, GUARD_4_FPR):
+        db_conn.execute("INSERT INTO relay (identity) VALUES (?)", (guard_fpr,))
+
+    db_conn.executemany("INSERT INTO guarddata (relay_id,consensus_id) VALUES (?,?)",
+                        [(1, 1), (2, 1), (3, 1), (1, 2), (2, 2), (1, 3), (4, 3)])
+    db_conn.commit()
 
 class testMissingConsensuses(unittest.TestCase):
-    def test_missing_hours_from_list(self):
-        # Only 23/02/2012 11:00 is missing
-        hours_list = [datetime(2010,2,23,10), datetime(2010,2,23,12)]
-        missing_list = guardfraction.find_missing_hours_from_list(hours_list)
-        self.assertEquals(missing_list, [datetime(2010,2,23,11)])
-
-        # Hours between 01:00 to next day 02:00 are missing
-        hours_list = [datetime(2014,4,20,1), datetime(2014,4,21,2)]
-        missing_list = guardfraction.find_missing_hours_from_list(hours_list)
-        self.assertEquals(missing_list,
-                          [datetime(2014,4,20,2), datetime(2014,4,20,3),
-                           datetime(2014,4,20,4), datetime(2014,4,20,5),
-                           datetime(2014,4,20,6), datetime(2014,4,20,7),
-                           datetime(2014,4,20,8), datetime(2014,4,20,9),
-                           datetime(2014,4,20,10), datetime(2014,4,20,11),
-                           datetime(2014,4,20,12), datetime(2014,4,20,13),
-                           datetime(2014,4,20,14), datetime(2014,4,20,15),
-                           datetime(2014,4,20,16), datetime(2014,4,20,17),
-                           datetime(2014,4,20,18), datetime(2014,4,20,19),
-                           datetime(2014,4,20,20), datetime(2014,4,20,21),
-                           datetime(2014,4,20,22), datetime(2014,4,20,23),
-                           datetime(2014,4,21,0), datetime(2014,4,21,1)])
+    def test_missing_ranges_from_db(self):
+        """Test that gaps are found in the middle and at the edges of the window."""
+
+        db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+
+        # The whole window is missing.
+        now = datetime(2014, 7, 6, 4, 30)
+        this_hour = now.replace(minute=0)
+        now_hour = sqlite_db.datetime_to_hour(now)
+        missing_ranges = guardfraction.find_missing_ranges(db_cursor, 2, now)
+        self.assertEquals(missing_ranges, [(this_hour - timedelta(hours=47), this_hour)])
+
+        # Have all the hours of the past two days but a few.
+        for hours_ago in range(2, 10) + range(12, 46):
+            db_cursor.execute("INSERT INTO consensus (consensus_hour) VALUES (?)",
+                              (now_hour - hours_ago,))
+        # A consensus outside the window
+        db_cursor.execute("INSERT INTO consensus (consensus_hour) VALUES (?)",
+                          (now_hour - 3*24,))
+        db_conn.commit()
+
+        missing_ranges = guardfraction.find_missing_ranges(db_cursor, 2, now)
+        self.assertEquals(missing_ranges,
+                          [(this_hour - timedelta(hours=47), this_hour - timedelta(hours=46)),
+                           (this_hour - timedelta(hours=11), this_hour - timedelta(hours=10)),
+                           (this_hour - timedelta(hours=1), this_hour)])
+
+        # Older sqlite versions without window functions find the same gaps.
+        have_window_functions = sqlite_db.HAVE_WINDOW_FUNCTIONS
+        sqlite_db.HAVE_WINDOW_FUNCTIONS = False
+        try:
+            self.assertEquals(guardfraction.find_missing_ranges(db_cursor, 2, now), missing_ranges)
+            self.assertEquals(sqlite_db.get_window_gaps(db_cursor, now_hour - 4*24),
+                              [(now_hour - 3*24, now_hour - 45), (now_hour - 12, now_hour - 9)])
+        finally:
+            sqlite_db.HAVE_WINDOW_FUNCTIONS = have_window_functions
+        self.assertEquals(sqlite_db.get_window_gaps(db_cursor, now_hour - 4*24),
+                          [(now_hour - 3*24, now_hour - 45), (now_hour - 12, now_hour - 9)])
+
+        db_conn.close()
+
+    def test_backfill_plan(self):
+        """Test that the backfill plan points at the right CollecTor archive members."""
 
+        plan = collector.make_backfill_plan([(datetime(2014,6,30,22), datetime(2014,7,1,0)),
+                                             (datetime(2014,7,6,5), datetime(2014,7,6,5))])
+
+        self.assertEquals(plan["missing_n"], 4)
+        self.assertEquals(plan["missing_ranges"],
+                          [["2014-06-30 22:00:00", "2014-07-01 00:00:00"],
+                           ["2014-07-06 05:00:00", "2014-07-06 05:00:00"]])
+        self.assertEquals(plan["archives"], [
+            {"url" : collector.COLLECTOR_ARCHIVE_URL + "microdescs-2014-06.tar.xz",
+             "members" : ["microdescs-2014-06/consensus-microdesc/30/2014-06-30-22-00-00-consensus-microdesc",
+                          "microdescs-2014-06/consensus-microdesc/30/2014-06-30-23-00-00-consensus-microdesc"]},
+            {"url" : collector.COLLECTOR_ARCHIVE_URL + "microdescs-2014-07.tar.xz",
+             "members" : ["microdescs-2014-07/consensus-microdesc/01/2014-07-01-00-00-00-consensus-microdesc",
+                          "microdescs-2014-07/consensus-microdesc/06/2014-07-06-05-00-00-consensus-microdesc"]}])
 
 class testGuardFraction(unittest.TestCase):
     def test_guardfraction_from_db(self):
@@ -104,22 +198,59 @@ class testGuardFraction(unittest.TestCase):
         # Now make sure that guardfraction understood the correct data.
 
         self.assertEquals(consensuses_read_n, 3)
-        self.assertEquals(len(guards.guards), 4)
+        self.assertEquals(len(guards), 4)
         # Check the times_seen for each guard.
-        for guard_fpr, guard in guards.guards.items():
+        for guard_fpr, times_seen in guards.items():
             if guard_fpr == GUARD_1_FPR:
-                self.assertEquals(guard.times_seen, 3)
+                self.assertEquals(times_seen, 3)
             elif guard_fpr == GUARD_2_FPR:
-                self.assertEquals(guard.times_seen, 2)
+                self.assertEquals(times_seen, 2)
             elif guard_fpr == GUARD_3_FPR:
-                self.assertEquals(guard.times_seen, 1)
+                self.assertEquals(times_seen, 1)
             elif guard_fpr == GUARD_4_FPR:
-                self.assertEquals(guard.times_seen, 1)
+                self.assertEquals(times_seen, 1)
             else:
                 self.assertTrue(False) # Unknown guard!
 
         db_conn.close()
 
+    def test_guardfraction_windows_from_db(self):
+        """Test that counting several windows at once matches counting them one by one."""
+
+        windows = [7, 45, 999]
+        expected = {}
+        for days in windows:
+            db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+            populate_db_helper(db_cursor)
+            db_conn.commit()
+            guards, consensuses_read_n = guardfraction.read_db_file(db_conn, db_cursor, days)
+            expected[days] = (dict(guards.items()), consensuses_read_n)
+
+        db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+        populate_db_helper(db_cursor)
+        db_conn.commit()
+        windows_guards = guardfraction.read_db_file_windows(db_conn, db_cursor, 45, windows)
+
+        self.assertEquals(sorted(windows_guards), windows)
+        for days, (guards, consensuses_read_n) in windows_guards.iteritems():
+            self.assertEquals((dict(guards.items()), consensuses_read_n), expected[days])
+
+        self.assertEquals(expected[7], ({GUARD_1_FPR : 1, GUARD_2_FPR : 1, GUARD_3_FPR : 1}, 1))
+        self.assertEquals(expected[999][1], 3)
+
+        # The one pass also works on a query_only connection, like the
+        # aggregate profile's, and streams each window in the same order
+        # as a single window.
+        db_conn.execute("PRAGMA query_only = ON")
+        windows_guards = guardfraction.read_db_file_windows(db_conn, db_cursor, 45, windows)
+        for days in windows:
+            window_start = sqlite_db.get_window_start(db_cursor, days)
+            self.assertEquals(list(windows_guards[days][0]),
+                              list(sqlite_db.iter_interval_guards(db_conn, db_cursor, window_start)))
+        self.assertEquals(db_conn.execute("PRAGMA query_only").fetchone()[0], 1)
+        self.assertRaises(sqlite3.OperationalError, db_conn.execute, "DELETE FROM consensus")
+        db_conn.close()
+
     def test_output_file(self):
         """
         Using the test database again, test that the guardfraction
@@ -161,5 +292,708 @@ class testGuardFraction(unittest.TestCase):
 
         db_conn.close()
 
+class testGuards(unittest.TestCase):
+    def test_output_order_and_rounding(self):
+        """Test that guards come out most seen first, with halves rounded up."""
+
+        guards = guard_ds.Guards()
+        guards.register_guard(GUARD_1_FPR, 1)
+        guards.register_guard(GUARD_2_FPR, 8)
+        guards.register_guard(GUARD_3_FPR, 3)
+        # Ties go to the lower relay_id.
+        guards.register_guard(GUARD_5_FPR, 3, 5)
+        guards.register_guard(GUARD_4_FPR, 3, 4)
+
+        temp_file, temp_path = tempfile.mkstemp()
+        os.close(temp_file)
+        # Split the guards across batches.
+        guard_ds.OUTPUT_BATCH_ROWS = 2
+        try:
+            guards.write_output_file(temp_path, 1, 8)
+            with open(temp_path) as test_fd:
+                lines = test_fd.readlines()
+        finally:
+            guard_ds.OUTPUT_BATCH_ROWS = 4096
+            os.remove(temp_path)
+
+        self.assertEquals(lines[2], "n-inputs 8 1 24\n")
+        self.assertEquals(lines[3:],
+                          ["guard-seen BBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBB 100 8\n",
+                           "guard-seen CCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCC 38 3\n",
+                           "guard-seen DDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDD 38 3\n",
+                           "guard-seen EEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEE 38 3\n",
+                           "guard-seen AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA 13 1\n"])
+
+    def test_streamed_guards(self):
+        """Test that streamed guards make the same output file as in-memory ones, on every pass."""
+
+        guards = guard_ds.Guards()
+        guards.register_guard(GUARD_1_FPR, 1)
+        guards.register_guard(GUARD_2_FPR, 8)
+
+        streamed_guards = guard_ds.StreamedGuards(lambda: iter([(GUARD_2_FPR, 8), (GUARD_1_FPR, 1)]))
+        self.assertEquals(len(streamed_guards), 2)
+        self.assertEquals(streamed_guards.items(), list(guards))
+
+        temp_dir = tempfile.mkdtemp()
+        output_path = os.path.join(temp_dir, "guardfraction.output")
+        try:
+            self.assertTrue(guards.write_output_file(output_path, 1, 8))
+            self.assertFalse(streamed_guards.write_output_file(output_path, 1, 8))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_output_file_only_changes_with_guard_data(self):
+        """
+        Test that rewriting the output file with the same guard data
+        leaves it alone, and that its digest follows real changes.
+        """
+
+        guards = guard_ds.Guards()
+        guards.register_guard(GUARD_1_FPR, 2)
+        guards.register_guard(GUARD_2_FPR, 1)
+
+        temp_dir = tempfile.mkdtemp()
+        output_path = os.path.join(temp_dir, "guardfraction.output")
+        try:
+            self.assertTrue(guards.write_output_file(output_path, 1, 2))
+            first_digest = guard_ds.read_output_digest(output_path)
+            with open(output_path) as output_fd:
+                first_output = output_fd.read()
+
+            # Same data: the file stays as it is.
+            self.assertFalse(guards.write_output_file(output_path, 1, 2))
+            self.assertEquals(guard_ds.read_output_digest(output_path), first_digest)
+            with open(output_path) as output_fd:
+                self.assertEquals(output_fd.read(), first_output)
+
+            # New data: new file and new digest.
+            guards.register_guard(GUARD_3_FPR, 1)
+            self.assertTrue(guards.write_output_file(output_path, 1, 2))
+            self.assertNotEquals(guard_ds.read_output_digest(output_path), first_digest)
+
+            # No temporary files left behind.
+            self.assertEquals(sorted(os.listdir(temp_dir)),
+                              ["guardfraction.output", "guardfraction.output" + guard_ds.DIGEST_SUFFIX])
+        finally:
+            shutil.rmtree(temp_dir)
+
+class testGuardCounts(unittest.TestCase):
+    def read_guard_count_table(self, db_cursor):
+        db_cursor.execute("SELECT relay.identity, guard_count.times_seen FROM guard_count "
+                          "JOIN relay ON relay.relay_id = guard_count.relay_id")
+        return dict((sqlite_db.unpack_identity(row[0]), row[1]) for row in db_cursor.fetchall())
+
+    def test_guard_counts_follow_window(self):
+        """
+        Test that the running guard counters are kept up to date by
+        the importer and by window expiry, and that guardfraction reads
+        them right even when they lag behind.
+        """
+
+        temp_file, temp_path = tempfile.mkstemp()
+        os.close(temp_file)
+        os.remove(temp_path)
+
+        try:
+            db_conn, db_cursor = sqlite_db.init_db(temp_path, SQLITE_DB_SCHEMA, "import")
+            populate_db_helper(db_cursor)
+            db_conn.commit()
+
+            # First update counts everything from scratch.
+            sqlite_db.update_guard_counts(db_conn, db_cursor, 60,
+                                          sqlite_db.get_window_start(db_cursor, 60))
+
+            # Import a new consensus with guard_1 and a brand new guard.
+            parser = consensus.ConsensusParser()
+            parser.import_guards(datetime.utcnow() - timedelta(hours=1), [GUARD_1_FPR, GUARD_5_FPR], db_cursor)
+            db_conn.commit()
+
+            self.assertEquals(self.read_guard_count_table(db_cursor),
+                              {GUARD_1_FPR : 4, GUARD_2_FPR : 2, GUARD_3_FPR : 1,
+                               GUARD_4_FPR : 1, GUARD_5_FPR : 1})
+
+            # Pretend that the counters were last moved to a 20 day
+            # window 40 days ago, so that the two month-old consensuses
+            # have expired since.
+            db_cursor.execute("UPDATE guard_count_window SET max_days = 20, window_start = ?",
+                              (sqlite_db.datetime_to_hour(datetime.utcnow() - timedelta(days=60)),))
+            db_conn.commit()
+            db_conn.close()
+
+            expected_guards = {GUARD_1_FPR : 2, GUARD_2_FPR : 1, GUARD_3_FPR : 1, GUARD_5_FPR : 1}
+
+            # guardfraction subtracts the expired consensuses on its own,
+            # without touching the database.
+            db_conn, db_cursor = sqlite_db.init_db(temp_path, profile="aggregate")
+            guards, consensuses_read_n = guardfraction.read_db_file(db_conn, db_cursor, 20)
+            self.assertEquals(consensuses_read_n, 2)
+            self.assertEquals(dict(guards.items()),
+                              expected_guards)
+
+            # The guards whose counts went down are merged back in
+            # order, just like when counting from scratch.
+            window_start = sqlite_db.get_window_start(db_cursor, 20)
+            self.assertEquals(guards.items(),
+                              list(sqlite_db.iter_counter_guards(
+                                  db_cursor, sqlite_db.count_window_guardsets(db_conn, window_start))))
+            self.assertEquals([times_seen for _, times_seen in guards.items()], [2, 1, 1, 1])
+            db_conn.close()
+
+            db_conn, db_cursor = sqlite_db.init_db(temp_path, profile="import")
+            self.assertEquals(self.read_guard_count_table(db_cursor)[GUARD_1_FPR], 4)
+
+            # Moving the counters forgets about the expired consensuses.
+            sqlite_db.update_guard_counts(db_conn, db_cursor, 20,
+                                          sqlite_db.get_window_start(db_cursor, 20))
+            self.assertEquals(self.read_guard_count_table(db_cursor), expected_guards)
+
+            # And so does deleting them.
+            guards, consensuses_read_n = guardfraction.read_db_file(db_conn, db_cursor, 20, delete_expired=True)
+            self.assertEquals(dict(guards.items()),
+                              expected_guards)
+        finally:
+            os.remove(temp_path)
+
+    def test_aggregate_profile_is_read_only(self):
+        """Test that the aggregation connection profile can't write."""
+
+        temp_file, temp_path = tempfile.mkstemp()
+        os.close(temp_file)
+        os.remove(temp_path)
+
+        try:
+            db_conn, db_cursor = sqlite_db.init_db(temp_path, SQLITE_DB_SCHEMA, "import")
+            db_conn.close()
+
+            db_conn, db_cursor = sqlite_db.init_db(temp_path, profile="aggregate")
+            self.assertRaises(sqlite3.OperationalError, db_cursor.execute,
+                              "INSERT INTO relay (identity) VALUES (?)", (GUARD_1_FPR,))
+            db_conn.close()
+        finally:
+            os.remove(temp_path)
+
+    def test_profile_busy_timeouts(self):
+        """Test that aggregation gives up on a locked database sooner than imports."""
+
+        busy_timeouts = {}
+        for profile in sqlite_db.CONNECTION_PROFILES:
+            db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA, profile)
+            busy_timeouts[profile] = db_conn.execute("PRAGMA busy_timeout").fetchone()[0]
+            db_conn.close()
+
+        self.assertEquals(busy_timeouts, {"default" : 900*1000, "import" : 900*1000, "aggregate" : 30*1000})
+
+class testGuardDecay(unittest.TestCase):
+    def read_guard_decay_table(self, db_cursor):
+        scores, total = sqlite_db.read_guard_decay(db_cursor)
+        identities = sqlite_db.get_relay_identities(db_cursor, scores.keys())
+        return dict((identities[relay_id], score) for relay_id, score in scores.iteritems()), total
+
+    def test_streaming_scores_match_rescoring(self):
+        """
+        Test that the decayed scores the importer keeps up to date,
+        even with consensuses arriving out of order, are the same as
+        scoring all the consensuses from scratch.
+        """
+
+        db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+        self.assertEquals(sqlite_db.read_guard_decay(db_cursor), None)
+        sqlite_db.update_guard_decay(db_conn, db_cursor, 1)
+
+        parser = consensus.ConsensusParser()
+        parser.import_guards(datetime(2014, 7, 1, 0), [GUARD_1_FPR, GUARD_2_FPR], db_cursor)
+        parser.import_guards(datetime(2014, 7, 2, 0), [GUARD_1_FPR], db_cursor)
+        parser.import_guards(datetime(2014, 7, 1, 12), [GUARD_1_FPR, GUARD_3_FPR], db_cursor)
+        db_conn.commit()
+
+        # Scores are as of the newest consensus, and halve every day.
+        scores, total = self.read_guard_decay_table(db_cursor)
+        self.assertAlmostEquals(total, 1 + 0.5 + 0.5 ** 0.5)
+        self.assertAlmostEquals(scores[GUARD_1_FPR], 1 + 0.5 + 0.5 ** 0.5)
+        self.assertAlmostEquals(scores[GUARD_2_FPR], 0.5)
+        self.assertAlmostEquals(scores[GUARD_3_FPR], 0.5 ** 0.5)
+
+        # A new half-life means scoring from scratch.
+        sqlite_db.update_guard_decay(db_conn, db_cursor, 2)
+        sqlite_db.update_guard_decay(db_conn, db_cursor, 1)
+        rescored_scores, rescored_total = self.read_guard_decay_table(db_cursor)
+        self.assertAlmostEquals(rescored_total, total)
+        self.assertEquals(sorted(rescored_scores), sorted(scores))
+        for guard_fpr, score in scores.iteritems():
+            self.assertAlmostEquals(rescored_scores[guard_fpr], score)
+
+        # Scores that decay too much get forgotten.
+        parser.import_guards(datetime(2014, 7, 3, 0), [GUARD_1_FPR], db_cursor)
+        scores, total = self.read_guard_decay_table(db_cursor)
+        self.assertEquals(sorted(scores), [GUARD_1_FPR])
+
+        db_conn.close()
+
+    def test_decayed_guardfraction(self):
+        """Test that guardfraction turns decayed scores into whole consensuses."""
+
+        db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+        sqlite_db.update_guard_decay(db_conn, db_cursor, 30)
+        parser = consensus.ConsensusParser()
+        for hour in xrange(48):
+            guard_fprs = [GUARD_1_FPR, GUARD_2_FPR] if hour % 2 else [GUARD_1_FPR]
+            parser.import_guards(datetime(2014, 7, 1) + timedelta(hours=hour), guard_fprs, db_cursor)
+        db_conn.commit()
+
+        # guard_1 is in all 48 consensuses and guard_2 in every other
+        # one, ending with the newest one.
+        weights = [0.5 ** (hours_ago / (30 * 24.)) for hours_ago in xrange(48)]
+        self.assertEquals((int(round(sum(weights))), int(round(sum(weights[::2])))), (47, 23))
+
+        guards, consensuses_read_n, ideal_consensuses_n = guardfraction.read_db_file_decayed(db_conn, db_cursor, 30)
+        self.assertEquals(consensuses_read_n, 47)
+        self.assertEquals(dict(guards.items()), {GUARD_1_FPR : 47, GUARD_2_FPR : 23})
+
+        # An unbroken history decays to 30 days over ln 2 worth of
+        # consensuses.
+        self.assertEquals(ideal_consensuses_n, int(round(1 / (1 - 0.5 ** (1 / (30 * 24.))))))
+        self.assertEquals(ideal_consensuses_n // 24, 43)
+
+        temp_file, temp_path = tempfile.mkstemp()
+        os.close(temp_file)
+        try:
+            guard_ds.write_output_file(temp_path, 43, consensuses_read_n, guards, ideal_consensuses_n)
+            with open(temp_path) as test_fd:
+                self.assertEquals(test_fd.readlines()[2], "n-inputs 47 43 %d\n" % ideal_consensuses_n)
+        finally:
+            os.remove(temp_path)
+
+        db_conn.close()
+
+class testPartitions(unittest.TestCase):
+    def test_partition_bounds(self):
+        """Test that consensuses go to the partition of their month."""
+        to_hour = sqlite_db.datetime_to_hour
+        self.assertEquals(sqlite_db._get_partition_bounds(to_hour(datetime(2014, 7, 31, 23))),
+                          ("guardset_2014_07", to_hour(datetime(2014, 7, 1)), to_hour(datetime(2014, 8, 1))))
+        self.assertEquals(sqlite_db._get_partition_bounds(to_hour(datetime(2014, 12, 1))),
+                          ("guardset_2014_12", to_hour(datetime(2014, 12, 1)), to_hour(datetime(2015, 1, 1))))
+
+    def test_expiry_drops_whole_partitions(self):
+        """
+        Test that expiring consensuses drops the partitions that fell
+        out of the window, and only deletes single consensuses from the
+        partition that the window starts in.
+        """
+
+        to_hour = sqlite_db.datetime_to_hour
+        db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+        parser = consensus.ConsensusParser()
+        for valid_after in (datetime(2014, 5, 20, 10), datetime(2014, 6, 30, 23),
+                            datetime(2014, 7, 1), datetime(2014, 7, 10), datetime(2014, 8, 2)):
+            parser.import_guards(valid_after, [GUARD_1_FPR], db_cursor)
+        db_conn.commit()
+
+        self.assertEquals(sqlite_db.get_guardset_partitions(db_cursor),
+                          ["guardset_2014_05", "guardset_2014_06", "guardset_2014_07", "guardset_2014_08"])
+        self.assertEquals(sqlite_db.get_guardset_partitions(db_cursor, to_hour(datetime(2014, 6, 30, 23)),
+                                                            to_hour(datetime(2014, 7, 1))),
+                          ["guardset_2014_06"])
+
+        sqlite_db.drop_expired_consensuses(db_conn, to_hour(datetime(2014, 7, 5)))
+
+        self.assertEquals(sqlite_db.get_guardset_partitions(db_cursor),
+                          ["guardset_2014_07", "guardset_2014_08"])
+        db_cursor.execute("SELECT count(*) FROM sqlite_master WHERE name IN ('guardset_2014_05', 'guardset_2014_06')")
+        self.assertEquals(db_cursor.fetchone()[0], 0)
+        db_cursor.execute("SELECT consensus_hour FROM consensus ORDER BY consensus_hour")
+        self.assertEquals([row[0] for row in db_cursor.fetchall()],
+                          [to_hour(datetime(2014, 7, 10)), to_hour(datetime(2014, 8, 2))])
+        self.assertEquals([consensus_id for consensus_id, _ in read_guardsets_helper(db_cursor)],
+                          [4, 5])
+        self.assertEquals(sqlite_db.count_window_guardsets(db_cursor, to_hour(datetime(2014, 7, 5))),
+                          {1 : 2})
+
+        db_conn.close()
+
+class testGuardHistory(unittest.TestCase):
+    def read_guard_interval_table(self, db_cursor):
+        db_cursor.execute("SELECT relay_id, start_hour, end_hour FROM guard_interval")
+        return sorted(tuple(row) for row in db_cursor.fetchall())
+
+    def test_guard_intervals(self):
+        """
+        Test that the importer keeps the guard intervals right, even
+        when missing consensuses get filled in later.
+        """
+
+        db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+        parser = consensus.ConsensusParser()
+        parser.import_guards(datetime(2014, 7, 1, 0), [GUARD_1_FPR, GUARD_2_FPR], db_cursor)
+        parser.import_guards(datetime(2014, 7, 1, 1), [GUARD_1_FPR], db_cursor)
+        parser.import_guards(datetime(2014, 7, 1, 3), [GUARD_1_FPR, GUARD_2_FPR], db_cursor)
+        parser.import_guards(datetime(2014, 7, 1, 4), [GUARD_2_FPR], db_cursor)
+        db_conn.commit()
+
+        # 02:00 is missing, so it splits the history of guard_1.
+        self.assertEquals(history.get_guard_intervals(db_cursor, [GUARD_1_FPR]),
+                          {GUARD_1_FPR : [(datetime(2014, 7, 1, 0), datetime(2014, 7, 1, 1)),
+                                          (datetime(2014, 7, 1, 3), datetime(2014, 7, 1, 3))]})
+
+        # Until it shows up.
+        parser.import_guards(datetime(2014, 7, 1, 2), [GUARD_1_FPR], db_cursor)
+        db_conn.commit()
+
+        to_hour = sqlite_db.datetime_to_hour
+        self.assertEquals(history.get_guard_intervals(db_cursor, [GUARD_1_FPR, GUARD_2_FPR, GUARD_3_FPR],
+                                                      to_hour(datetime(2014, 7, 1, 1)), to_hour(datetime(2014, 7, 2))),
+                          {GUARD_1_FPR : [(datetime(2014, 7, 1, 1), datetime(2014, 7, 1, 3))],
+                           GUARD_2_FPR : [(datetime(2014, 7, 1, 3), datetime(2014, 7, 1, 4))],
+                           GUARD_3_FPR : []})
+
+        # Finding the intervals from scratch gives the same result.
+        guard_intervals = self.read_guard_interval_table(db_cursor)
+        sqlite_db._rebuild_guard_intervals(db_conn)
+        self.assertEquals(self.read_guard_interval_table(db_cursor), guard_intervals)
+
+        # Expired consensuses take their part of the intervals with them.
+        sqlite_db.drop_expired_consensuses(db_conn, to_hour(datetime(2014, 7, 1, 2)))
+        self.assertEquals(history.get_guard_intervals(db_cursor, [GUARD_1_FPR, GUARD_2_FPR]),
+                          {GUARD_1_FPR : [(datetime(2014, 7, 1, 2), datetime(2014, 7, 1, 3))],
+                           GUARD_2_FPR : [(datetime(2014, 7, 1, 3), datetime(2014, 7, 1, 4))]})
+
+        db_conn.close()
+
+    def test_guardset_delta(self):
+        """
+        Test that consensuses right after the newest one only touch the
+        intervals of the guards that changed.
+        """
+
+        db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+        parser = consensus.ConsensusParser()
+        parser.import_guards(datetime(2014, 7, 1, 0), [GUARD_1_FPR, GUARD_2_FPR], db_cursor)
+
+        stats.reset()
+        parser.import_guards(datetime(2014, 7, 1, 1), [GUARD_1_FPR, GUARD_3_FPR], db_cursor)
+        self.assertEquals(stats.get_summary("test")["counters"]["guard_intervals_opened"], 1)
+        self.assertEquals(stats.get_summary("test")["counters"]["guard_intervals_closed"], 1)
+        db_conn.commit()
+
+        # A new parser diffs against the open intervals in the database.
+        stats.reset()
+        parser = consensus.ConsensusParser()
+        parser.import_guards(datetime(2014, 7, 1, 2), [GUARD_1_FPR], db_cursor)
+        self.assertEquals(stats.get_summary("test")["counters"]["guard_intervals_opened"], 0)
+        self.assertEquals(stats.get_summary("test")["counters"]["guard_intervals_closed"], 1)
+
+        # 03:00 is missing.
+        parser.import_guards(datetime(2014, 7, 1, 4), [GUARD_1_FPR, GUARD_2_FPR], db_cursor)
+        db_conn.commit()
+
+        self.assertEquals(history.get_guard_intervals(db_cursor, [GUARD_1_FPR, GUARD_2_FPR, GUARD_3_FPR]),
+                          {GUARD_1_FPR : [(datetime(2014, 7, 1, 0), datetime(2014, 7, 1, 2)),
+                                          (datetime(2014, 7, 1, 4), datetime(2014, 7, 1, 4))],
+                           GUARD_2_FPR : [(datetime(2014, 7, 1, 0), datetime(2014, 7, 1, 0)),
+                                          (datetime(2014, 7, 1, 4), datetime(2014, 7, 1, 4))],
+                           GUARD_3_FPR : [(datetime(2014, 7, 1, 1), datetime(2014, 7, 1, 1))]})
+
+        guard_intervals = self.read_guard_interval_table(db_cursor)
+        sqlite_db._rebuild_guard_intervals(db_conn)
+        self.assertEquals(self.read_guard_interval_table(db_cursor), guard_intervals)
+
+        db_conn.close()
+
+    def test_daily_guardfraction(self):
+        """Test that the daily guardfraction only counts the consensuses we have."""
+
+        db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+        parser = consensus.ConsensusParser()
+        # All the hours of the first day, and six of the second one.
+        for hour in xrange(30):
+            guard_fprs = [GUARD_1_FPR] + ([GUARD_2_FPR] if 20 <= hour < 26 else [])
+            parser.import_guards(datetime(2014, 7, 1) + timedelta(hours=hour), guard_fprs, db_cursor)
+        db_conn.commit()
+
+        to_hour = sqlite_db.datetime_to_hour
+        daily_guardfraction = history.get_daily_guardfraction(db_cursor, [GUARD_1_FPR, GUARD_2_FPR, GUARD_3_FPR],
+                                                              to_hour(datetime(2014, 6, 1)), to_hour(datetime(2014, 8, 1)))
+        day_1, day_2 = datetime(2014, 7, 1).date(), datetime(2014, 7, 2).date()
+        self.assertEquals(daily_guardfraction,
+                          {GUARD_1_FPR : [(day_1, 1.0), (day_2, 1.0)],
+                           GUARD_2_FPR : [(day_1, 4 / 24.), (day_2, 2 / 6.)],
+                           GUARD_3_FPR : [(day_1, 0.0), (day_2, 0.0)]})
+
+        db_conn.close()
+
+REPLAY_START = datetime(2014, 7, 1)
+
+def populate_replay_db_helper(db_cursor, hours=xrange(72)):
+    """
+    Import three days of hourly consensuses, minus a few, with guards
+    coming and going at different paces. 'hours' is the order to
+    import them in.
+    """
+    parser = consensus.ConsensusParser()
+    for hour in hours:
+        if hour in (5, 30, 31, 32):
+            continue
+
+        guard_fprs = [GUARD_1_FPR]
+        if hour % 2:
+            guard_fprs.append(GUARD_2_FPR)
+        if hour % 7 < 3:
+            guard_fprs.append(GUARD_3_FPR)
+        if 20 <= hour < 50:
+            guard_fprs.append(GUARD_4_FPR)
+        parser.import_guards(REPLAY_START + timedelta(hours=hour), guard_fprs, db_cursor)
+
+def read_replay_file_helper(replay_path):
+    """
+    Read a replay file and return a list of (as-of line, dict mapping
+    guard fpr to its guard-seen line) tuples, applying diffs as we go.
+    """
+    blocks = []
+    guards = {}
+    with open(replay_path) as replay_fd:
+        for line in replay_fd.readlines()[2:]:
+            fields = line.split()
+            if fields[0] == "as-of":
+                guards = dict(guards) if "diffs" in replay_path else {}
+                blocks.append((line, guards))
+            elif fields[0] == "guard-seen":
+                guards[fields[1]] = line
+            elif fields[0] == "guard-gone":
+                del guards[fields[1]]
+
+    return blocks
+
+class testReplay(unittest.TestCase):
+    def test_window_as_of(self):
+        """Test that windows can be placed in the past."""
+
+        db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+        as_of = datetime(2014, 7, 6, 4, 30)
+        self.assertEquals(replay.get_window_bounds(db_cursor, 1, as_of),
+                          (sqlite_db.datetime_to_hour(datetime(2014, 7, 5, 5)),
+                           sqlite_db.datetime_to_hour(datetime(2014, 7, 6, 5))))
+        db_conn.close()
+
+    def test_sliding_window_matches_counting(self):
+        """Test that sliding the window gives the same counts as counting each window from scratch."""
+
+        db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+        populate_replay_db_helper(db_cursor)
+        db_conn.commit()
+
+        for step_hours in (1, 5, 30):
+            steps_n = 0
+            for as_of, consensuses_read_n, times_seen_counter, _ in replay.iter_replay_windows(
+                    db_conn, db_cursor, 1, REPLAY_START, REPLAY_START + timedelta(days=4), step_hours):
+                window_start, window_end = replay.get_window_bounds(db_cursor, 1, as_of)
+                self.assertEquals(dict(times_seen_counter),
+                                  dict(sqlite_db.count_window_guardsets(db_conn, window_start, window_end)))
+                self.assertEquals(consensuses_read_n,
+                                  sqlite_db.count_range_consensuses(db_cursor, window_start, window_end))
+                steps_n += 1
+            self.assertEquals(steps_n, 96 // step_hours + 1)
+
+        # A single point in time reads the same guards.
+        as_of = REPLAY_START + timedelta(hours=40)
+        guards, consensuses_read_n = guardfraction.read_db_file(db_conn, db_cursor, 1, as_of=as_of)
+        self.assertEquals(consensuses_read_n, 22)
+        self.assertEquals(dict(guards.items()),
+                          {GUARD_1_FPR : 22, GUARD_2_FPR : 11, GUARD_3_FPR : 9, GUARD_4_FPR : 18})
+
+        db_conn.close()
+
+    def test_interval_counts_match_guardsets(self):
+        """Test that counting guard intervals gives the same guards, in the same order, as counting guardsets."""
+
+        # Backfilling merges intervals differently than appending.
+        for hours in (xrange(72), range(40, 72) + range(20, 40)[::-1] + range(20)):
+            db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+            populate_replay_db_helper(db_cursor, hours)
+            db_conn.commit()
+
+            to_hour = sqlite_db.datetime_to_hour
+            for window_start, window_end in [(to_hour(REPLAY_START), None),
+                                             (to_hour(REPLAY_START) + 25, None),
+                                             (to_hour(REPLAY_START) - 10, to_hour(REPLAY_START) + 31),
+                                             (to_hour(REPLAY_START) + 6, to_hour(REPLAY_START) + 7),
+                                             (to_hour(REPLAY_START) + 60, to_hour(REPLAY_START) + 200)]:
+                self.assertEquals(list(sqlite_db.iter_interval_guards(db_conn, db_cursor, window_start, window_end)),
+                                  list(sqlite_db.iter_counter_guards(
+                                      db_cursor, sqlite_db.count_window_guardsets(db_conn, window_start, window_end))))
+
+            db_conn.close()
+
+    def test_replay_diffs_add_up_to_snapshots(self):
+        """Test that applying the diffs of a replay file gives its snapshots."""
+
+        db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+        populate_replay_db_helper(db_cursor)
+        db_conn.commit()
+
+        temp_dir = tempfile.mkdtemp()
+        snapshots_path = os.path.join(temp_dir, "snapshots")
+        diffs_path = os.path.join(temp_dir, "diffs")
+        last_as_of = REPLAY_START + timedelta(days=4)
+        try:
+            self.assertEquals(replay.write_replay_file(db_conn, db_cursor, 1, REPLAY_START, last_as_of, 1,
+                                                       snapshots_path), 97)
+            replay.write_replay_file(db_conn, db_cursor, 1, REPLAY_START, last_as_of, 1, diffs_path, diffs=True)
+
+            snapshots = read_replay_file_helper(snapshots_path)
+            self.assertEquals(read_replay_file_helper(diffs_path), snapshots)
+            self.assertTrue(os.path.getsize(diffs_path) < os.path.getsize(snapshots_path))
+
+            # Each snapshot is what the output file would have said back then.
+            as_of_line, guards = snapshots[40]
+            self.assertEquals(as_of_line, "as-of 2014-07-02 16:00:00 n-inputs 22 1 24\n")
+            self.assertEquals(guards[GUARD_4_FPR], "guard-seen %s 82 18\n" % GUARD_4_FPR)
+            output_path = os.path.join(temp_dir, "output")
+            window_guards, consensuses_read_n = guardfraction.read_db_file(
+                db_conn, db_cursor, 1, as_of=REPLAY_START + timedelta(hours=40))
+            window_guards.write_output_file(output_path, 1, consensuses_read_n)
+            with open(output_path) as output_fd:
+                self.assertEquals(sorted(output_fd.readlines()[3:]), sorted(guards.values()))
+
+            # Everyone is gone once the window is past the last consensus.
+            self.assertEquals(snapshots[-1], ("as-of 2014-07-05 00:00:00 n-inputs 0 1 24\n", {}))
+        finally:
+            shutil.rmtree(temp_dir)
+
+        db_conn.close()
+
+    def test_as_of_keeps_output_file(self):
+        """Test that a single --as-of doesn't write to the output file that tor reads, unless told to."""
+
+        temp_dir = tempfile.mkdtemp()
+        db_path = os.path.join(temp_dir, "guardfraction.db")
+        old_cwd = os.getcwd()
+        try:
+            db_conn, db_cursor = sqlite_db.init_db(db_path, SQLITE_DB_SCHEMA)
+            populate_replay_db_helper(db_cursor)
+            db_conn.commit()
+            db_conn.close()
+
+            os.chdir(temp_dir)
+            guardfraction.run_guardfraction(guardfraction.parse_cmd_args(
+                ["--db-file", db_path, "--as-of", "2014-07-02 16:00", "1"]))
+            self.assertEquals(sorted(os.listdir(temp_dir)),
+                              sorted(["guardfraction.db", "guardfraction.as-of", "guardfraction.as-of.sha256"]))
+            with open(guardfraction.DEFAULT_AS_OF_FNAME) as as_of_fd:
+                self.assertEquals(as_of_fd.readlines()[2], "n-inputs 22 1 24\n")
+
+            guardfraction.run_guardfraction(guardfraction.parse_cmd_args(
+                ["--db-file", db_path, "--as-of", "2014-07-02 16:00", "-o", "past.output", "1"]))
+            self.assertTrue(os.path.exists("past.output"))
+            self.assertFalse(os.path.exists(guardfraction.DEFAULT_OUTPUT_FNAME))
+        finally:
+            os.chdir(old_cwd)
+            shutil.rmtree(temp_dir)
+
+class testQueryPlans(unittest.TestCase):
+    def assertIndexRangePlan(self, db_cursor, query, params, first_step="SEARCH consensus USING COVERING INDEX"):
+        """
+        Assert that sqlite serves 'query' with a search over an index,
+        starting with 'first_step', and never scans a whole table.
+        """
+        db_cursor.execute("EXPLAIN QUERY PLAN " + query, params)
+        plan = [row[3] for row in db_cursor.fetchall()]
+
+        for step in plan:
+            self.assertFalse(step.startswith("SCAN"), "%s: %s" % (query, plan))
+        self.assertTrue(plan[0].startswith(first_step), "%s: %s" % (query, plan))
+
+    def test_window_queries_use_index(self):
+        """Test that the window queries only touch the consensuses of the window."""
+
+        db_conn, db_cursor = sqlite_db.init_db(SQLITE_DB_FILE, SQLITE_DB_SCHEMA)
+        populate_db_helper(db_cursor)
+        db_conn.commit()
+        db_cursor.execute("ANALYZE")
+
+        window_start = sqlite_db.datetime_to_hour(datetime(2014, 7, 6, 4))
+        window_end = window_start + 24
+        partition = sqlite_db.get_guardset_partitions(db_cursor)[0]
+        self.assertIndexRangePlan(db_cursor, sqlite_db.WINDOW_CONSENSUS_COUNT_SQL, (window_start,))
+        self.assertIndexRangePlan(db_cursor, sqlite_db.PARTITION_GUARDSETS_SQL % partition, (window_start, window_end))
+        self.assertIndexRangePlan(db_cursor, sqlite_db.WINDOW_EDGES_SQL, (window_start,))
+        self.assertIndexRangePlan(db_cursor, sqlite_db.RANGE_CONSENSUS_COUNT_SQL, (window_start, window_end))
+        self.assertIndexRangePlan(db_cursor, sqlite_db.INTERVAL_GUARD_ROWS_SQL,
+                                  (window_end, window_start, window_start, window_end),
+                                  "SEARCH guard_interval USING INDEX guard_interval_end_hour_idx (end_hour>?)")
+
+        db_conn.close()
+
+class testSchemaMigration(unittest.TestCase):
+    def test_migrate_v1_db(self):
+        """Test that databases with one row per guard get packed properly."""
+
+        temp_file, temp_path = tempfile.mkstemp()
+        os.close(temp_file)
+
+        try:
+            db_conn = sqlite3.connect(temp_path)
+            populate_v1_db_helper(db_conn)
+            db_conn.close()
+
+            # Opening the database should migrate it.
+            db_conn, db_cursor = sqlite_db.init_db(temp_path)
+
+            db_cursor.execute("PRAGMA user_version")
+            self.assertEquals(db_cursor.fetchone()[0], sqlite_db.SCHEMA_VERSION)
+            db_cursor.execute("SELECT count(*) FROM sqlite_master WHERE name IN ('guarddata', 'consensus_consensus_date_idx')")
+            self.assertEquals(db_cursor.fetchone()[0], 0)
+
+            self.assertEquals(read_guardsets_helper(db_cursor),
+                              [(1, [1, 2, 3]), (2, [1, 2]), (3, [1, 4]), (4, [])])
+
+            # The month-old consensuses are an hour apart, and guard_1 is in both.
+            self.assertEquals(dict((fingerprint, len(intervals)) for fingerprint, intervals in
+                                   history.get_guard_intervals(db_cursor, [GUARD_1_FPR, GUARD_4_FPR]).iteritems()),
+                              {GUARD_1_FPR : 2, GUARD_4_FPR : 1})
+
+            # Dates became hours and identities became raw digests.
+            db_cursor.execute("SELECT typeof(consensus_hour) FROM consensus")
+            self.assertEquals(set(row[0] for row in db_cursor.fetchall()), set(["integer"]))
+            db_cursor.execute("SELECT length(identity) FROM relay")
+            self.assertEquals(set(row[0] for row in db_cursor.fetchall()), set([20]))
+
+            guards, consensuses_read_n = guardfraction.read_db_file(db_conn, db_cursor, 999)
+            self.assertEquals(consensuses_read_n, 4)
+            self.assertEquals(dict(guards.items()),
+                              {GUARD_1_FPR : 3, GUARD_2_FPR : 2, GUARD_3_FPR : 1, GUARD_4_FPR : 1})
+        finally:
+            os.remove(temp_path)
+
+    def test_migrate_v8_db(self):
+        """Test that the guard intervals that reach the newest consensus get opened."""
+
+        temp_file, temp_path = tempfile.mkstemp()
+        os.close(temp_file)
+
+        try:
+            db_conn, db_cursor = sqlite_db.init_db(temp_path, SQLITE_DB_SCHEMA)
+            parser = consensus.ConsensusParser()
+            parser.import_guards(datetime(2014, 7, 1, 0), [GUARD_1_FPR, GUARD_2_FPR], db_cursor)
+            parser.import_guards(datetime(2014, 7, 1, 1), [GUARD_1_FPR], db_cursor)
+            db_conn.commit()
+            db_cursor.execute("SELECT relay_id, start_hour, end_hour FROM guard_interval")
+            guard_intervals = sorted(tuple(row) for row in db_cursor.fetchall())
+            self.assertEquals([end_hour for _, _, end_hour in guard_intervals].count(sqlite_db.OPEN_END_HOUR), 1)
+
+            # Close them like schema version 8 did.
+            db_cursor.execute("UPDATE guard_interval SET end_hour = ? WHERE end_hour = ?",
+                              (sqlite_db.get_newest_consensus_hour(db_cursor) + 1, sqlite_db.OPEN_END_HOUR))
+            db_cursor.execute("PRAGMA user_version = 8")
+            db_conn.commit()
+            db_conn.close()
+
+            db_conn, db_cursor = sqlite_db.init_db(temp_path)
+            db_cursor.execute("SELECT relay_id, start_hour, end_hour FROM guard_interval")
+            self.assertEquals(sorted(tuple(row) for row in db_cursor.fetchall()), guard_intervals)
+            db_conn.close()
+        finally:
+            os.remove(temp_path)
+
 if __name__ == '__main__':
     unittest.main()
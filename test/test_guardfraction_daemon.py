@@ -0,0 +1,117 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+import guardiness.sqlite_db as sqlite_db
+import guardiness.guard_ds as guard_ds
+import guardfraction_daemon
+import guardfraction
+
+from test_databaser import parse_consensuses_naive_way
+
+SQLITE_DB_SCHEMA = "./db_schema.sql"
+
+TEST_CONSENSUSES_DIR = "./test/test_consensuses/" # XXX
+
+# Big enough for our 2014 test consensuses to be in the window.
+MAX_DAYS = 100*365
+
+class testGuardfractionDaemon(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.spool_dir = os.path.join(self.temp_dir, "spool")
+        os.mkdir(self.spool_dir)
+        self.output_file = os.path.join(self.temp_dir, "guardfraction.output")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def spool_consensuses(self, filenames):
+        for filename in filenames:
+            shutil.copy(os.path.join(TEST_CONSENSUSES_DIR, filename), self.spool_dir)
+
+    def read_output_guards(self):
+        with open(self.output_file) as output_fd:
+            lines = output_fd.readlines()
+
+        guards_dict = {}
+        for line in lines[3:]:
+            _, guard_fpr, _, times_seen = line.split()
+            guards_dict[guard_fpr] = int(times_seen)
+
+        return lines[2], guards_dict
+
+    def test_spooled_consensuses_get_imported(self):
+        """
+        Test that the daemon imports spooled consensuses as they arrive
+        and keeps the output file up to date.
+        """
+
+        db_conn, db_cursor = sqlite_db.init_db(os.path.join(self.temp_dir, "guardfraction.db"),
+                                               SQLITE_DB_SCHEMA, "import")
+        daemon = guardfraction_daemon.GuardfractionDaemon(db_conn, db_cursor, self.spool_dir,
+                                                          self.output_file, MAX_DAYS, fast=True)
+
+        # Nothing to do yet.
+        self.assertFalse(daemon.poll())
+
+        filenames = sorted(os.listdir(TEST_CONSENSUSES_DIR))
+        self.spool_consensuses(filenames[:2])
+        self.assertTrue(daemon.poll())
+        self.assertEquals(os.listdir(self.spool_dir), [])
+
+        n_inputs, _ = self.read_output_guards()
+        self.assertEquals(n_inputs, "n-inputs 2 %d %d\n" % (MAX_DAYS, MAX_DAYS*24))
+
+        # Nothing new, nothing to rewrite.
+        self.assertFalse(daemon.poll())
+
+        # The same consensus again, plus the rest of them.
+        self.spool_consensuses(filenames[1:])
+        self.assertTrue(daemon.poll())
+
+        n_inputs, guards_dict = self.read_output_guards()
+        self.assertEquals(n_inputs, "n-inputs 4 %d %d\n" % (MAX_DAYS, MAX_DAYS*24))
+        self.assertEquals(guards_dict, parse_consensuses_naive_way(TEST_CONSENSUSES_DIR))
+
+        # guardfraction.py writes the very same guard data, equally
+        # seen guards included.
+        guards, consensuses_read_n = guardfraction.read_db_file(db_conn, db_cursor, MAX_DAYS)
+        script_output_file = os.path.join(self.temp_dir, "script.output")
+        guard_ds.write_output_file(script_output_file, MAX_DAYS, consensuses_read_n, guards)
+        with open(self.output_file) as output_fd, open(script_output_file) as script_output_fd:
+            self.assertEquals(script_output_fd.readlines()[2:], output_fd.readlines()[2:])
+        self.assertEquals(guard_ds.read_output_digest(script_output_file),
+                          guard_ds.read_output_digest(self.output_file))
+
+        db_conn.close()
+
+    def test_unparseable_consensus_is_kept(self):
+        """Test that spooled files that don't parse are moved aside instead of being thrown away."""
+
+        db_conn, db_cursor = sqlite_db.init_db(os.path.join(self.temp_dir, "guardfraction.db"),
+                                               SQLITE_DB_SCHEMA, "import")
+        daemon = guardfraction_daemon.GuardfractionDaemon(db_conn, db_cursor, self.spool_dir,
+                                                          self.output_file, MAX_DAYS, fast=True)
+
+        filenames = sorted(os.listdir(TEST_CONSENSUSES_DIR))
+        self.spool_consensuses(filenames[:1])
+        with open(os.path.join(self.spool_dir, "consensus-garbage"), "w") as garbage_fd:
+            garbage_fd.write("network-status-version 3 microdesc\nthis is not a consensus\n")
+
+        self.assertTrue(daemon.poll())
+        self.assertEquals(sorted(os.listdir(self.spool_dir)), [guardfraction_daemon.FAILED_SUBDIR])
+        self.assertEquals(os.listdir(os.path.join(self.spool_dir, guardfraction_daemon.FAILED_SUBDIR)),
+                          ["consensus-garbage"])
+
+        n_inputs, _ = self.read_output_guards()
+        self.assertEquals(n_inputs, "n-inputs 1 %d %d\n" % (MAX_DAYS, MAX_DAYS*24))
+
+        # The failed directory isn't mistaken for a consensus.
+        self.assertFalse(daemon.poll())
+
+        db_conn.close()
+
+if __name__ == '__main__':
+    unittest.main()